@@ -6,7 +6,147 @@ if (sys.version_info[1] >= 7) :
 else :
   try: import subprocess_with_fixes as subprocess
   except ImportError: import subprocess
-import sys, os
+import sys, os, time
+
+def _popen_has_waitpid_hooks():
+  """\
+True if subprocess.Popen reaps the child via _internal_poll(_waitpid=)
+and _handle_exitstatus(), the private hooks _rusage_popen relies on
+(e.g. not necessarily the case for subprocess_with_fixes).
+"""
+  import inspect
+  try:
+    args = inspect.getargspec(subprocess.Popen._internal_poll)[0]
+  except (AttributeError, TypeError):
+    return False
+  return ("_waitpid" in args
+          and hasattr(subprocess.Popen, "_handle_exitstatus"))
+
+if (hasattr(os, "wait4") and _popen_has_waitpid_hooks()):
+
+  class _rusage_popen(subprocess.Popen):
+    "subprocess.Popen that reaps the child with os.wait4(), keeping rusage."
+
+    rusage = None
+
+    def _wait4(self, pid, options, _wait4=os.wait4):
+      result_pid, sts, rusage = _wait4(pid, options)
+      if (result_pid == pid):
+        self.rusage = rusage
+      return result_pid, sts
+
+    def _internal_poll(self, _deadstate=None):
+      return subprocess.Popen._internal_poll(self,
+        _deadstate=_deadstate, _waitpid=self._wait4)
+
+    def wait(self):
+      import errno
+      while (self.returncode is None):
+        try:
+          pid, sts = self._wait4(self.pid, 0)
+        except OSError, e:
+          if (e.errno == errno.EINTR): continue
+          if (e.errno != errno.ECHILD): raise
+          pid, sts = self.pid, 0
+        if (pid == self.pid):
+          self._handle_exitstatus(sts)
+      return self.returncode
+
+else:
+
+  class _rusage_popen(subprocess.Popen):
+    rusage = None
+
+def _format_optional(value, format):
+  if (value is None): return "n/a"
+  return format % value
+
+_resource_usage_collector = None
+
+class resource_usage_collector(object):
+  """\
+Records the resource usage (see fully_buffered_base) of every child
+run by fully_buffered, go, command_pool and streaming while installed,
+e.g. to find the slowest steps of a build:
+
+  collector = easy_run.resource_usage_collector("steps.jsonl").install()
+  ... # easy_run calls
+  collector.uninstall()
+  collector.show_slowest(n=10)
+
+If file_name is given, each record is also appended to it as one line
+of JSON; from_file() reads such a file back. Thread safe.
+"""
+
+  def __init__(self, file_name=None):
+    import threading
+    self.file_name = file_name
+    self.records = []
+    self._lock = threading.Lock()
+
+  def from_file(cls, file_name):
+    import json
+    result = cls()
+    for line in open(file_name):
+      if (len(line.strip()) != 0):
+        result.records.append(json.loads(line))
+    return result
+  from_file = classmethod(from_file)
+
+  def install(self):
+    global _resource_usage_collector
+    _resource_usage_collector = self
+    return self
+
+  def uninstall(self):
+    global _resource_usage_collector
+    if (_resource_usage_collector is self):
+      _resource_usage_collector = None
+    return self
+
+  def add(self, result):
+    command = result.command
+    if (not isinstance(command, str)):
+      command = list(command)
+    record = {
+      "start_time": time.time() - result.wall_time,
+      "command": command,
+      "return_code": result.return_code,
+      "timed_out": result.timed_out,
+      "wall_time": result.wall_time,
+      "user_time": result.user_time,
+      "system_time": result.system_time,
+      "max_rss_kb": result.max_rss_kb}
+    self._lock.acquire()
+    try:
+      self.records.append(record)
+      if (self.file_name is not None):
+        import json
+        f = open(self.file_name, "a")
+        try:
+          f.write(json.dumps(record, sort_keys=True) + "\n")
+        finally:
+          f.close()
+    finally:
+      self._lock.release()
+
+  def slowest(self, n=10, key="wall_time"):
+    records = [r for r in self.records if r[key] is not None]
+    records.sort(key=lambda r: r[key], reverse=True)
+    return records[:n]
+
+  def show_slowest(self, n=10, key="wall_time", out=None, prefix=""):
+    if (out is None): out = sys.stdout
+    print >> out, prefix + "%8s %8s %8s %10s  command" % (
+      "wall", "user", "system", "max RSS")
+    f = _format_optional
+    for r in self.slowest(n=n, key=key):
+      print >> out, prefix + "%8s %8s %8s %10s  %s" % (
+        f(r["wall_time"], "%.3f"),
+        f(r["user_time"], "%.3f"),
+        f(r["system_time"], "%.3f"),
+        f(r["max_rss_kb"], "%d kB"),
+        r["command"])
 
 def _show_lines(lines, out, prefix):
   if (out is None): out = sys.stdout
@@ -15,8 +155,46 @@ def _show_lines(lines, out, prefix):
 
 class fully_buffered_base(object):
 
+  timed_out = False
+  wall_time = None
+  user_time = None
+  system_time = None
+  max_rss_kb = None
+
+  def _set_resource_usage(self, wall_time, rusage):
+    """\
+Sets wall_time (seconds), and user_time, system_time (seconds) and
+max_rss_kb from rusage (as returned by os.wait4(); None if not
+available). Under POSIX these include the children of the child that
+it waited for (e.g. the command run by the shell).
+"""
+    self.wall_time = wall_time
+    if (rusage is not None):
+      self.user_time = rusage.ru_utime
+      self.system_time = rusage.ru_stime
+      if (sys.platform == "darwin"): # bytes
+        self.max_rss_kb = rusage.ru_maxrss // 1024
+      else:
+        self.max_rss_kb = rusage.ru_maxrss
+    if (_resource_usage_collector is not None):
+      _resource_usage_collector.add(self)
+
+  def format_resource_usage(self):
+    f = _format_optional
+    return "wall: %s, user: %s, system: %s, max RSS: %s" % (
+      f(self.wall_time, "%.3f s"),
+      f(self.user_time, "%.3f s"),
+      f(self.system_time, "%.3f s"),
+      f(self.max_rss_kb, "%d kB"))
+
   def format_errors_if_any(self):
     assert not self.join_stdout_stderr
+    if (self.timed_out):
+      msg = ["child process timed out after %.6g seconds:" % self.timeout]
+      msg.append("  command: " + repr(self.command))
+      for line in self.stderr_lines:
+        msg.append("  " + line)
+      return "\n".join(msg)
     if (len(self.stderr_lines) != 0):
       msg = ["child process stderr output:"]
       msg.append("  command: " + repr(self.command))
@@ -121,18 +299,31 @@ implementation should cover most practical situations.
     self.return_code = None
 
 class fully_buffered_subprocess(fully_buffered_base):
-  "This implementation is supposed to never block."
+  """\
+This implementation is supposed to never block.
+
+A str command is run by the shell. Under POSIX a sequence command is
+executed directly, without a shell; if the program cannot be executed,
+the result looks like the shell's (message in stderr_lines,
+return_code 127 if it does not exist).
+
+If timeout (seconds) is given, the child is killed when its output is
+not complete after timeout seconds (under POSIX together with all
+processes it started, which may keep the pipes open after the child
+exited), and timed_out is set (format_errors_if_any() reports it).
+"""
 
   def __init__(self,
         command,
         stdin_lines=None,
         join_stdout_stderr=False,
         stdout_splitlines=True,
-        bufsize=-1):
+        bufsize=-1,
+        timeout=None):
     self.command = command
     self.join_stdout_stderr = join_stdout_stderr
-    if (not isinstance(command, str)):
-      command = subprocess.list2cmdline(command)
+    self.timeout = timeout
+    popen_keyword_args = _popen_keyword_args(command, timeout)
     if (stdin_lines is not None):
       if (not isinstance(stdin_lines, str)):
         stdin_lines = os.linesep.join(stdin_lines)
@@ -142,16 +333,36 @@ class fully_buffered_subprocess(fully_buffered_base):
       stderr = subprocess.STDOUT
     else:
       stderr = subprocess.PIPE
-    p = subprocess.Popen(
-      args=command,
-      shell=True,
-      bufsize=bufsize,
-      stdin=subprocess.PIPE,
-      stdout=subprocess.PIPE,
-      stderr=stderr,
-      universal_newlines=True,
-      close_fds=not subprocess.mswindows)
-    o, e = p.communicate(input=stdin_lines)
+    t0 = time.time()
+    try:
+      p = _rusage_popen(
+        bufsize=bufsize,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        universal_newlines=True,
+        **popen_keyword_args)
+    except OSError, e:
+      if (popen_keyword_args["shell"]): raise
+      self._set_exec_failure(
+        popen_keyword_args["args"][0], e, stdout_splitlines)
+      self._set_resource_usage(time.time() - t0, None)
+      return
+    if (timeout is None):
+      o, e = p.communicate(input=stdin_lines)
+    else:
+      import threading
+      self._kill_lock = threading.Lock()
+      self._communicating = True
+      timer = threading.Timer(timeout, self._kill, (p,))
+      timer.start()
+      try:
+        o, e = p.communicate(input=stdin_lines)
+      finally:
+        self._kill_lock.acquire()
+        self._communicating = False
+        self._kill_lock.release()
+        timer.cancel()
     if (stdout_splitlines):
       self.stdout_buffer = None
       self.stdout_lines = o.splitlines()
@@ -163,9 +374,658 @@ class fully_buffered_subprocess(fully_buffered_base):
     else:
       self.stderr_lines = e.splitlines()
     self.return_code = p.returncode
+    self._set_resource_usage(time.time() - t0, p.rusage)
+
+  def _set_exec_failure(self, program, e, stdout_splitlines):
+    "Like the shell: message on stderr, return code 127 or 126."
+    import errno
+    lines = ["%s: %s" % (program, e.strerror)]
+    if (self.join_stdout_stderr):
+      self.stderr_lines = []
+    else:
+      self.stderr_lines, lines = lines, []
+    if (stdout_splitlines):
+      self.stdout_buffer = None
+      self.stdout_lines = lines
+    else:
+      self.stdout_buffer = "".join([line + "\n" for line in lines])
+      self.stdout_lines = None
+    if (e.errno == errno.ENOENT):
+      self.return_code = 127
+    else:
+      self.return_code = 126
+
+  def _kill(self, p):
+    """\
+Called by the timer: communicate() has not returned yet. Under POSIX the
+process group is killed even if the child itself has exited, because
+processes it started may still hold the pipes.
+"""
+    self._kill_lock.acquire()
+    try:
+      if (not self._communicating): return
+      if (os.name != "posix" and p.poll() is not None): return
+      try:
+        if (os.name == "posix"):
+          import signal
+          os.killpg(p.pid, signal.SIGKILL)
+        else:
+          p.kill()
+      except OSError:
+        pass # already finished
+      else:
+        self.timed_out = True
+    finally:
+      self._kill_lock.release()
 
 fully_buffered = fully_buffered_subprocess
 
+def _close_inherited_fds():
+  """\
+preexec_fn equivalent of close_fds=True that closes only the open file
+descriptors (listed in /proc/self/fd) instead of all up to the
+SC_OPEN_MAX limit, which takes milliseconds if the limit is high.
+Descriptors with FD_CLOEXEC are left to exec (subprocess needs its
+error pipe).
+"""
+  import fcntl
+  for name in os.listdir("/proc/self/fd"):
+    fd = int(name)
+    if (fd <= 2): continue
+    try:
+      if (not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC):
+        os.close(fd)
+    except (IOError, OSError):
+      pass
+
+def _popen_keyword_args(command, timeout=None, new_process_group=False):
+  """\
+args, shell, close_fds and preexec_fn for subprocess.Popen.
+
+A str command is run by the shell, as always. Under POSIX a sequence
+command is executed directly (shell=False), which saves starting
+/bin/sh, and its elements are passed unchanged (no quoting, no shell
+syntax); where os.posix_spawn exists (Python >= 3.8, descriptors are
+not inheritable by default) close_fds=False allows subprocess to use
+posix_spawn or vfork instead of fork, otherwise (Python 2) the
+inherited descriptors are closed by _close_inherited_fds() if
+/proc/self/fd is available. Under Windows a sequence is converted with
+list2cmdline and run by the shell as before.
+
+With timeout or new_process_group, the child gets a new process group
+under POSIX, so that it can be killed with all processes it started.
+"""
+  preexec_fns = []
+  if (isinstance(command, str)):
+    result = dict(args=command, shell=True,
+      close_fds=not subprocess.mswindows)
+  elif (os.name != "posix"):
+    result = dict(args=subprocess.list2cmdline(command), shell=True,
+      close_fds=False)
+  else:
+    result = dict(args=list(command), shell=False, close_fds=True)
+    if (hasattr(os, "posix_spawn")):
+      result["close_fds"] = False
+    elif (os.path.isdir("/proc/self/fd")):
+      result["close_fds"] = False
+      preexec_fns.append(_close_inherited_fds)
+  if ((timeout is not None or new_process_group) and os.name == "posix"):
+    preexec_fns.append(os.setpgrp)
+  if (len(preexec_fns) == 0):
+    result["preexec_fn"] = None
+  elif (len(preexec_fns) == 1):
+    result["preexec_fn"] = preexec_fns[0]
+  else:
+    def preexec_fn():
+      for f in preexec_fns: f()
+    result["preexec_fn"] = preexec_fn
+  return result
+
+def _default_max_in_flight():
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 1
+
+class command_pool(object):
+  """\
+Runs many independent commands concurrently via fully_buffered, with at
+most max_in_flight (default: the number of CPUs) children at a time.
+Keyword arguments (e.g. timeout, join_stdout_stderr, stdin_lines) are
+passed to fully_buffered for each command.
+
+Example:
+  for result in command_pool(max_in_flight=8, timeout=600).run(commands):
+    result.raise_if_errors()
+
+run() yields the results in the order of commands (ordered=True), or as
+they complete (ordered=False); each result has an extra attribute
+index, the position of its command. An exception raised for a command
+is re-raised by run() when that result is due; no further commands are
+started after that, or when the iteration is abandoned.
+"""
+
+  def __init__(self, max_in_flight=None, **keyword_args):
+    if (max_in_flight is None):
+      max_in_flight = _default_max_in_flight()
+    assert max_in_flight > 0
+    self.max_in_flight = max_in_flight
+    self.keyword_args = keyword_args
+
+  def run(self, commands, ordered=True):
+    import threading, Queue
+    jobs = enumerate(commands)
+    lock = threading.Lock()
+    done = Queue.Queue()
+    stop = []
+    def worker():
+      try:
+        while True:
+          lock.acquire()
+          try:
+            if (len(stop) != 0): break
+            try: index, command = jobs.next()
+            except StopIteration: break
+          finally:
+            lock.release()
+          try:
+            result = fully_buffered(command=command, **self.keyword_args)
+          except Exception:
+            done.put((index, None, sys.exc_info()))
+          else:
+            result.index = index
+            done.put((index, result, None))
+      finally:
+        done.put(None)
+    n_running = self.max_in_flight
+    for i in xrange(n_running):
+      t = threading.Thread(target=worker)
+      t.daemon = True
+      t.start()
+    pending = {}
+    next_index = 0
+    try:
+      while (n_running != 0):
+        item = done.get()
+        if (item is None):
+          n_running -= 1
+          continue
+        if (ordered):
+          pending[item[0]] = item
+          ready = []
+          while (next_index in pending):
+            ready.append(pending.pop(next_index))
+            next_index += 1
+        else:
+          ready = [item]
+        for index,result,exc_info in ready:
+          if (exc_info is not None):
+            raise exc_info[0], exc_info[1], exc_info[2]
+          yield result
+    finally:
+      stop.append(True)
+
+class streaming_result(fully_buffered_base):
+  """\
+Final result of streaming_subprocess: return_code, the numbers of
+lines (or chunks) seen, and the last tail_size of them in stdout_lines
+and stderr_lines (all of them if tail_size is None), e.g. for
+raise_if_errors().
+"""
+
+  def __init__(self, command, join_stdout_stderr, return_code,
+        n_stdout_lines, n_stderr_lines, stdout_lines, stderr_lines):
+    self.command = command
+    self.join_stdout_stderr = join_stdout_stderr
+    self.return_code = return_code
+    self.n_stdout_lines = n_stdout_lines
+    self.n_stderr_lines = n_stderr_lines
+    self.stdout_buffer = None
+    self.stdout_lines = stdout_lines
+    self.stderr_lines = stderr_lines
+
+class streaming_subprocess(object):
+  """\
+Executes command and yields ("stdout", line) and ("stderr", line)
+tuples (line without the trailing newline) as the child produces them,
+instead of buffering all output like fully_buffered_subprocess. With
+chunk_size, ("stdout", bytes) chunks of up to chunk_size bytes are
+yielded instead of lines.
+
+One thread per pipe reads the output as it becomes available (up to
+64 KiB per read) into a queue holding at most max_queue_size reads; if
+the consumer falls behind, the readers and eventually the child block,
+so memory use is bounded. stdin_lines (str or sequence) are written by
+another thread, i.e. this never deadlocks. Trailing carriage returns
+are removed from lines.
+
+Example:
+  s = streaming(command="make")
+  for source,line in s:
+    ...
+  s.result.raise_if_errors()
+
+wait() consumes any remaining output (keeping only the tails) and
+returns the streaming_result, which is also available as .result once
+the iteration is finished. After leaving the iteration early (break
+or an exception) it can be resumed with the next line, or wait()
+called; otherwise call close(), which kills the child and all
+processes it started (under POSIX the child runs in its own process
+group) and discards the remaining output, to release the child and the
+reader threads, most easily with a with statement:
+
+  with streaming(command="make") as s:
+    for source,line in s:
+      ...
+
+Sequence commands are executed without a shell under POSIX (see
+fully_buffered_subprocess); OSError is raised if the program cannot be
+executed.
+"""
+
+  def __init__(self,
+        command,
+        stdin_lines=None,
+        join_stdout_stderr=False,
+        chunk_size=None,
+        max_queue_size=64,
+        tail_size=100,
+        bufsize=-1):
+    import Queue
+    self.command = command
+    self.join_stdout_stderr = join_stdout_stderr
+    self.chunk_size = chunk_size
+    popen_keyword_args = _popen_keyword_args(command,
+      new_process_group=True)
+    if (join_stdout_stderr):
+      stderr = subprocess.STDOUT
+    else:
+      stderr = subprocess.PIPE
+    self._t0 = time.time()
+    self.process = p = _rusage_popen(
+      bufsize=bufsize,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      stderr=stderr,
+      **popen_keyword_args)
+    self.queue = Queue.Queue(maxsize=max_queue_size)
+    self.tail_size = tail_size
+    self.result = None
+    self._n_lines = {"stdout": 0, "stderr": 0}
+    import collections
+    self._pending = collections.deque() # received but not yet yielded
+    self._tails = {"stdout": [], "stderr": []}
+    self._threads = []
+    if (stdin_lines is None):
+      p.stdin.close()
+    else:
+      self._start_thread(self._write_stdin, p.stdin, stdin_lines)
+    self._n_readers = 0
+    for source,f in [("stdout", p.stdout), ("stderr", p.stderr)]:
+      if (f is not None):
+        self._start_thread(self._read, source, f)
+        self._n_readers += 1
+
+  def _start_thread(self, target, *args):
+    import threading
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+    self._threads.append(t)
+
+  def _write_stdin(self, f, stdin_lines):
+    try:
+      if (isinstance(stdin_lines, str)):
+        f.write(stdin_lines)
+      else:
+        for line in stdin_lines:
+          f.write(line + os.linesep)
+    except IOError:
+      pass # child exited without reading all input
+    try: f.close()
+    except IOError: pass
+
+  def _read(self, source, f):
+    put = self.queue.put
+    fd = f.fileno()
+    try:
+      if (self.chunk_size is not None):
+        while True:
+          chunk = os.read(fd, self.chunk_size)
+          if (len(chunk) == 0): break
+          put((source, [chunk]))
+      else:
+        pending = ""
+        while True:
+          data = os.read(fd, 65536)
+          if (len(data) == 0): break
+          lines = (pending + data).split("\n")
+          pending = lines.pop()
+          if (len(lines) != 0):
+            put((source, [line.rstrip("\r") for line in lines]))
+        if (len(pending) != 0):
+          put((source, [pending.rstrip("\r")]))
+    finally:
+      f.close()
+      put((source, None))
+
+  def __iter__(self):
+    get = self.queue.get
+    n_lines = self._n_lines
+    tails = self._tails
+    tail_size = self.tail_size
+    pending = self._pending
+    from itertools import izip, repeat
+    while True:
+      while (len(pending) != 0):
+        yield pending.popleft()
+      if (self._n_readers == 0): break
+      source, lines = get()
+      if (lines is None):
+        self._n_readers -= 1
+        continue
+      n_lines[source] += len(lines)
+      tail = tails[source]
+      tail.extend(lines)
+      if (tail_size is not None and len(tail) > 2 * tail_size + 16):
+        del tail[:len(tail)-tail_size]
+      pending.extend(izip(repeat(source), lines))
+    if (self.result is None):
+      self._finish()
+
+  def _finish(self):
+    for t in self._threads:
+      t.join()
+    tails = self._tails
+    if (self.tail_size is not None):
+      for tail in tails.values():
+        if (len(tail) > self.tail_size):
+          del tail[:len(tail)-self.tail_size]
+    self.result = streaming_result(
+      command=self.command,
+      join_stdout_stderr=self.join_stdout_stderr,
+      return_code=self.process.wait(),
+      n_stdout_lines=self._n_lines["stdout"],
+      n_stderr_lines=self._n_lines["stderr"],
+      stdout_lines=tails["stdout"],
+      stderr_lines=tails["stderr"])
+    self.result._set_resource_usage(
+      time.time() - self._t0, self.process.rusage)
+
+  def wait(self):
+    for item in self:
+      pass
+    return self.result
+
+  def close(self):
+    """\
+Kills the child and all processes it started (its process group under
+POSIX), discards the remaining output and waits for the reader
+threads. Returns the streaming_result.
+"""
+    if (self.result is None):
+      p = self.process
+      try:
+        if (os.name == "posix"):
+          import signal
+          os.killpg(p.pid, signal.SIGKILL)
+        elif (p.poll() is None):
+          p.kill()
+      except OSError:
+        pass # already finished
+      self._pending.clear()
+      while (self._n_readers != 0):
+        source, lines = self.queue.get()
+        if (lines is None):
+          self._n_readers -= 1
+      self._finish()
+    return self.result
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+streaming = streaming_subprocess
+
+class coprocess_result(fully_buffered_base):
+
+  def __init__(self, command, join_stdout_stderr, timeout):
+    self.command = command
+    self.join_stdout_stderr = join_stdout_stderr
+    self.timeout = timeout
+
+class coprocess_shell(object):
+  """\
+A long-lived /bin/sh (POSIX only) that runs one command after another,
+to avoid starting a new shell from Python for each of thousands of
+small commands (compare go() and fully_buffered).
+
+Each command is sent over the shell's stdin as
+  ( cd <cwd> || exit 126; <environment>; eval '<command>' ) < stdin 2>&1
+  printf '\\n<sentinel> %d\\n' $?
+  printf '\\n<sentinel>\\n' >&2
+i.e. it runs in a subshell (cd, exit, variable assignments do not
+affect later commands) in the current working directory of the Python
+process, with the variables of os.environ that were changed or removed
+since the shell was started exported or unset, with stdin_lines as a
+here-document (a final newline is added if missing) or /dev/null, and
+"2>&1" only with join_stdout_stderr. The command is passed to eval as a
+quoted string, so that a syntax error only ends the subshell (exit
+status 2 and the shell's message on stderr, as with go()). The output
+is read until the random sentinel lines appear on stdout and stderr;
+the one on stdout carries the exit status.
+
+run() returns a coprocess_result, which has the same attributes as
+fully_buffered_subprocess results (including timed_out and wall_time).
+If the shell has died it is restarted transparently before the next
+command. If it dies while running a command, or timeout expires (the
+shell runs in its own process group, which is then killed, including
+all processes the command started), the result has return_code None
+and a message in stderr_lines. run() may be called from several
+threads; the commands
+are then serialized (use several instances for parallelism).
+"""
+
+  def __init__(self, shell="/bin/sh"):
+    import threading
+    self.shell = shell
+    self.process = None
+    self.n_starts = 0
+    self._lock = threading.Lock()
+    self._serial = 0
+
+  def _start(self):
+    self.process = subprocess.Popen(
+      args=[self.shell],
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      close_fds=True,
+      preexec_fn=os.setsid)
+    self.n_starts += 1
+    self._environ = dict(os.environ)
+    import random
+    self._token = "__easy_run_%d_%08x__" % (
+      self.process.pid, random.SystemRandom().getrandbits(32))
+
+  def is_alive(self):
+    return (self.process is not None and self.process.poll() is None)
+
+  def close(self):
+    p = self.process
+    if (p is None): return
+    self.process = None
+    if (p.poll() is None):
+      try:
+        p.stdin.write("exit\n")
+        p.stdin.close()
+      except IOError:
+        pass
+      p.wait()
+    for f in (p.stdin, p.stdout, p.stderr):
+      if (not f.closed): f.close()
+
+  def kill(self):
+    "Kills the shell and all processes it started (its process group)."
+    p = self.process
+    if (p is not None):
+      import signal
+      try: os.killpg(p.pid, signal.SIGKILL)
+      except OSError: pass # no processes left
+    self.close()
+
+  def _environment_script(self):
+    "export and unset commands for the changes of os.environ."
+    import pipes, re
+    is_name = re.compile("[A-Za-z_][A-Za-z0-9_]*$").match
+    result = []
+    environ = self._environ
+    for name,value in sorted(os.environ.items()):
+      if (environ.get(name) != value and is_name(name)):
+        result.append("export %s=%s\n" % (name, pipes.quote(value)))
+    for name in sorted(environ.keys()):
+      if (name not in os.environ and is_name(name)):
+        result.append("unset %s\n" % name)
+    return "".join(result)
+
+  def _script(self, command, stdin_lines, join_stdout_stderr, token):
+    import pipes
+    if (not isinstance(command, str)):
+      command = " ".join([pipes.quote(arg) for arg in command])
+    redirections = ""
+    if (join_stdout_stderr):
+      redirections = " 2>&1"
+    if (stdin_lines is None):
+      here_document = ""
+      redirections = " </dev/null" + redirections
+    else:
+      if (not isinstance(stdin_lines, str)):
+        stdin_lines = "".join([line + "\n" for line in stdin_lines])
+      elif (not stdin_lines.endswith("\n") and len(stdin_lines) != 0):
+        stdin_lines += "\n"
+      here_document = stdin_lines + token + "_in\n"
+      redirections = " <<'%s_in'%s" % (token, redirections)
+    return "".join([
+      "(\n",
+      "cd %s || exit 126\n" % pipes.quote(os.getcwd()),
+      self._environment_script(),
+      "eval %s\n" % pipes.quote(command),
+      ")", redirections, "\n",
+      here_document,
+      "printf '\\n%s %%d\\n' $?\n" % token,
+      "printf '\\n%s\\n' >&2\n" % token])
+
+  def run(self,
+        command,
+        stdin_lines=None,
+        join_stdout_stderr=False,
+        stdout_splitlines=True,
+        timeout=None):
+    result = coprocess_result(
+      command=command,
+      join_stdout_stderr=join_stdout_stderr,
+      timeout=timeout)
+    self._lock.acquire()
+    try:
+      t0 = time.time()
+      if (not self.is_alive()):
+        self.close()
+        self._start()
+      self._serial += 1
+      token = "%s%d" % (self._token, self._serial)
+      script = self._script(command, stdin_lines, join_stdout_stderr, token)
+      o, e, result.return_code, result.timed_out = self._communicate(
+        script, token, timeout)
+    finally:
+      self._lock.release()
+    if (stdout_splitlines):
+      result.stdout_buffer = None
+      result.stdout_lines = o.splitlines()
+    else:
+      result.stdout_buffer = o
+      result.stdout_lines = None
+    result.stderr_lines = e.splitlines()
+    if (result.return_code is None):
+      if (result.timed_out):
+        result.stderr_lines.append("coprocess_shell: shell killed.")
+      else:
+        result.stderr_lines.append("coprocess_shell: shell terminated.")
+    result._set_resource_usage(time.time() - t0, None)
+    return result
+
+  def _communicate(self, script, token, timeout):
+    """\
+Sends script and reads stdout and stderr up to the sentinel lines.
+Returns (stdout, stderr, return code, timed out). If the shell died or
+timeout expired (the shell is then killed), the return code is None
+and stdout and stderr are the output read so far.
+"""
+    import select
+    p = self.process
+    try:
+      p.stdin.write(script)
+      p.stdin.flush()
+    except IOError:
+      self.kill()
+      return "", "", None, False
+    out_fd = p.stdout.fileno()
+    err_fd = p.stderr.fileno()
+    chunks = {out_fd: [], err_fd: []}
+    tails = {out_fd: "", err_fd: ""}
+    pending = [out_fd, err_fd]
+    marker = "\n" + token
+    def output(fd):
+      data = "".join(chunks[fd])
+      i = data.rfind(marker)
+      if (i < 0): return data, None
+      return data[:i], data[i+len(marker):-1]
+    def failure(timed_out):
+      self.kill()
+      return output(out_fd)[0], output(err_fd)[0], None, timed_out
+    if (timeout is not None):
+      deadline = time.time() + timeout
+    while (len(pending) != 0):
+      if (timeout is None):
+        ready = select.select(pending, [], [])[0]
+      else:
+        remaining = deadline - time.time()
+        if (remaining <= 0):
+          return failure(timed_out=True)
+        ready = select.select(pending, [], [], remaining)[0]
+      for fd in ready:
+        data = os.read(fd, 65536)
+        if (len(data) == 0):
+          return failure(timed_out=False)
+        chunks[fd].append(data)
+        tail = (tails[fd] + data)[-(len(marker) + 32):]
+        tails[fd] = tail
+        if (tail.endswith("\n")):
+          i = tail.rfind(marker, 0, len(tail)-1)
+          if (i >= 0 and tail.find("\n", i+1, len(tail)-1) < 0):
+            pending.remove(fd)
+    o, status = output(out_fd)
+    e = output(err_fd)[0]
+    return o, e, int(status), False
+
+_default_coprocess_shell = None
+
+def go_coprocess(command, stdin_lines=None):
+  """\
+Like go() (stdout and stderr joined), but runs the command in a shared
+coprocess_shell that is started on first use.
+"""
+  global _default_coprocess_shell
+  if (_default_coprocess_shell is None):
+    _default_coprocess_shell = coprocess_shell()
+  return _default_coprocess_shell.run(
+    command=command,
+    stdin_lines=stdin_lines,
+    join_stdout_stderr=True)
+
 def go(command, stdin_lines=None):
   return fully_buffered(
     command=command,
@@ -398,6 +1258,326 @@ sys.stderr.flush()"''' % (n_lines_e, ord("\n"))).splitlines())
   #
   fb(command=cat_command).raise_if_errors_or_output()
   #
+  s = streaming(
+    command=cat_command,
+    stdin_lines=(str(i) for i in xrange(n_lines_o)),
+    max_queue_size=4,
+    tail_size=3)
+  n = 0
+  for source,line in s:
+    assert source == "stdout"
+    assert line == str(n)
+    assert s.queue.qsize() <= 4
+    n += 1
+  assert n == n_lines_o
+  result = s.result.raise_if_errors()
+  assert result.return_code == 0
+  assert result.n_stdout_lines == n_lines_o
+  assert result.stdout_lines \
+    == [str(i) for i in xrange(n_lines_o-3, n_lines_o)]
+  assert s.wait() is result
+  command = pyexe + ''' -c "import sys
+for i in range(1000): sys.stderr.write(str(i)+chr(10))
+sys.exit(3)"'''
+  s = streaming(command=command)
+  for source,line in s:
+    if (line == "2"): break
+  assert source == "stderr"
+  result = s.wait()
+  assert result.return_code == 3
+  assert result.n_stderr_lines == 1000
+  assert result.stderr_lines[-1] == "999" and len(result.stderr_lines) == 100
+  try: result.raise_if_errors()
+  except RuntimeError, e:
+    assert str(e).endswith("\n  999")
+  else: raise Exception_expected
+  result = streaming(command=command, join_stdout_stderr=True,
+    tail_size=None).wait()
+  assert result.stdout_lines == [str(i) for i in xrange(1000)]
+  assert result.stderr_lines == []
+  s = streaming(command=cat_command, stdin_lines="hello\nworld\n",
+    chunk_size=4)
+  chunks = [chunk for source,chunk in s]
+  assert "".join(chunks) == "hello" + os.linesep + "world" + os.linesep
+  assert max([len(chunk) for chunk in chunks]) <= 4
+  assert s.result.n_stdout_lines == len(chunks)
+  result = streaming(command=cat_command).wait().raise_if_errors_or_output()
+  assert result.n_stdout_lines == 0
+  endless_command = [sys.executable, "-c", "while 1: print 'y' * 99"]
+  with streaming(command=endless_command, max_queue_size=2) as s:
+    for source,line in s:
+      break
+  assert line == "y" * 99
+  assert s.result.return_code != 0
+  assert [t for t in s._threads if t.is_alive()] == []
+  assert s.close() is s.result
+  s = streaming(command=endless_command, max_queue_size=2)
+  try:
+    with s:
+      for source,line in s:
+        raise RuntimeError("stop")
+  except RuntimeError, e:
+    assert str(e) == "stop"
+  else: raise Exception_expected
+  assert s.process.returncode is not None
+  assert s.result.n_stdout_lines >= 1
+  assert streaming(command=[sys.executable, "-c", "print 1"]).close() \
+    .return_code is not None
+  s = streaming(command=[sys.executable, "-c", "import sys; "
+    "sys.stdout.write(''.join([str(i)+chr(10) for i in range(10)]))"])
+  lines = []
+  for source,line in s:
+    lines.append(line)
+    if (line == "2"): break
+  for source,line in s:
+    lines.append(line)
+  assert lines == [str(i) for i in xrange(10)]
+  assert s.result.n_stdout_lines == 10
+  if (os.name == "posix"):
+    with streaming(command=pyexe + ''' -c "while 1: print 'y'" | cat''') as s:
+      for source,line in s:
+        break
+    assert line == "y"
+    assert [t for t in s._threads if t.is_alive()] == []
+  #
+  sleep_command = pyexe + ' -c "import sys, time; time.sleep(%s); print %d"'
+  delays = [0.8, 0.1, 0.2, 0, 0.1, 0]
+  commands = [sleep_command % (d, i) for i,d in enumerate(delays)]
+  pool = command_pool(max_in_flight=3)
+  results = list(pool.run(commands))
+  assert [result.index for result in results] == range(len(delays))
+  for i,result in enumerate(results):
+    assert result.raise_if_errors().stdout_lines == [str(i)]
+    assert result.return_code == 0
+  results = list(pool.run(commands, ordered=False))
+  assert sorted([result.index for result in results]) == range(len(delays))
+  for result in results:
+    assert result.stdout_lines == [str(result.index)]
+    assert not result.timed_out
+  import shutil, tempfile
+  rendezvous_dir = tempfile.mkdtemp()
+  try:
+    # each command waits until all four are running at the same time
+    rendezvous_command = pyexe + ''' -c "import os, time; d = %r; \
+open(os.path.join(d, '%d'), 'w').close(); t0 = time.time(); \
+exec('while len(os.listdir(d)) < 4 and time.time() - t0 < 30: \
+time.sleep(0.01)'); print len(os.listdir(d))"'''
+    results = list(command_pool(max_in_flight=4).run(
+      [rendezvous_command % (rendezvous_dir, i) for i in xrange(4)],
+      ordered=False))
+  finally:
+    shutil.rmtree(rendezvous_dir)
+  assert set([result.index for result in results]) == set(range(4))
+  for result in results:
+    assert result.raise_if_errors().stdout_lines == ["4"]
+  results = list(command_pool(max_in_flight=2, timeout=0.5).run(
+    [sleep_command % (30, 0), sleep_command % (0, 1)]))
+  assert results[0].timed_out and results[0].return_code != 0
+  assert not results[1].timed_out
+  assert results[1].raise_if_errors().stdout_lines == ["1"]
+  try: results[0].raise_if_errors()
+  except RuntimeError, e:
+    assert str(e).startswith("child process timed out after 0.5 seconds:")
+  else: raise Exception_expected
+  result = fully_buffered(
+    command=sleep_command % (0, 2), timeout=10).raise_if_errors()
+  assert result.stdout_lines == ["2"] and not result.timed_out
+  if (os.name == "posix"):
+    import time
+    t0 = time.time()
+    result = fully_buffered(command="sleep 30 & echo hi", timeout=0.5)
+    assert time.time() - t0 < 20
+    assert result.timed_out and result.stdout_lines == ["hi"]
+  try: list(command_pool(max_in_flight=2).run(
+    [sleep_command % (0, 0), None, sleep_command % (0, 2)]))
+  except TypeError: pass
+  else: raise Exception_expected
+  #
+  if (os.name == "posix"):
+    result = fully_buffered(command=("echo", 'a "b"  c;', "$HOME")) \
+      .raise_if_errors()
+    assert result.stdout_lines == ['a "b"  c; $HOME']
+    result = fully_buffered(command="echo a; echo b").raise_if_errors()
+    assert result.stdout_lines == ["a", "b"]
+    for join_stdout_stderr in [False, True]:
+      for stdout_splitlines in [True, False]:
+        result = fully_buffered(
+          command=["C68649356116218352", "x"],
+          join_stdout_stderr=join_stdout_stderr,
+          stdout_splitlines=stdout_splitlines)
+        assert result.return_code == 127
+        if (join_stdout_stderr):
+          assert result.stderr_lines == []
+          lines = result.stdout_lines
+          if (not stdout_splitlines):
+            lines = result.stdout_buffer.splitlines()
+          assert lines[0].startswith("C68649356116218352: ")
+        else:
+          assert result.stdout_lines in [[], None]
+          assert result.stdout_buffer in ["", None]
+          try: result.raise_if_errors()
+          except RuntimeError, e:
+            assert str(e).startswith("child process stderr output:\n")
+          else: raise Exception_expected
+    assert fully_buffered(command=["/"]).return_code == 126
+    r, w = os.pipe()
+    try:
+      for timeout in [None, 10]:
+        result = fully_buffered(
+          command=[sys.executable, "-c", "import os\n"
+            "try: os.fstat(%d)\nexcept OSError: print 'closed'" % w],
+          timeout=timeout).raise_if_errors()
+        assert result.stdout_lines == ["closed"]
+    finally:
+      os.close(r)
+      os.close(w)
+    assert [line for source,line in streaming(
+      command=("echo", "a;", "b"))] == ["a; b"]
+  #
+  burn_command = pyexe + ''' -c "import time; t0 = time.time(); \
+s = 'x' * (64 * 1024 * 1024); exec('while time.time() - t0 < 0.3: pass')"'''
+  import tempfile
+  fd, log_file_name = tempfile.mkstemp(suffix=".jsonl")
+  os.close(fd)
+  collector = resource_usage_collector(file_name=log_file_name).install()
+  try:
+    result = fully_buffered(command=burn_command).raise_if_errors()
+    assert result.wall_time >= 0.3
+    if (hasattr(_rusage_popen, "_wait4")):
+      assert result.user_time + result.system_time > 0
+      assert result.max_rss_kb >= 64 * 1024
+      assert result.format_resource_usage().startswith("wall: ")
+    result = streaming(command=[sys.executable, "-c", "print 1"]).wait()
+    assert result.wall_time > 0
+    result = fully_buffered(command=["C68649356116218352"])
+    assert result.wall_time is not None and result.user_time is None
+    assert result.format_resource_usage().endswith("max RSS: n/a")
+    fully_buffered_simple(command="echo hello").raise_if_errors()
+  finally:
+    collector.uninstall()
+  assert _resource_usage_collector is None
+  fully_buffered(command="echo hello").raise_if_errors()
+  try:
+    assert len(collector.records) == 3
+    assert collector.slowest(n=1)[0]["command"] == burn_command
+    assert collector.slowest(n=1)[0]["return_code"] == 0
+    assert collector.records[2]["return_code"] == 127
+    assert collector.records[1]["command"] \
+        == [sys.executable, "-c", "print 1"]
+    records = resource_usage_collector.from_file(log_file_name).records
+    assert records == collector.records
+    s = StringIO()
+    collector.show_slowest(n=2, out=s, prefix="  ")
+    lines = s.getvalue().splitlines()
+    assert len(lines) == 3
+    assert lines[0].split() == ["wall", "user", "system", "max", "RSS",
+      "command"]
+    assert lines[1].endswith(burn_command)
+  finally:
+    os.remove(log_file_name)
+  #
+  if (os.name == "posix"):
+    shell = coprocess_shell()
+    result = shell.run(command="echo hello; echo world >&2; exit 3")
+    assert result.stdout_lines == ["hello"]
+    assert result.stderr_lines == ["world"]
+    assert result.return_code == 3
+    try: result.raise_if_errors()
+    except RuntimeError, e:
+      assert str(e).endswith("\n  world")
+    else: raise Exception_expected
+    result = shell.run(command="echo hello; echo world >&2",
+      join_stdout_stderr=True)
+    assert result.stdout_lines == ["hello", "world"]
+    assert result.return_code == 0 and result.wall_time > 0
+    for command,buffer in [("printf abc", "abc"), ("echo abc", "abc\n"),
+                           ("true", "")]:
+      result = shell.run(command=command, stdout_splitlines=False)
+      assert result.stdout_buffer == buffer
+      assert result.stdout_lines is None
+    for stdin_lines in [["a", "b", "c"], "a\nb\nc\n", "a\nb\nc"]:
+      assert shell.run(command=cat_command, stdin_lines=stdin_lines) \
+        .raise_if_errors().stdout_lines == ["a", "b", "c"]
+    assert shell.run(command=cat_command).stdout_lines == []
+    assert shell.run(command=("echo", "a;", "$HOME")).stdout_lines \
+      == ["a; $HOME"]
+    shell.run(command="cd /; X=1")
+    assert shell.run(command="pwd; echo $X").stdout_lines \
+      == [os.getcwd(), ""]
+    result = shell.run(
+      command=pyexe + ' -c "import sys; lines = sys.stdin.read(); '
+        'sys.stdout.write(lines); sys.stderr.write(lines)"',
+      stdin_lines=[str(i) for i in xrange(n_lines_o)])
+    for lines in [result.stdout_lines, result.stderr_lines]:
+      assert len(lines) == n_lines_o
+      assert lines[-1] == str(n_lines_o-1)
+    assert shell.n_starts == 1
+    result = shell.run(command="echo partial; kill $$")
+    assert result.return_code is None and not result.timed_out
+    assert result.stdout_lines == ["partial"]
+    assert result.stderr_lines == ["coprocess_shell: shell terminated."]
+    assert not shell.is_alive()
+    assert shell.run(command="echo again").stdout_lines == ["again"]
+    assert shell.n_starts == 2
+    for command in ["echo )", "echo 'unbalanced"]:
+      result = shell.run(command=command, timeout=10)
+      expected = fully_buffered(command=command)
+      assert result.return_code == expected.return_code == 2
+      assert result.stdout_lines == expected.stdout_lines == []
+      assert len(result.stderr_lines) == 1
+      assert result.stderr_lines[0].split(": ")[-1] \
+          == expected.stderr_lines[0].split(": ")[-1]
+    assert shell.n_starts == 2
+    result = shell.run(command="sleep 30", timeout=0.5)
+    assert result.timed_out and result.return_code is None
+    try: result.raise_if_errors()
+    except RuntimeError, e:
+      assert str(e).startswith("child process timed out after 0.5 seconds")
+    else: raise Exception_expected
+    result = shell.run(
+      command="sh -c 'echo $$; exec sleep 30'", timeout=0.5)
+    assert result.timed_out
+    pid = int(result.stdout_lines[0])
+    def is_running(pid):
+      try: stat = open("/proc/%d/stat" % pid).read()
+      except IOError:
+        try: os.kill(pid, 0)
+        except OSError: return False
+        return True
+      return stat[stat.rindex(")")+2] != "Z" # zombies are dead
+    import time
+    t0 = time.time()
+    while (is_running(pid) and time.time() - t0 < 10):
+      time.sleep(0.01)
+    assert not is_running(pid)
+    assert shell.run(command="echo 3", timeout=10).stdout_lines == ["3"]
+    assert shell.n_starts == 4
+    shell.close()
+    assert not shell.is_alive()
+    assert shell.run(command="echo 4").stdout_lines == ["4"]
+    shell.close()
+    result = go_coprocess(command="echo hello; echo world >&2")
+    assert result.stdout_lines == go(command="echo hello; echo world >&2") \
+      .stdout_lines
+    import tempfile
+    cwd = os.getcwd()
+    saved_environ = dict(os.environ)
+    tmp_dir = os.path.realpath(tempfile.mkdtemp())
+    try:
+      os.chdir(tmp_dir)
+      os.environ["EASY_RUN_COPROCESS_X"] = "a b'c"
+      os.environ.pop("HOME", None)
+      command = "pwd; echo \"$EASY_RUN_COPROCESS_X\"; echo \"${HOME-unset}\""
+      expected = go(command=command).stdout_lines
+      assert expected == [tmp_dir, "a b'c", "unset"]
+      assert go_coprocess(command=command).stdout_lines == expected
+    finally:
+      os.chdir(cwd)
+      if (os.path.isdir(tmp_dir)): os.rmdir(tmp_dir)
+      os.environ.clear()
+      os.environ.update(saved_environ)
+    assert go_coprocess(command="pwd").stdout_lines == [cwd]
+  #
   result = fb(command=["nslookup", "localhost"])
   if (verbose):
     print result.stdout_lines
@@ -0,0 +1,132 @@
+"""
+Timings for easy_run.
+
+Usage:
+  python easy_run_benchmark.py [options] [command ...]
+  python easy_run_benchmark.py --throughput [n_commands]
+
+Compares the per-call latency of short commands, run
+  shell:      with easy_run.fully_buffered as a str command, i.e. via
+              /bin/sh
+  direct:     with easy_run.fully_buffered as a sequence command, i.e.
+              without a shell under POSIX
+  coprocess:  in an easy_run.coprocess_shell (POSIX only)
+Each command argument is split at whitespace; the default commands are
+"true", "git rev-parse HEAD" (if git is available) and
+"python -c pass". Options:
+  --min-time=0.5      (seconds per measurement)
+
+--throughput runs n_commands (default 1000) "echo i" commands with
+easy_run.go and with easy_run.go_coprocess and shows commands per
+second.
+"""
+
+import os
+import sys
+import time
+
+import easy_run
+
+
+def time_per_call(function, min_time=0.5):
+  n = 1
+  while True:
+    t0 = time.time()
+    for i in xrange(n):
+      function()
+    t = time.time() - t0
+    if (t >= min_time):
+      return t / n
+    n *= 2
+
+
+def find_program(name):
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, name)
+    if (os.path.isfile(path) and os.access(path, os.X_OK)):
+      return path
+  return None
+
+
+def default_commands():
+  result = [['true']]
+  if (find_program('git') is not None):
+    result.append(['git', 'rev-parse', 'HEAD'])
+  result.append([sys.executable, '-c', 'pass'])
+  return result
+
+
+def run_modes(coprocess_shell=None):
+  "(label, function(command as list)) tuples."
+  result = [
+    ('shell', lambda command: easy_run.fully_buffered(
+      command=' '.join(command))),
+    ('direct', lambda command: easy_run.fully_buffered(
+      command=command)),
+  ]
+  if (coprocess_shell is not None):
+    result.append(('coprocess', lambda command: coprocess_shell.run(
+      command=' '.join(command))))
+  return result
+
+
+def show_latencies(commands=None, min_time=0.5, out=None):
+  if (commands is None): commands = default_commands()
+  if (out is None): out = sys.stdout
+  shell = None
+  if (os.name == 'posix'):
+    shell = easy_run.coprocess_shell()
+  try:
+    modes = run_modes(coprocess_shell=shell)
+    print >> out, 'ms per call:'
+    print >> out, '  %-40s' % 'command' \
+      + ''.join(['%10s' % label for label,function in modes])
+    for command in commands:
+      label = ' '.join(command)
+      if (len(label) > 40): label = '...' + label[-37:]
+      line = '  %-40s' % label
+      for mode_label,function in modes:
+        t = time_per_call(lambda: function(command), min_time)
+        line += '%10.2f' % (t*1e3)
+      print >> out, line
+  finally:
+    if (shell is not None):
+      shell.close()
+
+
+def show_throughput(n_commands=1000, out=None):
+  if (out is None): out = sys.stdout
+  print >> out, '%d "echo i" commands:' % n_commands
+  for label,go in [('go', easy_run.go),
+                   ('go_coprocess', easy_run.go_coprocess)]:
+    t0 = time.time()
+    for i in xrange(n_commands):
+      assert go(command='echo %d' % i).stdout_lines == [str(i)]
+    t = time.time() - t0
+    print >> out, '  %-14s %8.2f s  %8.1f commands/s' % (
+      label, t, n_commands / t)
+
+
+def run(args):
+  if (len(args) != 0 and args[0] == '--throughput'):
+    assert len(args) <= 2, '--throughput [n_commands]'
+    n_commands = 1000
+    if (len(args) == 2):
+      n_commands = int(args[1])
+    show_throughput(n_commands)
+    return 0
+  min_time = 0.5
+  commands = []
+  for arg in args:
+    if (arg.startswith('--min-time=')):
+      min_time = float(arg.split('=', 1)[1])
+    elif (arg.startswith('--')):
+      raise RuntimeError('Unknown option: %s' % arg)
+    else:
+      commands.append(arg.split())
+  show_latencies(commands or None, min_time)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(run(sys.argv[1:]))
@@ -36,9 +36,673 @@ try:
   from stdlib import random
 except ImportError:
   import random
+import array
+import operator
+try:
+  import __builtin__ as _builtins
+except ImportError:
+  import builtins as _builtins
+_builtin_sum = _builtins.sum
+
+def _builtin_real_types(elems, require_float):
+  """\
+True if all elems are int, long or float (or subclasses). If
+require_float is True, at least one element must be a float.
+"""
+  has_float = False
+  for t in set(map(type, elems)):
+    if (issubclass(t, float)):
+      has_float = True
+    elif (not issubclass(t, (int, long))):
+      return False
+  return has_float or not require_float
+
+class matrix_backend(object):
+  """\
+Base class for implementations registered with backend_registry.
+Subclasses define methods for any subset of backend_registry.operations,
+with these signatures:
+
+  mul(a, b)                  returns the elements of a * b
+  transpose_multiply(a, b)   returns the elements of a.transpose() * b
+                             (b may be None, meaning b = a)
+  determinant(m)             returns the determinant of m
+  inverse(m)                 returns the inverse of m (a rec)
+  dihedral_angle(sites, deg) see dihedral_angle()
+
+default_thresholds maps operation names to the smallest problem size for
+which the backend is used (None: never). The size is the number of
+multiply-adds for mul and transpose_multiply, the number of rows for
+determinant and inverse, and the number of sites for dihedral_angle.
+"""
+
+  name = None
+  default_thresholds = {}
+
+  def is_available(self):
+    return True
+
+  def accepts(self, operation, operands):
+    return True
+
+class _pure_backend(matrix_backend):
+  "Plain Python implementations; always available, used as fallback."
+
+  name = "pure"
+  default_thresholds = {
+    "mul": 0,
+    "transpose_multiply": 0,
+    "determinant": 0,
+    "inverse": 0,
+    "dihedral_angle": 0}
+
+  def mul(self, a, b):
+    ar, ac = a.n
+    bc = b.n[1]
+    a = a.elems
+    b = b.elems
+    result = []
+    for i in xrange(ar):
+      for k in xrange(bc):
+        s = 0
+        for j in xrange(ac):
+          s += a[i * ac + j] * b[j * bc + k]
+        result.append(s)
+    return result
+
+  def transpose_multiply(self, a, b):
+    ar, ac = a.n
+    a = a.elems
+    if (b is None):
+      result = [0] * (ac * ac)
+      jac = 0
+      for j in xrange(ar):
+        ik = 0
+        for i in xrange(ac):
+          for k in xrange(ac):
+            result[ik] += a[jac + i] * a[jac + k]
+            ik += 1
+        jac += ac
+      return result
+    bc = b.n[1]
+    b = b.elems
+    result = [0] * (ac * bc)
+    jac = 0
+    jbc = 0
+    for j in xrange(ar):
+      ik = 0
+      for i in xrange(ac):
+        for k in xrange(bc):
+          result[ik] += a[jac + i] * b[jbc + k]
+          ik += 1
+      jac += ac
+      jbc += bc
+    return result
+
+  def determinant(self, m):
+    n = m.n[0]
+    e = m.elems
+    if (n == 1):
+      return e[0]
+    if (n == 2):
+      return e[0]*e[3] - e[1]*e[2]
+    if (n == 3):
+      return   e[0] * (e[4] * e[8] - e[5] * e[7]) \
+             - e[1] * (e[3] * e[8] - e[5] * e[6]) \
+             + e[2] * (e[3] * e[7] - e[4] * e[6])
+    return determinant_via_lu(m=m)
+
+  def inverse(self, m):
+    if (m.n[0] < 4):
+      determinant = m.determinant()
+      assert determinant != 0
+      return m.co_factor_matrix_transposed() / determinant
+    return inverse_via_lu(m=m)
+
+  def dihedral_angle(self, sites, deg):
+    return _dihedral_angle(sites=sites, deg=deg)
+
+class _numpy_backend(matrix_backend):
+  """\
+numpy (BLAS/LAPACK). Products are only computed with numpy if at least
+one element is a float, to keep integer products exact.
+"""
+
+  name = "numpy"
+  default_thresholds = {
+    "mul": 4096,
+    "transpose_multiply": 4096,
+    "determinant": 10,
+    "inverse": 4}
+
+  def is_available(self):
+    return numpy_proxy() is not None
+
+  def accepts(self, operation, operands):
+    require_float = operation in ("mul", "transpose_multiply")
+    if (require_float):
+      elems = []
+      for m in operands:
+        if (m is not None): elems.extend(m.elems)
+      return _builtin_real_types(elems, require_float=True)
+    return _builtin_real_types(operands[0].elems, require_float=False)
+
+  def _as_array(self, m):
+    numpy = numpy_proxy()
+    return numpy.array(m.elems, dtype=numpy.float64).reshape(m.n)
+
+  def mul(self, a, b):
+    numpy = numpy_proxy()
+    return numpy.dot(self._as_array(a), self._as_array(b)).ravel().tolist()
+
+  def transpose_multiply(self, a, b):
+    numpy = numpy_proxy()
+    a = self._as_array(a)
+    if (b is None): b = a
+    else:           b = self._as_array(b)
+    return numpy.dot(a.transpose(), b).ravel().tolist()
+
+  def determinant(self, m):
+    numpy = numpy_proxy()
+    return float(numpy.linalg.det(self._as_array(m)))
+
+  def inverse(self, m):
+    numpy = numpy_proxy()
+    return rec(
+      elems=numpy.linalg.inv(self._as_array(m)).ravel().tolist(), n=m.n)
+
+class _flex_backend(matrix_backend):
+  "scitbx.array_family.flex (C++)."
+
+  name = "flex"
+  default_thresholds = {
+    "determinant": 4,
+    "inverse": 4,
+    "dihedral_angle": 0}
+
+  def is_available(self):
+    return flex_proxy() is not None
+
+  def accepts(self, operation, operands):
+    if (operation == "dihedral_angle"): return True
+    return _builtin_real_types(operands[0].elems, require_float=False)
+
+  def determinant(self, m):
+    flex = flex_proxy()
+    e = flex.double(m.elems)
+    e.resize(flex.grid(m.n))
+    return e.matrix_determinant_via_lu()
+
+  def inverse(self, m):
+    flex = flex_proxy()
+    e = flex.double(m.elems)
+    e.resize(flex.grid(m.n))
+    e.matrix_inversion_in_place()
+    return rec(elems=e, n=m.n)
+
+  def dihedral_angle(self, sites, deg):
+    from scitbx.math import dihedral_angle
+    return dihedral_angle(sites=sites, deg=deg)
+
+def _exact_types(elems, require_fraction):
+  """\
+True if all elems are int, long or fractions.Fraction (or subclasses).
+If require_fraction is True, at least one element must be a Fraction.
+"""
+  import fractions
+  has_fraction = False
+  for t in set(map(type, elems)):
+    if (issubclass(t, fractions.Fraction)):
+      has_fraction = True
+    elif (not issubclass(t, (int, long))):
+      return False
+  return has_fraction or not require_fraction
+
+class _exact_backend(matrix_backend):
+  """\
+Exact arithmetic for int and fractions.Fraction elements:
+fraction-free (Bareiss) elimination for the determinant, Fraction
+Gauss-Jordan elimination for the inverse. The inverse is only computed
+exactly if at least one element is a Fraction, i.e. the inverse of an
+int matrix is still a float matrix.
+"""
+
+  name = "exact"
+  default_thresholds = {
+    "determinant": 4,
+    "inverse": 4}
+
+  def accepts(self, operation, operands):
+    return _exact_types(
+      operands[0].elems, require_fraction=(operation == "inverse"))
+
+  def determinant(self, m):
+    return determinant_bareiss(m=m)
+
+  def inverse(self, m):
+    return inverse_via_fractions(m=m)
+
+def _mul_rows_via_columns(a_rows, ac, b_columns):
+  """\
+The rows of a * b for the row-major elements a_rows (with ac columns),
+given the columns of b as sequences. Module-level so that it can be
+sent to worker processes.
+"""
+  mul = operator.mul
+  result = []
+  for i in xrange(0, len(a_rows), ac):
+    a_row = a_rows[i:i+ac]
+    result.extend([_builtin_sum(map(mul, a_row, b_column))
+      for b_column in b_columns])
+  return result
+
+def _columns(m):
+  nr, nc = m.n
+  e = m.elems
+  return [tuple(e[j::nc]) for j in xrange(nc)]
+
+class _blocked_backend(matrix_backend):
+  """\
+Pure Python, but faster than the naive triple loop for all but tiny
+matrices: b is transposed once into contiguous columns, and the inner
+products are computed with sum(map(operator.mul, ...)), i.e. in C.
+The rows of a are processed in blocks of block_rows rows. Exact for
+int and Fraction elements.
+"""
+
+  name = "blocked"
+  default_thresholds = {"mul": 200}
+  block_rows = 64
+
+  def mul(self, a, b):
+    ac = a.n[1]
+    a = a.elems
+    b_columns = _columns(b)
+    result = []
+    block = self.block_rows * ac
+    for i in xrange(0, len(a), block):
+      result.extend(_mul_rows_via_columns(a[i:i+block], ac, b_columns))
+    return result
+
+def _sqr_quadrants(a, n, h):
+  "The h x h quadrants of the row-major n x n elements a (n == 2*h)."
+  a11 = []; a12 = []; a21 = []; a22 = []
+  for i in xrange(0, h*n, n):
+    a11.extend(a[i:i+h])
+    a12.extend(a[i+h:i+n])
+  for i in xrange(h*n, n*n, n):
+    a21.extend(a[i:i+h])
+    a22.extend(a[i+h:i+n])
+  return a11, a12, a21, a22
+
+def _strassen_winograd_mul(a, b, n, leaf_size):
+  """\
+Elements of the n x n product of the row-major n x n elements a and b:
+Winograd's variant of Strassen's algorithm (7 products and 15
+additions per level), using _mul_rows_via_columns for n <= leaf_size.
+Odd n are handled by dynamic peeling of the last row and column.
+"""
+  if (n <= leaf_size):
+    return _mul_rows_via_columns(a, n, [b[j::n] for j in xrange(n)])
+  add = operator.add
+  sub = operator.sub
+  mul = operator.mul
+  if (n % 2):
+    m = n - 1
+    a11 = []; b11 = []
+    for i in xrange(0, m*n, n):
+      a11.extend(a[i:i+m])
+      b11.extend(b[i:i+m])
+    a12 = a[m:m*n:n]
+    b12 = b[m:m*n:n]
+    a21 = a[m*n:n*n-1]
+    b21 = b[m*n:n*n-1]
+    a22 = a[-1]
+    b22 = b[-1]
+    c11 = _strassen_winograd_mul(a11, b11, m, leaf_size)
+    result = []
+    for i in xrange(m):
+      ai = a12[i]
+      result.extend(map(add, c11[i*m:(i+1)*m], [ai*x for x in b21]))
+      result.append(
+        _builtin_sum(map(mul, a11[i*m:(i+1)*m], b12)) + ai*b22)
+    result.extend([_builtin_sum(map(mul, a21, b11[j::m])) + a22*b21[j]
+      for j in xrange(m)])
+    result.append(_builtin_sum(map(mul, a21, b12)) + a22*b22)
+    return result
+  h = n // 2
+  a11, a12, a21, a22 = _sqr_quadrants(a, n, h)
+  b11, b12, b21, b22 = _sqr_quadrants(b, n, h)
+  s1 = map(add, a21, a22)
+  s2 = map(sub, s1, a11)
+  s3 = map(sub, a11, a21)
+  s4 = map(sub, a12, s2)
+  t1 = map(sub, b12, b11)
+  t2 = map(sub, b22, t1)
+  t3 = map(sub, b22, b12)
+  t4 = map(sub, t2, b21)
+  m1 = _strassen_winograd_mul(a11, b11, h, leaf_size)
+  m2 = _strassen_winograd_mul(a12, b21, h, leaf_size)
+  m3 = _strassen_winograd_mul(s4, b22, h, leaf_size)
+  m4 = _strassen_winograd_mul(a22, t4, h, leaf_size)
+  m5 = _strassen_winograd_mul(s1, t1, h, leaf_size)
+  m6 = _strassen_winograd_mul(s2, t2, h, leaf_size)
+  m7 = _strassen_winograd_mul(s3, t3, h, leaf_size)
+  c11 = map(add, m1, m2)
+  u2 = map(add, m1, m6)
+  u3 = map(add, u2, m7)
+  c12 = map(add, map(add, u2, m5), m3)
+  c21 = map(sub, u3, m4)
+  c22 = map(add, u3, m5)
+  result = []
+  for i in xrange(0, h*h, h):
+    result.extend(c11[i:i+h])
+    result.extend(c12[i:i+h])
+  for i in xrange(0, h*h, h):
+    result.extend(c21[i:i+h])
+    result.extend(c22[i:i+h])
+  return result
+
+class _strassen_backend(_blocked_backend):
+  """\
+Recursive Strassen-Winograd multiplication of square matrices of equal
+size, with the _blocked_backend kernel for blocks of at most leaf_size
+rows. Pure Python; about O(n**2.81) instead of O(n**3) operations.
+Exact for int and Fraction elements; for floats the error bound is
+somewhat weaker than for the classic product (Higham, Accuracy and
+Stability of Numerical Algorithms, 2002, section 23.2.2).
+
+The parallel backend is registered with a higher priority: if it is
+enabled (a mul threshold is set) and its threshold is reached, it is
+used instead of this one.
+"""
+
+  name = "strassen"
+  default_thresholds = {"mul": 8000000}
+  leaf_size = 64
+
+  def accepts(self, operation, operands):
+    a, b = operands
+    return (a.n[0] == a.n[1] and a.n == b.n)
+
+  def mul(self, a, b):
+    return _strassen_winograd_mul(
+      list(a.elems), list(b.elems), a.n[0], self.leaf_size)
+
+def _process_pool_executor_type():
+  "concurrent.futures.ProcessPoolExecutor, or None if not available."
+  try: from concurrent.futures import ProcessPoolExecutor
+  except ImportError: return None
+  return ProcessPoolExecutor
+
+class _parallel_backend(_blocked_backend):
+  """\
+_blocked_backend with the row blocks distributed over a
+concurrent.futures.ProcessPoolExecutor (created on first use and then
+reused). Only available if concurrent.futures can be imported and more
+than one worker is available; intended for very large products when
+numpy is not available (numpy is preferred for float operands).
+
+Opt-in: registered without a threshold, i.e. never selected unless a
+mul threshold is set, e.g. backends.set_threshold("mul", "parallel",
+8000000) or in the backend config file. Once enabled it takes
+precedence over the strassen backend (higher priority). The pool is
+shut down at exit (or explicitly with shutdown()).
+"""
+
+  name = "parallel"
+  default_thresholds = {"mul": None}
+
+  def __init__(self, max_workers=None):
+    self._max_workers = max_workers
+    self._executor = None
+    self._shutdown_at_exit = False
+
+  def max_workers(self):
+    if (self._max_workers is None):
+      try:
+        import multiprocessing
+        self._max_workers = multiprocessing.cpu_count()
+      except (ImportError, NotImplementedError):
+        self._max_workers = 1
+    return self._max_workers
+
+  def is_available(self):
+    return (_process_pool_executor_type() is not None
+            and self.max_workers() > 1)
+
+  def executor(self):
+    if (self._executor is None):
+      self._executor = _process_pool_executor_type()(
+        max_workers=self.max_workers())
+      if (not self._shutdown_at_exit):
+        import atexit
+        atexit.register(self.shutdown)
+        self._shutdown_at_exit = True
+    return self._executor
+
+  def shutdown(self):
+    if (self._executor is not None):
+      self._executor.shutdown()
+      self._executor = None
+
+  def mul(self, a, b):
+    ar, ac = a.n
+    a = a.elems
+    b_columns = _columns(b)
+    n_workers = self.max_workers()
+    rows_per_task = max(1, (ar + n_workers - 1) // n_workers)
+    block = rows_per_task * ac
+    executor = self.executor()
+    futures = [
+      executor.submit(_mul_rows_via_columns, a[i:i+block], ac, b_columns)
+        for i in xrange(0, len(a), block)]
+    result = []
+    for future in futures:
+      result.extend(future.result())
+    return result
+
+class backend_registry(object):
+  """\
+Selects the implementation used for each rec operation, based on
+per-operation size thresholds (crossover points). Backends are tried
+in priority order (highest first); the first one that is available,
+accepts the operands, and has a threshold <= the problem size is used.
+The "pure" backend is the fallback.
+
+Thresholds can be calibrated with scitbx_matrix_benchmark.py --calibrate
+and are stored in a JSON config file: $SCITBX_MATRIX_BACKENDS if set,
+otherwise ~/.scitbx_matrix_backends.json. The config file is loaded
+the first time an operation is dispatched.
+"""
+
+  operations = (
+    "mul", "transpose_multiply", "determinant", "inverse", "dihedral_angle")
+
+  def __init__(self):
+    self.backends = {}
+    self.priorities = []
+    self.thresholds = {}
+    self.config_file_name = None
+    self._config_loaded = False
+    self._lowest_thresholds = {}
+    self.pure = None
+
+  def register(self, backend, priority=None):
+    "Backends with higher priority are preferred."
+    assert backend.name is not None
+    if (priority is None):
+      priority = len(self.priorities)
+    self.unregister(backend.name)
+    self.backends[backend.name] = backend
+    self.priorities.append((priority, backend.name))
+    self.priorities.sort(reverse=True)
+    if (backend.name == "pure"):
+      self.pure = backend
+    self._update_lowest_thresholds()
+
+  def unregister(self, name):
+    if (name in self.backends):
+      del self.backends[name]
+      self.priorities = [(p,n) for p,n in self.priorities if n != name]
+      self._update_lowest_thresholds()
+
+  def threshold(self, operation, name):
+    t = self.thresholds.get(operation, {})
+    if (name in t):
+      return t[name]
+    return self.backends[name].default_thresholds.get(operation)
+
+  def set_threshold(self, operation, name, size):
+    "size None means: never use backend name for operation."
+    assert operation in self.operations
+    self.thresholds.setdefault(operation, {})[name] = size
+    self._update_lowest_thresholds()
+
+  def reset_thresholds(self):
+    self.thresholds = {}
+    self._update_lowest_thresholds()
+
+  def _update_lowest_thresholds(self):
+    for operation in self.operations:
+      lowest = None
+      for name in self.backends:
+        if (name == "pure"): continue
+        t = self.threshold(operation, name)
+        if (t is not None and (lowest is None or t < lowest)):
+          lowest = t
+      self._lowest_thresholds[operation] = lowest
+
+  def default_config_file_name(self):
+    import os
+    result = os.environ.get("SCITBX_MATRIX_BACKENDS")
+    if (result is None):
+      result = os.path.join(
+        os.path.expanduser("~"), ".scitbx_matrix_backends.json")
+    return result
+
+  def load_config(self, file_name=None):
+    """\
+A missing file is not an error if file_name is None. An invalid file
+raises RuntimeError; select() then tries to load it again next time.
+"""
+    import json, os
+    explicit = (file_name is not None)
+    if (not explicit):
+      file_name = self.default_config_file_name()
+      if (not os.path.isfile(file_name)):
+        self._config_loaded = True
+        return False
+    try:
+      f = open(file_name)
+      try:
+        config = json.load(f)
+      finally:
+        f.close()
+      thresholds = config["thresholds"]
+      for operation,t in thresholds.items():
+        if (operation not in self.operations):
+          raise ValueError("unknown operation: %s" % operation)
+        for name,size in t.items():
+          if (size is not None): int(size)
+    except (IOError, ValueError, KeyError, TypeError, AttributeError), e:
+      raise RuntimeError(
+        "Invalid scitbx_matrix backend config file %s: %s"
+          % (repr(file_name), str(e)))
+    self.thresholds = dict([(str(op), dict([(str(k),v) for k,v in t.items()]))
+      for op,t in thresholds.items()])
+    self.config_file_name = file_name
+    self._config_loaded = True
+    self._update_lowest_thresholds()
+    return True
+
+  def save_config(self, file_name=None):
+    import json
+    if (file_name is None):
+      file_name = self.default_config_file_name()
+    f = open(file_name, "w")
+    json.dump({"thresholds": self.thresholds}, f, indent=2, sort_keys=True)
+    f.write("\n")
+    f.close()
+    self.config_file_name = file_name
+    return file_name
+
+  def select(self, operation, size, operands):
+    if (not self._config_loaded):
+      self.load_config()
+    lowest = self._lowest_thresholds.get(operation)
+    if (lowest is None or size < lowest):
+      return self.pure
+    for priority,name in self.priorities:
+      if (name == "pure"): continue
+      backend = self.backends[name]
+      if (not hasattr(backend, operation)): continue
+      t = self.threshold(operation, name)
+      if (t is None or size < t): continue
+      if (not backend.is_available()): continue
+      if (not backend.accepts(operation, operands)): continue
+      return backend
+    return self.pure
+
+backends = backend_registry()
+backends.register(_pure_backend(), priority=0)
+backends.register(_numpy_backend(), priority=10)
+backends.register(_flex_backend(), priority=20)
+backends.register(_blocked_backend(), priority=5)
+backends.register(_strassen_backend(), priority=6)
+backends.register(_parallel_backend(), priority=7)
+backends.register(_exact_backend(), priority=30)
+
+class derived_value_cache_statistics(object):
+  "Hit and miss counts of rec.cache_derived_values(), per method name."
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.hits = {}
+    self.misses = {}
+
+  def hit_ratio(self, name=None):
+    if (name is None):
+      h = _builtin_sum(self.hits.values())
+      n = h + _builtin_sum(self.misses.values())
+    else:
+      h = self.hits.get(name, 0)
+      n = h + self.misses.get(name, 0)
+    if (n == 0): return 0
+    return h / n
+
+  def show(self, out=None, prefix=""):
+    if (out is None):
+      import sys
+      out = sys.stdout
+    names = sorted(set(self.hits.keys()) | set(self.misses.keys()))
+    for name in names:
+      print >> out, prefix + "%s: hits: %d, misses: %d (hit ratio %.3f)" % (
+        name, self.hits.get(name, 0), self.misses.get(name, 0),
+        self.hit_ratio(name))
+
+derived_value_cache = derived_value_cache_statistics()
+
+def _cached_derived_value(values, name, compute):
+  hits = derived_value_cache.hits
+  misses = derived_value_cache.misses
+  def get():
+    try:
+      result = values[name]
+    except KeyError:
+      misses[name] = misses.get(name, 0) + 1
+      result = values[name] = compute()
+    else:
+      hits[name] = hits.get(name, 0) + 1
+    return result
+  return get
 
 class rec(object):
 
+  __slots__ = ("elems", "n", "__dict__", "__weakref__")
+
   container_type = tuple
 
   def __init__(self, elems, n):
@@ -49,6 +713,52 @@ class rec(object):
     self.elems = elems
     self.n = tuple(n)
 
+  def __getstate__(self):
+    result = dict(self.__dict__)
+    for name in self._cached_derived_value_names:
+      result.pop(name, None)
+    result["elems"] = self.elems
+    result["n"] = self.n
+    return result
+
+  def __setstate__(self, state):
+    for key,value in state.items():
+      setattr(self, key, value)
+
+  _cached_derived_value_names = (
+    "determinant", "inverse", "transpose", "norm_sq", "length_sq",
+    "is_r3_rotation_matrix_rms")
+
+  def cache_derived_values(self, enable=True):
+    """\
+Opt-in memoization of determinant(), inverse(), transpose(), norm_sq()
+(also used by abs(), cos_angle() and angle(); the unrolled abs() and
+length() of vec3 do not use the cache) and is_r3_rotation_matrix_rms()
+(used by is_r3_rotation_matrix()) for this instance. Each value is
+computed on the first call and the same object is returned afterwards;
+hits and misses are counted in the module-level derived_value_cache.
+Only instances with tuple elems (i.e. not mutable_rec or typed_rec) can
+be cached. The cache is not pickled. Returns self.
+"""
+    d = self.__dict__
+    for name in self._cached_derived_value_names:
+      d.pop(name, None)
+    if (enable):
+      if (type(self.elems) is not tuple):
+        raise RuntimeError(
+          "cache_derived_values(): not available for mutable elems.")
+      values = {}
+      cls = type(self)
+      for name in self._cached_derived_value_names:
+        if (name == "length_sq"): key = "norm_sq"
+        else:                     key = name
+        d[name] = _cached_derived_value(
+          values, key, getattr(cls, key).__get__(self, cls))
+    return self
+
+  def caches_derived_values(self):
+    return "determinant" in self.__dict__
+
   def n_rows(self):
     return self.n[0]
 
@@ -72,6 +782,8 @@ class rec(object):
 
   def __mul__(self, other):
     if (not hasattr(other, "elems")):
+      if (isinstance(other, _r3_array)):
+        return NotImplemented
       if (not isinstance(other, (list, tuple))):
         return rec([x * other for x in self.elems], self.n)
       other = col(other)
@@ -88,13 +800,8 @@ class rec(object):
     if (ac == 0):
       # Roy Featherstone, Springer, New York, 2007, p. 53 footnote
       return rec((0,)*(ar*bc), (ar,bc))
-    result = []
-    for i in xrange(ar):
-      for k in xrange(bc):
-        s = 0
-        for j in xrange(ac):
-          s += a[i * ac + j] * b[j * bc + k]
-        result.append(s)
+    result = backends.select(
+      operation="mul", size=ar*ac*bc, operands=(self, other)).mul(self, other)
     if (ar == bc):
       return sqr(result)
     return rec(result, (ar, bc))
@@ -106,34 +813,17 @@ class rec(object):
     return self * other
 
   def transpose_multiply(self, other=None):
-    a = self.elems
     ar = self.n_rows()
     ac = self.n_columns()
     if (other is None):
-      result = [0] * (ac * ac)
-      jac = 0
-      for j in xrange(ar):
-        ik = 0
-        for i in xrange(ac):
-          for k in xrange(ac):
-            result[ik] += a[jac + i] * a[jac + k]
-            ik += 1
-        jac += ac
-      return sqr(result)
-    b = other.elems
-    assert other.n_rows() == ar, "Incompatible matrices."
-    bc = other.n_columns()
-    result = [0] * (ac * bc)
-    jac = 0
-    jbc = 0
-    for j in xrange(ar):
-      ik = 0
-      for i in xrange(ac):
-        for k in xrange(bc):
-          result[ik] += a[jac + i] * b[jbc + k]
-          ik += 1
-      jac += ac
-      jbc += bc
+      bc = ac
+    else:
+      assert other.n_rows() == ar, "Incompatible matrices."
+      bc = other.n_columns()
+    result = backends.select(
+      operation="transpose_multiply",
+      size=ar*ac*bc,
+      operands=(self, other)).transpose_multiply(self, other)
     if (ac == bc):
       return sqr(result)
     return rec(result, (ac, bc))
@@ -177,6 +867,10 @@ class rec(object):
     assert numpy is not None
     return numpy.array(self.elems).reshape(self.n)
 
+  def as_typed(self, typecode="d"):
+    "A typed_rec with a copy of the elements (see typed_rec)."
+    return typed_rec(array.array(typecode, self.elems), self.n)
+
   def each_abs(self):
     return rec([abs(e) for e in self.elems], self.n)
 
@@ -290,11 +984,7 @@ class rec(object):
 
   def unit_quaternion_as_r3_rotation_matrix(self):
     assert self.n in [(1,4), (4,1)]
-    q0,q1,q2,q3 = self.elems
-    return sqr((
-      2*(q0*q0+q1*q1)-1, 2*(q1*q2-q0*q3),   2*(q1*q3+q0*q2),
-      2*(q1*q2+q0*q3),   2*(q0*q0+q2*q2)-1, 2*(q2*q3-q0*q1),
-      2*(q1*q3-q0*q2),   2*(q2*q3+q0*q1),   2*(q0*q0+q3*q3)-1))
+    return sqr(_unit_quaternion_as_mat3_elems(self.elems))
 
   def r3_rotation_matrix_as_unit_quaternion(self):
     # Based on work by:
@@ -492,22 +1182,10 @@ class rec(object):
 
   def determinant(self):
     assert self.is_square()
-    m = self.elems
-    n = self.n[0]
-    if (n == 1):
-      return m[0]
-    if (n == 2):
-      return m[0]*m[3] - m[1]*m[2]
-    if (n == 3):
-      return   m[0] * (m[4] * m[8] - m[5] * m[7]) \
-             - m[1] * (m[3] * m[8] - m[5] * m[6]) \
-             + m[2] * (m[3] * m[7] - m[4] * m[6])
-    flex = flex_proxy()
-    if (flex is not None):
-      m = flex.double(m)
-      m.resize(flex.grid(self.n))
-      return m.matrix_determinant_via_lu()
-    return determinant_via_lu(m=self)
+    return backends.select(
+      operation="determinant",
+      size=self.n[0],
+      operands=(self,)).determinant(self)
 
   def co_factor_matrix_transposed(self):
     n = self.n
@@ -534,24 +1212,10 @@ class rec(object):
 
   def inverse(self):
     assert self.is_square()
-    n = self.n
-    if (n[0] < 4):
-      determinant = self.determinant()
-      assert determinant != 0
-      return self.co_factor_matrix_transposed() / determinant
-    flex = flex_proxy()
-    if (flex is not None):
-      m = flex.double(self.elems)
-      m.resize(flex.grid(n))
-      m.matrix_inversion_in_place()
-      return rec(elems=m, n=n)
-    numpy = numpy_proxy()
-    if (numpy is not None):
-      m = numpy.asarray(self.elems)
-      m.shape = n
-      m = numpy.ravel(numpy.linalg.inv(m))
-      return rec(elems=m, n=n)
-    return inverse_via_lu(m=self)
+    return backends.select(
+      operation="inverse",
+      size=self.n[0],
+      operands=(self,)).inverse(self)
 
   def transpose(self):
     elems = []
@@ -560,13 +1224,14 @@ class rec(object):
         elems.append(self(i,j))
     return rec(elems, (self.n_columns(), self.n_rows()))
 
-  def _mathematica_or_matlab_form(self,
+  def _mathematica_or_matlab_form_pieces(self,
         outer_open, outer_close,
         inner_open, inner_close, inner_close_follow,
         label,
         one_row_per_line,
         format,
         prefix):
+    "Generates the text one row at a time."
     nr = self.n_rows()
     nc = self.n_columns()
     s = prefix
@@ -574,24 +1239,44 @@ class rec(object):
     if (label):
       s += label + "="
       indent += " " * (len(label) + 1)
-    s += outer_open
+    yield s + outer_open
     if (nc != 0):
+      e = self.elems
+      if (one_row_per_line): separator = "\n" + indent + " "
+      else:                  separator = " "
       for ir in xrange(nr):
-        s += inner_open
-        for ic in xrange(nc):
-          if (format is None):
-            s += str(self(ir, ic))
-          else:
-            s += format % self(ir, ic)
-          if (ic+1 != nc): s += ", "
-          elif (ir+1 != nr or len(inner_open) != 0): s += inner_close
+        row = e[ir*nc:(ir+1)*nc]
+        if (format is None):
+          row = ", ".join([str(v) for v in row])
+        else:
+          row = ", ".join([format % v for v in row])
         if (ir+1 != nr):
-          s += inner_close_follow
-          if (one_row_per_line):
-            s += "\n"
-            s += indent
-          s += " "
-    return s + outer_close
+          yield inner_open + row + inner_close + inner_close_follow \
+              + separator
+        elif (len(inner_open) != 0):
+          yield inner_open + row + inner_close
+        else:
+          yield inner_open + row
+    yield outer_close
+
+  def _mathematica_or_matlab_form(self, **keyword_args):
+    return "".join(self._mathematica_or_matlab_form_pieces(**keyword_args))
+
+  def _mathematica_form_pieces(self,
+        label,
+        one_row_per_line,
+        format,
+        prefix,
+        matrix_form):
+    for s in self._mathematica_or_matlab_form_pieces(
+          outer_open="{", outer_close="}",
+          inner_open="{", inner_close="}", inner_close_follow=",",
+          label=label,
+          one_row_per_line=one_row_per_line,
+          format=format,
+          prefix=prefix):
+      yield s.replace('e', '*^')
+    if matrix_form: yield "//MatrixForm"
 
   def mathematica_form(self,
         label="",
@@ -599,16 +1284,36 @@ class rec(object):
         format=None,
         prefix="",
         matrix_form=False):
-    result = self._mathematica_or_matlab_form(
-      outer_open="{", outer_close="}",
-      inner_open="{", inner_close="}", inner_close_follow=",",
+    return "".join(self._mathematica_form_pieces(
       label=label,
       one_row_per_line=one_row_per_line,
       format=format,
-      prefix=prefix)
-    if matrix_form: result += "//MatrixForm"
-    result = result.replace('e', '*^')
-    return result
+      prefix=prefix,
+      matrix_form=matrix_form))
+
+  def write_mathematica_form(self,
+        f,
+        label="",
+        one_row_per_line=False,
+        format=None,
+        prefix="",
+        matrix_form=False):
+    """\
+Writes mathematica_form() to the file object f row by row, without
+building the whole string (no trailing newline is written).
+"""
+    for s in self._mathematica_form_pieces(
+          label=label,
+          one_row_per_line=one_row_per_line,
+          format=format,
+          prefix=prefix,
+          matrix_form=matrix_form):
+      f.write(s)
+
+  def _matlab_form_keyword_args(self):
+    return dict(
+      outer_open="[", outer_close="]",
+      inner_open="", inner_close=";", inner_close_follow="")
 
   def matlab_form(self,
         label="",
@@ -616,12 +1321,26 @@ class rec(object):
         format=None,
         prefix=""):
     return self._mathematica_or_matlab_form(
-      outer_open="[", outer_close="]",
-      inner_open="", inner_close=";", inner_close_follow="",
       label=label,
       one_row_per_line=one_row_per_line,
       format=format,
-      prefix=prefix)
+      prefix=prefix,
+      **self._matlab_form_keyword_args())
+
+  def write_matlab_form(self,
+        f,
+        label="",
+        one_row_per_line=False,
+        format=None,
+        prefix=""):
+    "Writes matlab_form() to the file object f row by row."
+    for s in self._mathematica_or_matlab_form_pieces(
+          label=label,
+          one_row_per_line=one_row_per_line,
+          format=format,
+          prefix=prefix,
+          **self._matlab_form_keyword_args()):
+      f.write(s)
 
   def __repr__(self):
     n0, n1 = self.n
@@ -683,7 +1402,11 @@ class rec(object):
     if self is other: return True
     if other is None: return False
     if issubclass(type(other), rec):
-      return self.elems == other.elems
+      a = self.elems
+      b = other.elems
+      if (type(a) is type(b) and isinstance(a, (tuple, list))):
+        return a == b
+      return len(a) == len(b) and tuple(a) == tuple(b)
     for ir in xrange(self.n_rows()):
       for ic in xrange(self.n_columns()):
         if self(ir,ic) != other[ir,ic]: return False
@@ -733,35 +1456,416 @@ class mutable_rec(rec):
   def __setitem__(self, i, x):
     self.elems[i] = x
 
-class row_mixin(object):
-
-  def __init__(self, elems):
-    super(row_mixin, self).__init__(elems, (1, len(elems)))
+  def __iadd__(self, other):
+    return add_into(self, self, other)
 
-class row(row_mixin, rec): pass
-class mutable_row(row_mixin, mutable_rec): pass
+  def __isub__(self, other):
+    return sub_into(self, self, other)
 
-class col_mixin(object):
+  def __imul__(self, other):
+    "Scalar, or square matrix with n == (self.n[1], self.n[1])."
+    return mul_into(self, self, other)
 
-  def __init__(self, elems):
-    super(col_mixin, self).__init__(elems, (len(elems), 1))
+class typed_rec(rec):
+  """\
+rec with compact typed storage: elems is an array.array (by default
+with typecode "d", or e.g. "l" for integers) or a numpy array, i.e.
+8 bytes per element instead of a tuple of Python objects (about 32
+bytes per element). as_numpy_array() returns a view of the same memory
+without a copy. Other objects supporting the buffer protocol (e.g.
+bytearray) are interpreted as raw typecode elements, zero-copy if
+numpy is available. Any other sequence is copied into a new array.
 
-  def random(cls, n, a, b):
-    uniform = random.uniform
-    return cls([ uniform(a,b) for i in xrange(n) ])
-  random = classmethod(random)
+All rec operations work unchanged; their results are ordinary
+(tuple-based) rec.
+"""
 
-class col(col_mixin, rec): pass
-class mutable_col(col_mixin, mutable_rec): pass
+  def __init__(self, elems, n, typecode="d"):
+    assert len(n) == 2
+    numpy = numpy_proxy()
+    if (isinstance(elems, array.array)):
+      pass
+    elif (numpy is not None and isinstance(elems, numpy.ndarray)):
+      elems = elems.reshape(-1)
+    else:
+      try: memoryview(elems)
+      except (NameError, TypeError):
+        elems = array.array(typecode, elems)
+      else:
+        if (numpy is not None):
+          elems = numpy.frombuffer(elems, dtype=typecode)
+        else:
+          elems = array.array(typecode, bytes(elems))
+    assert len(elems) == n[0] * n[1]
+    self.elems = elems
+    self.n = tuple(n)
+
+  def as_numpy_array(self):
+    "A numpy view of elems (no copy)."
+    numpy = numpy_proxy()
+    assert numpy is not None
+    e = self.elems
+    if (isinstance(e, array.array)):
+      e = numpy.frombuffer(e, dtype=e.typecode)
+    return e.reshape(self.n)
+
+_npy_magic = b"\x93NUMPY"
+
+def _int64_typecode():
+  for typecode in ("l", "q"):
+    try:
+      if (array.array(typecode).itemsize == 8): return typecode
+    except ValueError:
+      pass
+  raise RuntimeError("no 8-byte integer array typecode.")
+
+def _npy_header(descr, shape):
+  header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (
+    descr, shape[0], shape[1])
+  # magic (6) + version (2) + header length (2) + header + "\n" is
+  # padded to a multiple of 64 bytes, as numpy does.
+  n_pad = 63 - (10 + len(header)) % 64
+  header += " " * n_pad + "\n"
+  import struct
+  return _npy_magic + b"\x01\x00" + struct.pack("<H", len(header)) \
+    + header.encode("latin1")
+
+def save_npy(m, file_name_or_object):
+  """\
+Writes the matrix m (rec or any object with .elems and .n) in the numpy
+.npy format (version 1.0): float64 ("<f8") elements, or int64 ("<i8")
+if all elements are integers. The file can be read with numpy.load()
+or load_npy().
+"""
+  import sys
+  e = m.elems
+  if (hasattr(e, "typecode")):
+    is_float = (e.typecode in "fd")
+  elif (hasattr(e, "dtype")):
+    is_float = (e.dtype.kind not in "iub")
+  else:
+    is_float = False
+    for v in e:
+      if (not isinstance(v, (int, long))):
+        is_float = True
+        break
+  if (is_float): typecode = "d"
+  else:          typecode = _int64_typecode()
+  try:
+    data = array.array(typecode, e)
+  except (TypeError, OverflowError):
+    if (typecode == "d"):
+      raise RuntimeError("save_npy: unsupported element type.")
+    raise RuntimeError("save_npy: integer out of int64 range.")
+  if (sys.byteorder == "big"): data.byteswap()
+  header = _npy_header(typecode == "d" and "<f8" or "<i8", m.n)
+  if (hasattr(file_name_or_object, "write")):
+    f = file_name_or_object
+    f.write(header)
+    f.write(data.tostring())
+  else:
+    f = open(file_name_or_object, "wb")
+    try:
+      f.write(header)
+      data.tofile(f)
+    finally:
+      f.close()
+
+def _npy_read_header(f):
+  "Returns (descr, fortran_order, shape, header_size)."
+  import ast, struct
+  magic = f.read(8)
+  if (len(magic) != 8 or magic[:6] != _npy_magic):
+    raise RuntimeError("load_npy: not a .npy file.")
+  major = ord(magic[6:7])
+  if (major == 1):
+    header_size, = struct.unpack("<H", f.read(2))
+    offset = 10
+  elif (major in (2, 3)):
+    header_size, = struct.unpack("<I", f.read(4))
+    offset = 12
+  else:
+    raise RuntimeError("load_npy: unsupported .npy version %d." % major)
+  header = ast.literal_eval(f.read(header_size).decode("latin1"))
+  return (
+    header["descr"], header["fortran_order"], tuple(header["shape"]),
+    offset + header_size)
+
+_npy_typecodes = {
+  "<f8": "d", ">f8": "d", "<i8": "q", ">i8": "q", "<f4": "f", ">f4": "f"}
+
+def load_npy(file_name_or_object, memory_map=None,
+      memory_map_min_bytes=1<<26):
+  """\
+Reads a 2-dimensional (or 1-dimensional, returned as a column) .npy
+file of float64, float32 or int64 elements as a typed_rec.
+
+With memory_map=True (or memory_map=None for files of at least
+memory_map_min_bytes) and numpy available, the elements are a
+read-only numpy.memmap of the file: nothing is read until elements are
+accessed. Otherwise the elements are read into an array.array.
+"""
+  import sys
+  if (hasattr(file_name_or_object, "read")):
+    f = file_name_or_object
+    close = False
+    memory_map = False
+  else:
+    f = open(file_name_or_object, "rb")
+    close = True
+  try:
+    descr, fortran_order, shape, header_size = _npy_read_header(f)
+    typecode = _npy_typecodes.get(descr)
+    if (typecode is None):
+      raise RuntimeError("load_npy: unsupported dtype %s." % descr)
+    if (typecode == "q"): typecode = _int64_typecode()
+    if (len(shape) == 1): shape = (shape[0], 1)
+    if (len(shape) != 2):
+      raise RuntimeError("load_npy: not a matrix (shape %s)." % str(shape))
+    size = shape[0] * shape[1]
+    numpy = numpy_proxy()
+    if (memory_map is None):
+      memory_map = (size * 8 >= memory_map_min_bytes)
+    if (memory_map and numpy is not None and size != 0):
+      elems = numpy.memmap(
+        file_name_or_object,
+        dtype=numpy.dtype(descr),
+        mode="r",
+        offset=header_size,
+        shape=(size,))
+    else:
+      elems = array.array(typecode)
+      elems.fromstring(f.read(size * elems.itemsize))
+      if (len(elems) != size):
+        raise RuntimeError("load_npy: file too short.")
+      if ((descr[0] == ">") != (sys.byteorder == "big")):
+        elems.byteswap()
+  finally:
+    if (close): f.close()
+  if (fortran_order):
+    nr, nc = shape
+    elems = array.array(typecode,
+      [elems[ic*nr+ir] for ir in xrange(nr) for ic in xrange(nc)])
+  return typed_rec(elems, shape)
+
+class row_mixin(object):
+
+  __slots__ = ()
+
+  def __init__(self, elems):
+    super(row_mixin, self).__init__(elems, (1, len(elems)))
+
+class row(row_mixin, rec): pass
+class mutable_row(row_mixin, mutable_rec): pass
+
+class col_mixin(object):
+
+  __slots__ = ()
+
+  def __init__(self, elems):
+    super(col_mixin, self).__init__(elems, (len(elems), 1))
+
+  def random(cls, n, a, b):
+    uniform = random.uniform
+    return cls([ uniform(a,b) for i in xrange(n) ])
+  random = classmethod(random)
+
+class col(col_mixin, rec):
+
+  def __new__(cls, elems=None):
+    "col((x,y,z)) returns a vec3 instance."
+    if (cls is col and elems is not None and len(elems) == 3):
+      return object.__new__(vec3)
+    return object.__new__(cls)
+
+class mutable_col(col_mixin, mutable_rec): pass
 
 class sqr(rec):
 
+  def __new__(cls, elems=None):
+    "sqr() with 9 elements returns a mat3 instance."
+    if (cls is sqr and elems is not None and len(elems) == 9):
+      return object.__new__(mat3)
+    return object.__new__(cls)
+
   def __init__(self, elems):
     l = len(elems)
     n = int(l**(.5) + 0.5)
     assert l == n * n
     rec.__init__(self, elems, (n,n))
 
+_scalar_types = (int, long, float)
+
+def _vec3_from_tuple(elems):
+  result = object.__new__(vec3)
+  result.elems = elems
+  result.n = (3,1)
+  return result
+
+def _mat3_from_tuple(elems):
+  result = object.__new__(mat3)
+  result.elems = elems
+  result.n = (3,3)
+  return result
+
+class vec3(col):
+  """\
+Fast path for 3-vectors: fully unrolled versions of the most frequently
+used rec methods. Instances are created automatically by col((x,y,z)).
+Operations involving other shapes or non-builtin scalars fall back to
+the generic rec implementations.
+"""
+
+  __slots__ = ()
+
+  def __init__(self, elems):
+    if (type(elems) is not tuple):
+      elems = tuple(elems)
+    assert len(elems) == 3
+    self.elems = elems
+    self.n = (3,1)
+
+  def __neg__(self):
+    a0,a1,a2 = self.elems
+    return _vec3_from_tuple((-a0, -a1, -a2))
+
+  def __add__(self, other):
+    if (other.n != (3,1)): return rec.__add__(self, other)
+    a0,a1,a2 = self.elems
+    b0,b1,b2 = other.elems
+    return _vec3_from_tuple((a0+b0, a1+b1, a2+b2))
+
+  def __sub__(self, other):
+    if (other.n != (3,1)): return rec.__sub__(self, other)
+    a0,a1,a2 = self.elems
+    b0,b1,b2 = other.elems
+    return _vec3_from_tuple((a0-b0, a1-b1, a2-b2))
+
+  def __mul__(self, other):
+    if (not isinstance(other, _scalar_types)):
+      return rec.__mul__(self, other)
+    a0,a1,a2 = self.elems
+    return _vec3_from_tuple((a0*other, a1*other, a2*other))
+
+  def __truediv__(self, other):
+    if (not isinstance(other, _scalar_types)):
+      return rec.__truediv__(self, other)
+    a0,a1,a2 = self.elems
+    return _vec3_from_tuple((a0/other, a1/other, a2/other))
+
+  __div__ = __truediv__
+
+  def norm_sq(self):
+    a0,a1,a2 = self.elems
+    return a0*a0 + a1*a1 + a2*a2
+
+  length_sq = norm_sq
+
+  def __abs__(self):
+    a0,a1,a2 = self.elems
+    return math.sqrt(a0*a0 + a1*a1 + a2*a2)
+
+  length = __abs__
+
+  def dot(self, other=None):
+    a0,a1,a2 = self.elems
+    if (other is None):
+      return a0*a0 + a1*a1 + a2*a2
+    b = other.elems
+    assert len(b) == 3
+    return a0*b[0] + a1*b[1] + a2*b[2]
+
+  def cross(self, other):
+    assert other.n == (3,1)
+    a0,a1,a2 = self.elems
+    b0,b1,b2 = other.elems
+    return _vec3_from_tuple((a1*b2 - b1*a2, a2*b0 - b2*a0, a0*b1 - b0*a1))
+
+class mat3(sqr):
+  """\
+Fast path for 3x3 matrices: fully unrolled versions of the most
+frequently used rec methods. Instances are created automatically by
+sqr() with 9 elements (and therefore also by rec.__mul__ and rt).
+"""
+
+  __slots__ = ()
+
+  def __init__(self, elems):
+    if (type(elems) is not tuple):
+      elems = tuple(elems)
+    assert len(elems) == 9
+    self.elems = elems
+    self.n = (3,3)
+
+  def __neg__(self):
+    return _mat3_from_tuple(tuple([-e for e in self.elems]))
+
+  def __add__(self, other):
+    if (other.n != (3,3)): return rec.__add__(self, other)
+    a0,a1,a2,a3,a4,a5,a6,a7,a8 = self.elems
+    b0,b1,b2,b3,b4,b5,b6,b7,b8 = other.elems
+    return _mat3_from_tuple((
+      a0+b0, a1+b1, a2+b2, a3+b3, a4+b4, a5+b5, a6+b6, a7+b7, a8+b8))
+
+  def __sub__(self, other):
+    if (other.n != (3,3)): return rec.__sub__(self, other)
+    a0,a1,a2,a3,a4,a5,a6,a7,a8 = self.elems
+    b0,b1,b2,b3,b4,b5,b6,b7,b8 = other.elems
+    return _mat3_from_tuple((
+      a0-b0, a1-b1, a2-b2, a3-b3, a4-b4, a5-b5, a6-b6, a7-b7, a8-b8))
+
+  def __mul__(self, other):
+    if (isinstance(other, rec)):
+      n = other.n
+      if (n == (3,1)):
+        a0,a1,a2,a3,a4,a5,a6,a7,a8 = self.elems
+        v0,v1,v2 = other.elems
+        return _vec3_from_tuple((
+          a0*v0 + a1*v1 + a2*v2,
+          a3*v0 + a4*v1 + a5*v2,
+          a6*v0 + a7*v1 + a8*v2))
+      if (n == (3,3)):
+        a0,a1,a2,a3,a4,a5,a6,a7,a8 = self.elems
+        b0,b1,b2,b3,b4,b5,b6,b7,b8 = other.elems
+        return _mat3_from_tuple((
+          a0*b0 + a1*b3 + a2*b6, a0*b1 + a1*b4 + a2*b7, a0*b2 + a1*b5 + a2*b8,
+          a3*b0 + a4*b3 + a5*b6, a3*b1 + a4*b4 + a5*b7, a3*b2 + a4*b5 + a5*b8,
+          a6*b0 + a7*b3 + a8*b6, a6*b1 + a7*b4 + a8*b7, a6*b2 + a7*b5 + a8*b8))
+    elif (isinstance(other, _scalar_types)):
+      return _mat3_from_tuple(tuple([e*other for e in self.elems]))
+    return rec.__mul__(self, other)
+
+  def transpose(self):
+    m0,m1,m2,m3,m4,m5,m6,m7,m8 = self.elems
+    return _mat3_from_tuple((m0,m3,m6,m1,m4,m7,m2,m5,m8))
+
+  def trace(self):
+    m = self.elems
+    return m[0] + m[4] + m[8]
+
+  def determinant(self):
+    m0,m1,m2,m3,m4,m5,m6,m7,m8 = self.elems
+    return   m0 * (m4 * m8 - m5 * m7) \
+           - m1 * (m3 * m8 - m5 * m6) \
+           + m2 * (m3 * m7 - m4 * m6)
+
+  def inverse(self):
+    m0,m1,m2,m3,m4,m5,m6,m7,m8 = self.elems
+    d =   m0 * (m4 * m8 - m5 * m7) \
+        - m1 * (m3 * m8 - m5 * m6) \
+        + m2 * (m3 * m7 - m4 * m6)
+    assert d != 0
+    return _mat3_from_tuple((
+       (m4 * m8 - m5 * m7) / d,
+      (-m1 * m8 + m2 * m7) / d,
+       (m1 * m5 - m2 * m4) / d,
+      (-m3 * m8 + m5 * m6) / d,
+       (m0 * m8 - m2 * m6) / d,
+      (-m0 * m5 + m2 * m3) / d,
+       (m3 * m7 - m4 * m6) / d,
+      (-m0 * m7 + m1 * m6) / d,
+       (m0 * m4 - m1 * m3) / d))
+
 class diag(rec):
 
   def __init__(self, diag_elems):
@@ -782,15 +1886,45 @@ class inversion(diag):
     super(inversion, self).__init__((-1,)*n)
 
 class sym(rec):
+  """\
+Symmetric square matrix. Constructed from a sym_mat3
+(m00,m11,m22,m01,m02,m12) or from the n*n elems of a full matrix,
+of which only the upper triangle is used.
+"""
 
   def __init__(self, elems=None, sym_mat3=None):
-    assert elems is None, "Not implemented."
+    if (elems is not None):
+      assert sym_mat3 is None
+      n = int(math.sqrt(len(elems)) + 0.5)
+      assert n*n == len(elems)
+      e = list(elems)
+      for i in xrange(n):
+        for j in xrange(i+1, n):
+          e[j*n+i] = e[i*n+j]
+      rec.__init__(self, e, (n,n))
+      return
     assert len(sym_mat3) == 6
     m = sym_mat3
     rec.__init__(self, (m[0], m[3], m[4],
                         m[3], m[1], m[5],
                         m[4], m[5], m[2]), (3,3))
 
+  def packed_u(self):
+    "Upper triangle (including the diagonal) in packed row storage."
+    n = self.n[0]
+    e = self.elems
+    result = []
+    for i in xrange(n):
+      result.extend(e[i*n+i:(i+1)*n])
+    return result
+
+  def cholesky_factorization(self, raise_if_not_positive_definite=True):
+    return cholesky_factorization(m=self,
+      raise_if_not_positive_definite=raise_if_not_positive_definite)
+
+  def eigensystem(self):
+    return real_symmetric_eigensystem(m=self)
+
 def zeros(n, mutable=False):
   if mutable:
     col_t, rec_t = mutable_col, mutable_rec
@@ -804,13 +1938,83 @@ def zeros(n, mutable=False):
 def mutable_zeros(n):
   return zeros(n, mutable=True)
 
+def add_into(out, a, b):
+  """\
+out = a + b, written into the existing elements of out (a mutable_rec,
+which may also be a or b). Returns out.
+"""
+  assert a.n == b.n
+  assert out.n == a.n
+  o = out.elems
+  ae = a.elems
+  be = b.elems
+  for i in xrange(len(o)):
+    o[i] = ae[i] + be[i]
+  return out
+
+def sub_into(out, a, b):
+  "out = a - b (see add_into)."
+  assert a.n == b.n
+  assert out.n == a.n
+  o = out.elems
+  ae = a.elems
+  be = b.elems
+  for i in xrange(len(o)):
+    o[i] = ae[i] - be[i]
+  return out
+
+def mul_into(out, a, b):
+  """\
+out = a * b, with b a matrix or a scalar, written into the existing
+elements of out (see add_into). out may be a; if out is b, a copy of b
+is used.
+"""
+  o = out.elems
+  ae = a.elems
+  if (not hasattr(b, "elems")):
+    assert out.n == a.n
+    for i in xrange(len(o)):
+      o[i] = ae[i] * b
+    return out
+  ar, ac = a.n
+  bc = b.n[1]
+  assert b.n[0] == ac
+  assert out.n == (ar, bc)
+  be = b.elems
+  if (be is o): be = list(be)
+  row = [0] * bc
+  for i in xrange(ar):
+    iac = i * ac
+    for k in xrange(bc):
+      s = 0
+      for j in xrange(ac):
+        s += ae[iac + j] * be[j * bc + k]
+      row[k] = s
+    o[i*bc:(i+1)*bc] = row
+  return out
+
 def sum(iterable):
-  """ The sum of the given sequence of matrices """
+  """\
+The sum of the given sequence of matrices. The sum is accumulated in
+place, i.e. without a temporary matrix per element. For a sequence of
+numbers the result is the same as for the builtin sum.
+"""
   sequence = iter(iterable)
   result = sequence.next()
+  if (not isinstance(result, rec)):
+    for m in sequence:
+      result += m
+    return result
+  accumulator = None
   for m in sequence:
-    result += m
-  return result
+    if (accumulator is None):
+      accumulator = mutable_rec(list(result.elems), result.n)
+    accumulator += m
+  if (accumulator is None):
+    return result
+  if (isinstance(result, vec3)): return col(accumulator.elems)
+  if (isinstance(result, mat3)): return sqr(accumulator.elems)
+  return rec(accumulator.elems, result.n)
 
 def cross_product_matrix((v0, v1, v2)):
   """\
@@ -861,11 +2065,115 @@ def _dihedral_angle(sites, deg):
   return result
 
 def dihedral_angle(sites, deg=False):
-  flex = flex_proxy()
-  if (flex is None):
-    return _dihedral_angle(sites=sites, deg=deg)
-  from scitbx.math import dihedral_angle
-  return dihedral_angle(sites=sites, deg=deg)
+  return backends.select(
+    operation="dihedral_angle",
+    size=len(sites),
+    operands=sites).dihedral_angle(sites=sites, deg=deg)
+
+def _dihedral_angles_flat(xyz, quadruples, deg):
+  "xyz: flat array.array('d'); returns array.array('d') (nan: undefined)."
+  nan = float("nan")
+  atan2 = math.atan2
+  sqrt = math.sqrt
+  if (deg): factor = 180/math.pi
+  else:     factor = 1
+  result = array.array("d")
+  append = result.append
+  for i0,i1,i2,i3 in quadruples:
+    i0 *= 3; i1 *= 3; i2 *= 3; i3 *= 3
+    x1 = xyz[i1]; y1 = xyz[i1+1]; z1 = xyz[i1+2]
+    x2 = xyz[i2]; y2 = xyz[i2+1]; z2 = xyz[i2+2]
+    ax = xyz[i0]-x1; ay = xyz[i0+1]-y1; az = xyz[i0+2]-z1
+    bx = x2-x1; by = y2-y1; bz = z2-z1
+    cx = x2-xyz[i3]; cy = y2-xyz[i3+1]; cz = z2-xyz[i3+2]
+    nx = ay*bz-az*by; ny = az*bx-ax*bz; nz = ax*by-ay*bx
+    mx = by*cz-bz*cy; my = bz*cx-bx*cz; mz = bx*cy-by*cx
+    if (nx*nx+ny*ny+nz*nz == 0 or mx*mx+my*my+mz*mz == 0):
+      append(nan)
+      continue
+    y = (bx*(ny*mz-nz*my) + by*(nz*mx-nx*mz) + bz*(nx*my-ny*mx)) \
+      / sqrt(bx*bx+by*by+bz*bz)
+    append(atan2(y, nx*mx+ny*my+nz*mz) * factor)
+  return result
+
+def _dihedral_angles_numpy(xyz, quadruples, deg):
+  "xyz: numpy array (..., N, 3); quadruples: int array (M, 4)."
+  numpy = numpy_proxy()
+  p = xyz[..., quadruples, :]
+  a = p[...,0,:] - p[...,1,:]
+  b = p[...,2,:] - p[...,1,:]
+  c = p[...,2,:] - p[...,3,:]
+  n = numpy.cross(a, b)
+  m = numpy.cross(b, c)
+  saved = numpy.seterr(invalid="ignore", divide="ignore")
+  try:
+    y = (b * numpy.cross(n, m)).sum(axis=-1) \
+      / numpy.sqrt((b * b).sum(axis=-1))
+    result = numpy.arctan2(y, (n * m).sum(axis=-1))
+  finally:
+    numpy.seterr(**saved)
+  undefined = ((n * n).sum(axis=-1) == 0) | ((m * m).sum(axis=-1) == 0)
+  result[undefined] = numpy.nan
+  if (deg): result *= 180/math.pi
+  return result
+
+def dihedral_angles(sites, quadruples=None, deg=False, use_numpy=None):
+  """\
+Vectorized dihedral_angle() for many quadruples of sites.
+
+sites: N sites in any form accepted by superpose() (numpy (N,3) array,
+flat array.array("d"), vec3_array, sequence of triples), or, with
+numpy, a stack of frames (e.g. a trajectory) as an array with shape
+(n_frames, N, 3).
+
+quadruples: M x 4 table of site indices (sequence of 4-tuples or numpy
+integer array); None means consecutive groups of four sites.
+
+Returns a numpy array (shape (M,) or (n_frames, M)) or, without numpy,
+an array.array("d"). Undefined angles (collinear sites) are nan, where
+dihedral_angle() returns None. Signs agree with dihedral_angle().
+"""
+  if (use_numpy is None):
+    use_numpy = (numpy_proxy() is not None)
+  if (use_numpy):
+    numpy = numpy_proxy()
+    assert numpy is not None
+    if (isinstance(sites, numpy.ndarray) and sites.ndim == 3):
+      xyz = numpy.asarray(sites, dtype=numpy.float64)
+    else:
+      xyz = _sites_as_xyz(sites, use_numpy=True)
+    if (quadruples is None):
+      n = xyz.shape[-2]
+      assert n % 4 == 0
+      quadruples = numpy.arange(n).reshape((n//4, 4))
+    else:
+      quadruples = numpy.asarray(quadruples, dtype=int).reshape((-1, 4))
+    return _dihedral_angles_numpy(xyz, quadruples, deg)
+  xyz = _sites_as_xyz(sites, use_numpy=False)
+  if (quadruples is None):
+    n = len(xyz) // 3
+    assert n % 4 == 0
+    quadruples = [(i, i+1, i+2, i+3) for i in xrange(0, n, 4)]
+  return _dihedral_angles_flat(xyz, quadruples, deg)
+
+def dihedral_angles_over_frames(frames, quadruples, deg=False,
+      use_numpy=None):
+  """\
+Dihedral angles for the same quadruples in each of a sequence of
+frames (coordinate sets of the same N sites). Returns a numpy array
+with shape (n_frames, M) or, without numpy, a list of array.array("d").
+"""
+  if (use_numpy is None):
+    use_numpy = (numpy_proxy() is not None)
+  if (use_numpy):
+    numpy = numpy_proxy()
+    if (not isinstance(frames, numpy.ndarray)):
+      frames = numpy.array([_sites_as_xyz(frame, use_numpy=True)
+        for frame in frames])
+    return dihedral_angles(frames, quadruples, deg=deg, use_numpy=True)
+  quadruples = [tuple(q) for q in quadruples]
+  return [_dihedral_angles_flat(_sites_as_xyz(frame, use_numpy=False),
+    quadruples, deg) for frame in frames]
 
 def __rotate_point_around_axis(
       axis_point_1,
@@ -926,6 +2234,94 @@ def rotate_point_around_axis(
   z_new = xma*m7 + yma*m8 + zma*m9 + za
   return (x_new,y_new,z_new)
 
+def _r3_transform_points(r, t, points, in_place, pivot=None):
+  """\
+Computes r * p + t (or r * (p - pivot) + pivot if pivot is given) for
+all points p in one pass. points may be a numpy array with shape
+(N,3), a flat array.array("d") with 3*N elements, or a vec3_array.
+The result has the same type as points. If in_place is True, points
+is overwritten and returned.
+"""
+  if (isinstance(points, vec3_array)):
+    result = _r3_transform_points(r, t, points.data, in_place, pivot)
+    if (in_place): return points
+    return points._new(result)
+  m0,m1,m2,m3,m4,m5,m6,m7,m8 = r
+  if (isinstance(points, array.array)):
+    assert points.typecode == "d"
+    assert len(points) % 3 == 0
+    if (in_place): result = points
+    else:          result = array.array("d", points)
+    if (pivot is None):
+      t0,t1,t2 = t
+      for i in xrange(0, len(result), 3):
+        x = result[i]
+        y = result[i+1]
+        z = result[i+2]
+        result[i]   = m0*x + m1*y + m2*z + t0
+        result[i+1] = m3*x + m4*y + m5*z + t1
+        result[i+2] = m6*x + m7*y + m8*z + t2
+    else:
+      xa,ya,za = pivot
+      for i in xrange(0, len(result), 3):
+        x = result[i] - xa
+        y = result[i+1] - ya
+        z = result[i+2] - za
+        result[i]   = x*m0 + y*m1 + z*m2 + xa
+        result[i+1] = x*m3 + y*m4 + z*m5 + ya
+        result[i+2] = x*m6 + y*m7 + z*m8 + za
+    return result
+  numpy = numpy_proxy()
+  if (numpy is None or not isinstance(points, numpy.ndarray)):
+    raise TypeError(
+      "points must be a numpy array, an array.array or a vec3_array: %s"
+        % repr(points))
+  assert points.shape[-1] == 3
+  rt_ = numpy.array(r, dtype=numpy.float64).reshape((3,3)).transpose()
+  if (pivot is None):
+    result = numpy.dot(points, rt_)
+    result += t
+  else:
+    result = numpy.dot(points - pivot, rt_)
+    result += pivot
+  if (in_place):
+    points[...] = result
+    return points
+  return result
+
+def rotate_points_around_axis(
+      axis_point_1,
+      axis_point_2,
+      points,
+      angle,
+      deg=False,
+      in_place=False):
+  """\
+Vectorized rotate_point_around_axis(): the rotation is computed once
+and applied to all points (see _r3_transform_points for the supported
+types of points).
+"""
+  if (deg): angle *= math.pi/180.
+  xa,ya,za = axis_point_1
+  xb,yb,zb = axis_point_2
+  xl,yl,zl = xb-xa,yb-ya,zb-za
+  xlsq = xl**2
+  ylsq = yl**2
+  zlsq = zl**2
+  dlsq = xlsq + ylsq + zlsq
+  dl = dlsq**0.5
+  ca = math.cos(angle)
+  dsa = math.sin(angle)/dl
+  oca = (1-ca)/dlsq
+  xlylo = xl*yl*oca
+  xlzlo = xl*zl*oca
+  ylzlo = yl*zl*oca
+  r = (xlsq*oca+ca, xlylo-zl*dsa, xlzlo+yl*dsa,
+       xlylo+zl*dsa, ylsq*oca+ca, ylzlo-xl*dsa,
+       xlzlo-yl*dsa, ylzlo+xl*dsa, zlsq*oca+ca)
+  return _r3_transform_points(
+    r=r, t=None, points=points, in_place=in_place, pivot=(xa,ya,za))
+
 class rt(object):
 
   def __init__(self, tuple_r_t):
@@ -951,56 +2347,994 @@ class rt(object):
     else:
       return rt((self.r, self.t - other))
 
-  def __mul__(self, other):
-    if (isinstance(other, rt)):
-      return rt((self.r * other.r, self.r * other.t + self.t))
-    if (isinstance(other, rec)):
-      if (other.n == self.r.n):
-        return rt((self.r * other, self.t))
-      if (other.n == self.t.n):
-        return self.r * other + self.t
-      raise ValueError(
-        "cannot multiply %s by %s: incompatible number of rows or columns"
-          % (repr(self), repr(other)))
-    n = len(self.t.elems)
-    if (isinstance(other, (list, tuple))):
-      if (len(other) == n):
-        return self.r * col(other) + self.t
-      if (len(other) == n*n):
-        return rt((self.r * sqr(other), self.t))
-      raise ValueError(
-        "cannot multiply %s by %s: incompatible number of elements"
-          % (repr(self), repr(other)))
-    if (n == 3):
-      flex = flex_proxy()
-      if (flex is not None and isinstance(other, flex.vec3_double)):
-        return self.r.elems * other + self.t.elems
-    raise TypeError("cannot multiply %s by %s" % (repr(self), repr(other)))
+  def __mul__(self, other):
+    if (isinstance(other, rt)):
+      return rt((self.r * other.r, self.r * other.t + self.t))
+    if (isinstance(other, rec)):
+      if (other.n == self.r.n):
+        return rt((self.r * other, self.t))
+      if (other.n == self.t.n):
+        return self.r * other + self.t
+      raise ValueError(
+        "cannot multiply %s by %s: incompatible number of rows or columns"
+          % (repr(self), repr(other)))
+    n = len(self.t.elems)
+    if (isinstance(other, (list, tuple))):
+      if (len(other) == n):
+        return self.r * col(other) + self.t
+      if (len(other) == n*n):
+        return rt((self.r * sqr(other), self.t))
+      raise ValueError(
+        "cannot multiply %s by %s: incompatible number of elements"
+          % (repr(self), repr(other)))
+    if (n == 3):
+      if (isinstance(other, vec3_array)):
+        return self.apply_to_points(other)
+      flex = flex_proxy()
+      if (flex is not None and isinstance(other, flex.vec3_double)):
+        return self.r.elems * other + self.t.elems
+    raise TypeError("cannot multiply %s by %s" % (repr(self), repr(other)))
+
+  def apply_to_points(self, points, in_place=False):
+    """\
+r * p + t for all points p of a numpy array with shape (N,3), a flat
+array.array("d"), or a vec3_array, in one pass.
+"""
+    assert self.r.n == (3,3)
+    return _r3_transform_points(
+      r=self.r.elems, t=self.t.elems, points=points, in_place=in_place)
+
+  def inverse(self):
+    r_inv = self.r.inverse()
+    return rt((r_inv, -(r_inv*self.t)))
+
+  def inverse_assuming_orthogonal_r(self):
+    r_inv = self.r.transpose()
+    return rt((r_inv, -(r_inv*self.t)))
+
+  def as_float(self):
+    return rt((self.r.as_float(), self.t.as_float()))
+
+  def as_augmented_matrix(self):
+    assert self.r.n_rows() == self.r.n_columns()
+    n = self.r.n_rows()
+    result = []
+    for i_row in xrange(n):
+      result.extend(self.r.elems[i_row*n:(i_row+1)*n])
+      result.append(self.t[i_row])
+    result.extend([0]*n)
+    result.append(1)
+    return rec(result, (n+1,n+1))
+
+def col_list(seq): return [col(elem) for elem in seq]
+def row_list(seq): return [row(elem) for elem in seq]
+
+# The _mat3_*_elems and _vec3_*_elems functions below work with plain
+# numbers and equally with numpy column arrays (one column per element),
+# which is how vec3_array and mat3_array vectorize them.
+
+def _mat3_transpose_elems(m):
+  m0,m1,m2,m3,m4,m5,m6,m7,m8 = m
+  return (m0,m3,m6,m1,m4,m7,m2,m5,m8)
+
+def _mat3_determinant_elems(m):
+  m0,m1,m2,m3,m4,m5,m6,m7,m8 = m
+  return   m0 * (m4 * m8 - m5 * m7) \
+         - m1 * (m3 * m8 - m5 * m6) \
+         + m2 * (m3 * m7 - m4 * m6)
+
+def _mat3_inverse_elems(m):
+  m0,m1,m2,m3,m4,m5,m6,m7,m8 = m
+  d = _mat3_determinant_elems(m)
+  return (
+     (m4 * m8 - m5 * m7) / d,
+    (-m1 * m8 + m2 * m7) / d,
+     (m1 * m5 - m2 * m4) / d,
+    (-m3 * m8 + m5 * m6) / d,
+     (m0 * m8 - m2 * m6) / d,
+    (-m0 * m5 + m2 * m3) / d,
+     (m3 * m7 - m4 * m6) / d,
+    (-m0 * m7 + m1 * m6) / d,
+     (m0 * m4 - m1 * m3) / d)
+
+def _mat3_product_elems(a, b):
+  a0,a1,a2,a3,a4,a5,a6,a7,a8 = a
+  b0,b1,b2,b3,b4,b5,b6,b7,b8 = b
+  return (
+    a0*b0 + a1*b3 + a2*b6, a0*b1 + a1*b4 + a2*b7, a0*b2 + a1*b5 + a2*b8,
+    a3*b0 + a4*b3 + a5*b6, a3*b1 + a4*b4 + a5*b7, a3*b2 + a4*b5 + a5*b8,
+    a6*b0 + a7*b3 + a8*b6, a6*b1 + a7*b4 + a8*b7, a6*b2 + a7*b5 + a8*b8)
+
+def _mat3_vec3_product_elems(a, v):
+  a0,a1,a2,a3,a4,a5,a6,a7,a8 = a
+  v0,v1,v2 = v
+  return (
+    a0*v0 + a1*v1 + a2*v2,
+    a3*v0 + a4*v1 + a5*v2,
+    a6*v0 + a7*v1 + a8*v2)
+
+def _vec3_dot_elems(a, b):
+  return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def _vec3_cross_elems(a, b):
+  a0,a1,a2 = a
+  b0,b1,b2 = b
+  return (a1*b2 - b1*a2, a2*b0 - b2*a0, a0*b1 - b0*a1)
+
+def _sym_mat3_as_mat3_elems(m):
+  m0,m1,m2,m3,m4,m5 = m
+  return (m0,m3,m4,m3,m1,m5,m4,m5,m2)
+
+def _sym_mat3_trace_elems(m):
+  return m[0] + m[1] + m[2]
+
+def _sym_mat3_determinant_elems(m):
+  m0,m1,m2,m3,m4,m5 = m
+  return m0*(m1*m2 - m5*m5) - m3*(m3*m2 - m5*m4) + m4*(m3*m5 - m1*m4)
+
+def _sym_mat3_inverse_elems(m):
+  m0,m1,m2,m3,m4,m5 = m
+  c0 = m1*m2 - m5*m5
+  c3 = m4*m5 - m3*m2
+  c4 = m3*m5 - m1*m4
+  d = m0*c0 + m3*c3 + m4*c4
+  return (c0/d, (m0*m2 - m4*m4)/d, (m0*m1 - m3*m3)/d,
+          c3/d, c4/d, (m3*m4 - m0*m5)/d)
+
+def _sym_mat3_transform_elems(r, m):
+  "r * m * r.transpose() for a mat3 r and a sym_mat3 m"
+  r0,r1,r2,r3,r4,r5,r6,r7,r8 = r
+  m0,m1,m2,m3,m4,m5 = m
+  t0 = r0*m0 + r1*m3 + r2*m4
+  t1 = r0*m3 + r1*m1 + r2*m5
+  t2 = r0*m4 + r1*m5 + r2*m2
+  t3 = r3*m0 + r4*m3 + r5*m4
+  t4 = r3*m3 + r4*m1 + r5*m5
+  t5 = r3*m4 + r4*m5 + r5*m2
+  t6 = r6*m0 + r7*m3 + r8*m4
+  t7 = r6*m3 + r7*m1 + r8*m5
+  t8 = r6*m4 + r7*m5 + r8*m2
+  return (t0*r0 + t1*r1 + t2*r2,
+          t3*r3 + t4*r4 + t5*r5,
+          t6*r6 + t7*r7 + t8*r8,
+          t0*r3 + t1*r4 + t2*r5,
+          t0*r6 + t1*r7 + t2*r8,
+          t3*r6 + t4*r7 + t5*r8)
+
+def _unit_quaternion_as_mat3_elems(q):
+  q0,q1,q2,q3 = q
+  return (
+    2*(q0*q0+q1*q1)-1, 2*(q1*q2-q0*q3),   2*(q1*q3+q0*q2),
+    2*(q1*q2+q0*q3),   2*(q0*q0+q2*q2)-1, 2*(q2*q3-q0*q1),
+    2*(q1*q3-q0*q2),   2*(q2*q3+q0*q1),   2*(q0*q0+q3*q3)-1)
+
+class _r3_array(object):
+  """\
+Common base of vec3_array, mat3_array and sym_mat3_array: a stack of
+fixed-width items in one contiguous float64 buffer, either a numpy
+array with shape (size, width) or a flat array.array("d") (if numpy
+is not available or use_numpy=False). data is used without a copy if
+it already has the required type.
+"""
+
+  width = None
+  item_type = None
+  item_type_n = None
+  item_shape = None
+
+  def __init__(self, data=(), use_numpy=None):
+    if (use_numpy is None):
+      use_numpy = (numpy_proxy() is not None)
+    if (use_numpy):
+      numpy = numpy_proxy()
+      assert numpy is not None
+      data = numpy.ascontiguousarray(data, dtype=numpy.float64)
+      assert data.size % self.width == 0
+      data = data.reshape((data.size // self.width, self.width))
+    else:
+      if (not isinstance(data, array.array) or data.typecode != "d"):
+        data = array.array("d", data)
+      assert len(data) % self.width == 0
+    self.data = data
+
+  def from_recs(cls, recs, use_numpy=None):
+    if (use_numpy is None):
+      use_numpy = (numpy_proxy() is not None)
+    n = cls.item_type_n
+    if (use_numpy):
+      numpy = numpy_proxy()
+      assert numpy is not None
+      for r in recs: assert r.n == n
+      return cls(
+        numpy.array([r.elems for r in recs], dtype=numpy.float64),
+        use_numpy=True)
+    data = array.array("d")
+    for r in recs:
+      assert r.n == n
+      data.extend(r.elems)
+    return cls(data, use_numpy=False)
+  from_recs = classmethod(from_recs)
+
+  def uses_numpy(self):
+    return not isinstance(self.data, array.array)
+
+  def __len__(self):
+    if (self.uses_numpy()):
+      return self.data.shape[0]
+    return len(self.data) // self.width
+
+  def size(self):
+    return len(self)
+
+  def __getitem__(self, i):
+    n = len(self)
+    if (i < 0): i += n
+    if (not 0 <= i < n): raise IndexError("%s index out of range" %
+      self.__class__.__name__)
+    if (self.uses_numpy()):
+      return self.item_type(self.data[i].tolist())
+    w = self.width
+    return self.item_type(self.data[i*w:(i+1)*w])
+
+  def as_recs(self):
+    if (self.uses_numpy()):
+      return [self.item_type(e) for e in self.data.tolist()]
+    d = self.data
+    w = self.width
+    return [self.item_type(d[i:i+w]) for i in xrange(0, len(d), w)]
+
+  def as_numpy_array(self):
+    numpy = numpy_proxy()
+    assert numpy is not None
+    if (self.uses_numpy()):
+      return self.data.reshape((-1,) + self.item_shape)
+    return numpy.frombuffer(self.data, dtype=numpy.float64).reshape(
+      (-1,) + self.item_shape)
+
+  def _new(self, data, result_type=None):
+    if (result_type is None): result_type = self.__class__
+    result = result_type.__new__(result_type)
+    result.data = data
+    return result
+
+  def _operand_data(self, other):
+    "Data of other converted to the storage type of self."
+    if (self.uses_numpy()):
+      if (other.uses_numpy()): return other.data
+      numpy = numpy_proxy()
+      return numpy.frombuffer(other.data, dtype=numpy.float64).reshape(
+        (-1, other.width))
+    if (other.uses_numpy()): return array.array("d", other.data.ravel())
+    return other.data
+
+  def _apply(self, function, other=None, result_type=None, swap=False):
+    """\
+Evaluates function(item_self, item_other) for all items. other may be
+an array of the same size, a rec (broadcast), or None. result_type None
+means function returns a scalar.
+"""
+    if (isinstance(other, _r3_array)):
+      assert len(other) == len(self), "array sizes differ"
+      other_data = self._operand_data(other)
+      other_width = other.width
+    elif (other is not None):
+      other_data = None
+      other_elems = tuple(other.elems)
+    if (self.uses_numpy()):
+      numpy = numpy_proxy()
+      d = self.data
+      args = [[d[:,i] for i in xrange(self.width)]]
+      if (other is not None):
+        if (other_data is None):
+          args.append(other_elems)
+        else:
+          args.append([other_data[:,i] for i in xrange(other_width)])
+      if (swap): args.reverse()
+      result = function(*args)
+      if (result_type is None):
+        return numpy.asarray(result, dtype=numpy.float64)
+      return self._new(numpy.column_stack(result), result_type)
+    d = self.data
+    w = self.width
+    result = array.array("d")
+    if (result_type is None):
+      store = result.append
+    else:
+      store = result.extend
+    if (other is None):
+      for i in xrange(0, len(d), w):
+        store(function(d[i:i+w]))
+    elif (other_data is None):
+      if (swap):
+        for i in xrange(0, len(d), w):
+          store(function(other_elems, d[i:i+w]))
+      else:
+        for i in xrange(0, len(d), w):
+          store(function(d[i:i+w], other_elems))
+    else:
+      ow = other_width
+      j = 0
+      if (swap):
+        for i in xrange(0, len(d), w):
+          store(function(other_data[j:j+ow], d[i:i+w]))
+          j += ow
+      else:
+        for i in xrange(0, len(d), w):
+          store(function(d[i:i+w], other_data[j:j+ow]))
+          j += ow
+    if (result_type is None):
+      return result
+    return self._new(result, result_type)
+
+  def _scaled(self, factor):
+    if (self.uses_numpy()):
+      return self._new(self.data * factor)
+    return self._new(array.array("d", [e * factor for e in self.data]))
+
+class vec3_array(_r3_array):
+  """\
+Stack of N 3-vectors (see _r3_array). Vectorized equivalent of a list
+of col((x,y,z)).
+"""
+
+  width = 3
+  item_type = col
+  item_type_n = (3,1)
+  item_shape = (3,)
+
+  def __neg__(self):
+    return self._scaled(-1)
+
+  def __add__(self, other):
+    return self._apply(
+      lambda a, b: (a[0]+b[0], a[1]+b[1], a[2]+b[2]), other, vec3_array)
+
+  def __sub__(self, other):
+    return self._apply(
+      lambda a, b: (a[0]-b[0], a[1]-b[1], a[2]-b[2]), other, vec3_array)
+
+  def __mul__(self, other):
+    "vec3_array * scalar"
+    return self._scaled(other)
+
+  def __rmul__(self, other):
+    "sqr * vec3_array or scalar * vec3_array"
+    if (isinstance(other, rec)):
+      assert other.n == (3,3)
+      return self._apply(_mat3_vec3_product_elems, other, vec3_array,
+        swap=True)
+    return self._scaled(other)
+
+  def dot(self, other=None):
+    if (other is None): other = self
+    return self._apply(_vec3_dot_elems, other)
+
+  def cross(self, other):
+    return self._apply(_vec3_cross_elems, other, vec3_array)
+
+class mat3_array(_r3_array):
+  """\
+Stack of N 3x3 matrices (see _r3_array). Vectorized equivalent of a
+list of sqr((m00,m01,m02,m10,m11,m12,m20,m21,m22)).
+"""
+
+  width = 9
+  item_type = sqr
+  item_type_n = (3,3)
+  item_shape = (3,3)
+
+  def __mul__(self, other):
+    """\
+mat3_array * mat3_array, mat3_array * vec3_array (pairwise),
+mat3_array * sqr, mat3_array * col (broadcast), or mat3_array * scalar.
+"""
+    if (isinstance(other, mat3_array)):
+      return self._apply(_mat3_product_elems, other, mat3_array)
+    if (isinstance(other, vec3_array)):
+      return self._apply(_mat3_vec3_product_elems, other, vec3_array)
+    if (isinstance(other, rec)):
+      if (other.n == (3,3)):
+        return self._apply(_mat3_product_elems, other, mat3_array)
+      if (other.n == (3,1)):
+        return self._apply(_mat3_vec3_product_elems, other, vec3_array)
+      raise RuntimeError(
+        "Incompatible matrices:\n"
+        "  self.n:  (3,3)\n"
+        "  other.n: %s" % str(other.n))
+    return self._scaled(other)
+
+  def __rmul__(self, other):
+    "sqr * mat3_array or scalar * mat3_array"
+    if (isinstance(other, rec)):
+      assert other.n == (3,3)
+      return self._apply(_mat3_product_elems, other, mat3_array, swap=True)
+    return self._scaled(other)
+
+  def transpose(self):
+    if (self.uses_numpy()):
+      numpy = numpy_proxy()
+      return self._new(numpy.ascontiguousarray(
+        self.data[:, (0,3,6,1,4,7,2,5,8)]))
+    return self._apply(_mat3_transpose_elems, None, mat3_array)
+
+  def determinant(self):
+    return self._apply(_mat3_determinant_elems)
+
+  def inverse(self):
+    if (0 in self.determinant()):
+      raise RuntimeError("mat3_array.inverse(): singular matrix.")
+    return self._apply(_mat3_inverse_elems, None, mat3_array)
+
+def _sym_from_sym_mat3(elems):
+  return sym(sym_mat3=elems)
+
+class sym_mat3_array(_r3_array):
+  """\
+Stack of N symmetric 3x3 matrices (e.g. anisotropic displacement
+tensors) in packed sym_mat3 storage (m00,m11,m22,m01,m02,m12), i.e.
+6 instead of 9 elements per matrix (see _r3_array).
+"""
+
+  width = 6
+  item_type = staticmethod(_sym_from_sym_mat3)
+  item_type_n = (3,3)
+  item_shape = (6,)
+
+  def from_recs(cls, recs, use_numpy=None):
+    "recs are symmetric 3x3 rec (only the symmetric part is used)."
+    sym_mat3s = []
+    for r in recs:
+      sym_mat3s.extend(r.as_sym_mat3())
+    return cls(sym_mat3s, use_numpy=use_numpy)
+  from_recs = classmethod(from_recs)
+
+  def __neg__(self):
+    return self._scaled(-1)
+
+  def __add__(self, other):
+    return self._apply(
+      lambda a, b: tuple([a[i]+b[i] for i in xrange(6)]),
+      other, sym_mat3_array)
+
+  def __sub__(self, other):
+    return self._apply(
+      lambda a, b: tuple([a[i]-b[i] for i in xrange(6)]),
+      other, sym_mat3_array)
+
+  def __mul__(self, other):
+    "sym_mat3_array * scalar"
+    return self._scaled(other)
+
+  __rmul__ = __mul__
+
+  def as_mat3_array(self):
+    return self._apply(_sym_mat3_as_mat3_elems, None, mat3_array)
+
+  def trace(self):
+    return self._apply(_sym_mat3_trace_elems)
+
+  def determinant(self):
+    return self._apply(_sym_mat3_determinant_elems)
+
+  def inverse(self):
+    if (0 in self.determinant()):
+      raise RuntimeError("sym_mat3_array.inverse(): singular matrix.")
+    return self._apply(_sym_mat3_inverse_elems, None, sym_mat3_array)
+
+  def transform(self, r):
+    """\
+r * u * r.transpose() for each u, with r a sqr (broadcast) or a
+mat3_array (pairwise), e.g. to rotate displacement tensors.
+"""
+    if (isinstance(r, rec)):
+      assert r.n == (3,3)
+    else:
+      assert isinstance(r, mat3_array)
+    return self._apply(_sym_mat3_transform_elems, r, sym_mat3_array,
+      swap=True)
+
+def axis_and_angles_as_r3_rotation_matrices(
+      axis, angles, deg=False, use_numpy=None):
+  """\
+Rotation matrices for all angles around one axis (same result as
+col(axis).axis_and_angle_as_r3_rotation_matrix() for each angle),
+computed in one vectorized pass. Returns a mat3_array.
+"""
+  if (use_numpy is None):
+    use_numpy = (numpy_proxy() is not None)
+  u,v,w = col(axis).normalize().elems
+  if (use_numpy):
+    numpy = numpy_proxy()
+    assert numpy is not None
+    h = numpy.asarray(angles, dtype=numpy.float64)
+    if (deg): h = h * (math.pi/180)
+    h = h * 0.5
+    s = numpy.sin(h)
+    q = (numpy.cos(h), u*s, v*s, w*s)
+    return mat3_array(numpy.column_stack(_unit_quaternion_as_mat3_elems(q)),
+      use_numpy=True)
+  data = array.array("d")
+  for angle in angles:
+    if (deg): angle *= math.pi/180
+    h = angle * 0.5
+    s = math.sin(h)
+    data.extend(_unit_quaternion_as_mat3_elems((math.cos(h), u*s, v*s, w*s)))
+  return mat3_array(data, use_numpy=False)
+
+class rotation_matrix_cache(object):
+  """\
+Opt-in memoizing factory for rotations given as axis and angle, e.g.
+for torsion scans that reuse a small set of discretized axes and
+angles. Keys are the normalized axis and the angle (radians, modulo
+2*pi) rounded to multiples of resolution; inputs that differ by less
+than that share one entry, which holds the result computed for the
+first of them. At most max_size results are kept; the least recently
+used one is dropped first.
+"""
+
+  def __init__(self, max_size=1024, resolution=1.e-9):
+    import collections
+    assert max_size > 0
+    self.max_size = max_size
+    self.resolution = resolution
+    self._cache = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def _lookup(self, key, compute):
+    cache = self._cache
+    result = cache.pop(key, None)
+    if (result is not None):
+      self.hits += 1
+    else:
+      self.misses += 1
+      result = compute()
+      if (len(cache) >= self.max_size):
+        cache.popitem(last=False)
+    cache[key] = result
+    return result
+
+  def _axis_angle_key(self, kind, axis, angle, deg):
+    if (deg): angle *= math.pi/180
+    r = self.resolution
+    x,y,z = col(axis).normalize().elems
+    if (kind == "q"): period = 4*math.pi # q(angle+2*pi) == -q(angle)
+    else:             period = 2*math.pi
+    return (kind, int(round(x/r)), int(round(y/r)), int(round(z/r)),
+      int(round((angle % period)/r)))
+
+  def axis_and_angle_as_r3_rotation_matrix(self, axis, angle, deg=False):
+    return self._lookup(
+      self._axis_angle_key("r", axis, angle, deg),
+      lambda: col(axis).axis_and_angle_as_r3_rotation_matrix(
+        angle=angle, deg=deg))
+
+  def axis_and_angle_as_unit_quaternion(self, axis, angle, deg=False):
+    return self._lookup(
+      self._axis_angle_key("q", axis, angle, deg),
+      lambda: col(axis).axis_and_angle_as_unit_quaternion(
+        angle=angle, deg=deg))
+
+  def unit_quaternion_as_r3_rotation_matrix(self, q):
+    r = self.resolution
+    q = col(getattr(q, "elems", q))
+    key = ("uq",) + tuple([int(round(e/r)) for e in q.elems])
+    return self._lookup(key, q.unit_quaternion_as_r3_rotation_matrix)
+
+  def axis_and_angles_as_r3_rotation_matrices(
+        self, axis, angles, deg=False, use_numpy=None):
+    "Not cached; see the module-level function."
+    return axis_and_angles_as_r3_rotation_matrices(
+      axis=axis, angles=angles, deg=deg, use_numpy=use_numpy)
+
+  def size(self):
+    return len(self._cache)
+
+  def clear(self):
+    self._cache.clear()
+    self.hits = 0
+    self.misses = 0
+
+  def show_statistics(self, out=None, prefix=""):
+    if (out is None):
+      import sys
+      out = sys.stdout
+    n = self.hits + self.misses
+    if (n == 0): ratio = 0
+    else:        ratio = self.hits / n
+    print >> out, prefix + "rotation_matrix_cache: hits: %d, misses: %d" \
+      " (hit ratio %.3f), size: %d of %d" % (
+        self.hits, self.misses, ratio, len(self._cache), self.max_size)
+
+def _horn_quaternion_matrix_elems(s):
+  """\
+The symmetric 4x4 matrix of Horn (1987), J. Opt. Soc. Am. A, 4, 629-642,
+for the covariance s[3*a+b] = sum(other_a * reference_b) of centered
+sites. The eigenvector of its largest eigenvalue is the unit quaternion
+of the rotation that best superposes other onto reference.
+"""
+  sxx,sxy,sxz,syx,syy,syz,szx,szy,szz = s
+  return (sxx+syy+szz, syz-szy,     szx-sxz,     sxy-syx,
+          syz-szy,     sxx-syy-szz, sxy+syx,     szx+sxz,
+          szx-sxz,     sxy+syx,     syy-sxx-szz, syz+szy,
+          sxy-syx,     szx+sxz,     syz+szy,     szz-sxx-syy)
+
+def _sites_as_xyz(sites, use_numpy):
+  """\
+sites may be a vec3_array, a numpy array with shape (N,3), a flat
+array.array("d"), or a sequence of 3-tuples or col. Returns a numpy
+array (N,3) or a flat array.array("d"), without a copy if possible.
+"""
+  if (isinstance(sites, vec3_array)):
+    sites = sites.data
+  if (use_numpy):
+    numpy = numpy_proxy()
+    if (not isinstance(sites, (numpy.ndarray, array.array))):
+      sites = [getattr(site, "elems", site) for site in sites]
+    return numpy.asarray(sites, dtype=numpy.float64).reshape((-1,3))
+  if (isinstance(sites, array.array) and sites.typecode == "d"):
+    return sites
+  numpy = numpy_proxy()
+  if (numpy is not None and isinstance(sites, numpy.ndarray)):
+    return array.array("d", sites.ravel())
+  result = array.array("d")
+  for site in sites:
+    result.extend(getattr(site, "elems", site))
+  return result
+
+class superposition_engine(object):
+  """\
+Least-squares superposition (rotation and translation, no scaling) of
+one or many coordinate sets ("other", e.g. models of an ensemble) onto
+one reference, using the quaternion eigenvalue method (Horn 1987).
+
+The centered reference and its sum of squares are computed once. With
+numpy the covariance matrices are accumulated with numpy.dot into work
+buffers allocated once per engine, and fit_many() solves all 4x4
+eigenproblems in one numpy.linalg.eigh call. Without numpy flat
+array.array loops and jacobi_eigensystem_in_place() are used.
+"""
+
+  def __init__(self, reference_sites, use_numpy=None):
+    if (use_numpy is None):
+      use_numpy = (numpy_proxy() is not None)
+    self.use_numpy = use_numpy
+    reference = _sites_as_xyz(reference_sites, use_numpy)
+    if (use_numpy):
+      numpy = numpy_proxy()
+      n = reference.shape[0]
+      assert n > 0
+      center = reference.mean(axis=0)
+      self.reference_center = tuple(center.tolist())
+      self._reference = reference - center
+      self._reference_ss = float(numpy.vdot(self._reference, self._reference))
+      self._centered = numpy.empty((n,3))
+      self._covariance = numpy.empty((3,3))
+    else:
+      n = len(reference) // 3
+      assert n > 0
+      c = [0., 0., 0.]
+      for i in xrange(0, 3*n, 3):
+        c[0] += reference[i]
+        c[1] += reference[i+1]
+        c[2] += reference[i+2]
+      c = [v / n for v in c]
+      self.reference_center = tuple(c)
+      self._reference = array.array("d", reference)
+      ss = 0.
+      for i in xrange(3*n):
+        v = self._reference[i] - c[i % 3]
+        self._reference[i] = v
+        ss += v * v
+      self._reference_ss = ss
+    self.n_sites = n
+
+  def _covariance_numpy(self, other):
+    "Returns (center of other, covariance elems, sum of squares)."
+    numpy = numpy_proxy()
+    assert other.shape == self._centered.shape, "numbers of sites differ"
+    center = other.mean(axis=0)
+    numpy.subtract(other, center, out=self._centered)
+    numpy.dot(self._centered.transpose(), self._reference,
+      out=self._covariance)
+    return (center, self._covariance.ravel(),
+      float(numpy.vdot(self._centered, self._centered)))
+
+  def _covariance_flat(self, other):
+    n = self.n_sites
+    assert len(other) == 3*n, "numbers of sites differ"
+    cx = cy = cz = 0.
+    for i in xrange(0, 3*n, 3):
+      cx += other[i]
+      cy += other[i+1]
+      cz += other[i+2]
+    cx /= n
+    cy /= n
+    cz /= n
+    r = self._reference
+    s = [0.] * 9
+    ss = 0.
+    for i in xrange(0, 3*n, 3):
+      x = other[i] - cx
+      y = other[i+1] - cy
+      z = other[i+2] - cz
+      rx = r[i]
+      ry = r[i+1]
+      rz = r[i+2]
+      s[0] += x*rx; s[1] += x*ry; s[2] += x*rz
+      s[3] += y*rx; s[4] += y*ry; s[5] += y*rz
+      s[6] += z*rx; s[7] += z*ry; s[8] += z*rz
+      ss += x*x + y*y + z*z
+    return (cx,cy,cz), s, ss
+
+  def _result(self, center, q, eigenvalue, other_ss):
+    r = sqr(_unit_quaternion_as_mat3_elems(q))
+    t = col(self.reference_center) - r * col(center)
+    msd = (other_ss + self._reference_ss - 2 * eigenvalue) / self.n_sites
+    return rt((r, t)), math.sqrt(max(0., msd))
+
+  def fit(self, other_sites):
+    """\
+Returns (rt, rmsd): rt * other_site is the superposed other_site, rmsd
+the root-mean-square deviation after superposition.
+"""
+    other = _sites_as_xyz(other_sites, self.use_numpy)
+    if (self.use_numpy):
+      numpy = numpy_proxy()
+      center, s, other_ss = self._covariance_numpy(other)
+      values, vectors = numpy.linalg.eigh(numpy.array(
+        _horn_quaternion_matrix_elems(s)).reshape((4,4)))
+      return self._result(
+        center.tolist(), vectors[:,3].tolist(), float(values[3]), other_ss)
+    center, s, other_ss = self._covariance_flat(other)
+    a = list(_horn_quaternion_matrix_elems(s))
+    v = jacobi_eigensystem_in_place(a=a, n=4)
+    i = max(xrange(4), key=lambda i: a[i*5])
+    return self._result(center, v[i::4], a[i*5], other_ss)
+
+  def fit_many(self, models):
+    """\
+models is a sequence of coordinate sets (any type accepted by fit()),
+or a numpy array with shape (n_models, n_sites, 3).
+Returns (list of rt, list of rmsd).
+"""
+    if (not self.use_numpy):
+      rts = []
+      rmsds = []
+      for other in models:
+        r, rmsd = self.fit(other)
+        rts.append(r)
+        rmsds.append(rmsd)
+      return rts, rmsds
+    numpy = numpy_proxy()
+    n_models = len(models)
+    if (n_models == 0): return [], []
+    centers = numpy.empty((n_models,3))
+    horn = numpy.empty((n_models,16))
+    other_ss = numpy.empty(n_models)
+    for i,other in enumerate(models):
+      other = _sites_as_xyz(other, True)
+      centers[i], s, other_ss[i] = self._covariance_numpy(other)
+      horn[i] = _horn_quaternion_matrix_elems(s)
+    values, vectors = numpy.linalg.eigh(horn.reshape((n_models,4,4)))
+    q = vectors[:,:,3]
+    rotations = numpy.column_stack(_unit_quaternion_as_mat3_elems(
+      (q[:,0], q[:,1], q[:,2], q[:,3])))
+    translations = numpy.array(self.reference_center) - numpy.einsum(
+      "mij,mj->mi", rotations.reshape((n_models,3,3)), centers)
+    msds = (other_ss + self._reference_ss - 2 * values[:,3]) / self.n_sites
+    rmsds = numpy.sqrt(numpy.maximum(msds, 0))
+    return ([rt((sqr(r), col(t))) for r,t in zip(
+              rotations.tolist(), translations.tolist())],
+            rmsds.tolist())
+
+def superpose(reference_sites, other_sites, use_numpy=None):
+  """\
+Least-squares superposition of other_sites onto reference_sites (see
+superposition_engine). Returns (rt, rmsd).
+"""
+  return superposition_engine(
+    reference_sites=reference_sites, use_numpy=use_numpy).fit(other_sites)
+
+def matrix_chain_order(dims):
+  """\
+Optimal parenthesization of the product of len(dims)-1 matrices, the
+i-th with shape (dims[i], dims[i+1]) (classic O(k^3) dynamic
+programming). Returns (number of multiply-adds, split table); split[i][j]
+is the index after which the product of matrices i..j is split.
+"""
+  k = len(dims) - 1
+  cost = [[0] * k for i in xrange(k)]
+  split = [[0] * k for i in xrange(k)]
+  for length in xrange(2, k+1):
+    for i in xrange(k - length + 1):
+      j = i + length - 1
+      best = None
+      for s in xrange(i, j):
+        c = cost[i][s] + cost[s+1][j] + dims[i] * dims[s+1] * dims[j+1]
+        if (best is None or c < best):
+          best = c
+          split[i][j] = s
+      cost[i][j] = best
+  if (k == 0): return 0, split
+  return cost[0][k-1], split
+
+class lazy(object):
+  """\
+Opt-in lazy evaluation of matrix expressions:
+
+  e = lazy(r) * (lazy(point) - pivot) + pivot
+  e.eval()     # or e[i], e(ir, ic), e.elems
+
+Operators (+, -, unary -, * with rec, lazy or scalars) only build an
+expression tree. Evaluation (once; the result is cached) fuses all sums,
+differences and scalar factors of a subexpression into one pass over
+the elements and computes chains of matrix products in the cheapest
+order (matrix_chain_order()), without intermediate tuples or rec.
+Operations with a plain rec as the left operand are evaluated
+immediately (via the elems attribute).
+"""
+
+  def __init__(self, m, op="leaf", args=(), n=None):
+    if (op == "leaf"):
+      assert isinstance(m, rec)
+      n = m.n
+    self.m = m
+    self.op = op
+    self.args = args
+    self.n = n
+    self._value = None
+
+  def _node(self, other):
+    if (isinstance(other, lazy)): return other
+    if (isinstance(other, rec)): return lazy(other)
+    if (isinstance(other, (list, tuple))): return lazy(col(other))
+    return None
+
+  def _binary(self, op, a, b):
+    if (a.n != b.n):
+      raise RuntimeError(
+        "Incompatible matrices:\n"
+        "  self.n:  %s\n"
+        "  other.n: %s" % (str(a.n), str(b.n)))
+    return lazy(None, op, (a, b), a.n)
+
+  def __add__(self, other):
+    return self._binary("add", self, self._node(other))
+
+  def __radd__(self, other):
+    return self._binary("add", self._node(other), self)
+
+  def __sub__(self, other):
+    return self._binary("sub", self, self._node(other))
+
+  def __rsub__(self, other):
+    return self._binary("sub", self._node(other), self)
+
+  def __neg__(self):
+    return lazy(None, "scale", (self, -1), self.n)
+
+  def __mul__(self, other):
+    node = self._node(other)
+    if (node is None):
+      return lazy(None, "scale", (self, other), self.n)
+    return self._product(self, node)
+
+  def __rmul__(self, other):
+    node = self._node(other)
+    if (node is None):
+      return lazy(None, "scale", (self, other), self.n)
+    return self._product(node, self)
+
+  def _product(self, a, b):
+    if (a.n[1] != b.n[0]):
+      raise RuntimeError(
+        "Incompatible matrices:\n"
+        "  self.n:  %s\n"
+        "  other.n: %s" % (str(a.n), str(b.n)))
+    return lazy(None, "mul", (a, b), (a.n[0], b.n[1]))
+
+  def n_rows(self):
+    return self.n[0]
+
+  def n_columns(self):
+    return self.n[1]
+
+  def eval(self):
+    if (self._value is None):
+      self._value = rec(self._elems(), self.n)
+    return self._value
+
+  def elems(self):
+    return self.eval().elems
+  elems = property(elems)
+
+  def __len__(self):
+    return self.n[0] * self.n[1]
+
+  def __getitem__(self, i):
+    return self.eval().elems[i]
 
-  def inverse(self):
-    r_inv = self.r.inverse()
-    return rt((r_inv, -(r_inv*self.t)))
+  def __call__(self, ir, ic):
+    return self.eval().elems[ir * self.n[1] + ic]
 
-  def inverse_assuming_orthogonal_r(self):
-    r_inv = self.r.transpose()
-    return rt((r_inv, -(r_inv*self.t)))
+  def _elems(self):
+    "Elements of the value of self (a tuple or list; not a copy for leaves)."
+    if (self._value is not None):
+      return self._value.elems
+    op = self.op
+    if (op == "leaf"):
+      return self.m.elems
+    if (op == "mul"):
+      return self._product_elems()
+    terms = []
+    self._collect_terms(1, terms)
+    coefficient, node = terms[0]
+    first = node._elems()
+    if (len(terms) == 1 and coefficient == 1):
+      return first
+    if (coefficient == 1): result = list(first)
+    elif (coefficient == -1): result = [-e for e in first]
+    else: result = [coefficient * e for e in first]
+    indices = xrange(len(result))
+    for coefficient, node in terms[1:]:
+      e = node._elems()
+      if (coefficient == 1):
+        for i in indices: result[i] += e[i]
+      elif (coefficient == -1):
+        for i in indices: result[i] -= e[i]
+      else:
+        for i in indices: result[i] += coefficient * e[i]
+    return result
 
-  def as_float(self):
-    return rt((self.r.as_float(), self.t.as_float()))
+  def _collect_terms(self, coefficient, terms):
+    "Flattens sums, differences and scalar factors into (coefficient, node)."
+    op = self.op
+    if (self._value is None):
+      if (op == "add"):
+        self.args[0]._collect_terms(coefficient, terms)
+        self.args[1]._collect_terms(coefficient, terms)
+        return
+      if (op == "sub"):
+        self.args[0]._collect_terms(coefficient, terms)
+        self.args[1]._collect_terms(-coefficient, terms)
+        return
+      if (op == "scale"):
+        self.args[0]._collect_terms(coefficient * self.args[1], terms)
+        return
+    terms.append((coefficient, self))
 
-  def as_augmented_matrix(self):
-    assert self.r.n_rows() == self.r.n_columns()
-    n = self.r.n_rows()
-    result = []
-    for i_row in xrange(n):
-      result.extend(self.r.elems[i_row*n:(i_row+1)*n])
-      result.append(self.t[i_row])
-    result.extend([0]*n)
-    result.append(1)
-    return rec(result, (n+1,n+1))
+  def _collect_factors(self, factors):
+    if (self.op == "mul" and self._value is None):
+      self.args[0]._collect_factors(factors)
+      self.args[1]._collect_factors(factors)
+    else:
+      factors.append(self)
 
-def col_list(seq): return [col(elem) for elem in seq]
-def row_list(seq): return [row(elem) for elem in seq]
+  def _product_elems(self):
+    factors = []
+    self._collect_factors(factors)
+    dims = [f.n[0] for f in factors] + [factors[-1].n[1]]
+    cost, split = matrix_chain_order(dims)
+    def operand(elems, n):
+      "rec without the conversion of elems to a tuple"
+      result = rec.__new__(rec)
+      result.elems = elems
+      result.n = n
+      return result
+    values = [operand(f._elems(), f.n) for f in factors]
+    def product(i, j):
+      if (i == j): return values[i]
+      s = split[i][j]
+      a = product(i, s)
+      b = product(s+1, j)
+      if (a.n[1] == 0):
+        elems = [0] * (a.n[0] * b.n[1])
+      else:
+        elems = backends.select(operation="mul",
+          size=a.n[0]*a.n[1]*b.n[1], operands=(a, b)).mul(a, b)
+      return operand(elems, (a.n[0], b.n[1]))
+    return product(0, len(factors)-1).elems
 
 def lu_decomposition_in_place(a, n, raise_if_singular=True):
   is_singular_message = "lu_decomposition_in_place: singular matrix"
@@ -1074,35 +3408,846 @@ def lu_back_substitution(a, n, pivot_indices, b, raise_if_singular=True):
     b[i] = sum / a[i*n+i]
   return True
 
+class lu_factorization(object):
+  """\
+LU factorization of a square matrix, computed once (O(n^3)) and then
+reused by solve(), solve_many(), determinant() and inverse().
+
+If numpy is available (and use_numpy is not False) the factorization
+and the triangular solves are vectorized with numpy; solve_many()
+then processes all right-hand sides in one pass. Otherwise
+lu_decomposition_in_place() and lu_back_substitution() are used.
+
+If raise_if_singular is False, a singular matrix is not an error:
+is_singular() returns True, determinant() returns 0, and the solve
+methods raise RuntimeError.
+"""
+
+  def __init__(self, m, raise_if_singular=True, use_numpy=None):
+    assert m.is_square()
+    n = m.n[0]
+    if (use_numpy is None):
+      use_numpy = (n != 0 and numpy_proxy() is not None)
+    self.n = n
+    self.use_numpy = use_numpy
+    if (use_numpy):
+      self._factor_numpy(m, raise_if_singular)
+    else:
+      self.a = list(m.elems)
+      if (n == 0):
+        self.pivot_indices = [0]
+      else:
+        self.pivot_indices = lu_decomposition_in_place(
+          a=self.a, n=n, raise_if_singular=raise_if_singular)
+
+  def _factor_numpy(self, m, raise_if_singular):
+    numpy = numpy_proxy()
+    assert numpy is not None
+    n = self.n
+    a = numpy.array(m.elems, dtype=numpy.float64).reshape((n,n))
+    permutation = numpy.arange(n)
+    n_swaps = 0
+    for j in xrange(n):
+      p = j + int(numpy.argmax(numpy.abs(a[j:,j])))
+      if (a[p,j] == 0):
+        if (raise_if_singular):
+          raise RuntimeError("lu_factorization: singular matrix")
+        self.a = None
+        self.pivot_indices = None
+        return
+      if (p != j):
+        a[[j,p]] = a[[p,j]]
+        permutation[[j,p]] = permutation[[p,j]]
+        n_swaps += 1
+      if (j+1 < n):
+        a[j+1:,j] /= a[j,j]
+        a[j+1:,j+1:] -= numpy.outer(a[j+1:,j], a[j,j+1:])
+    self.a = a
+    self.pivot_indices = permutation
+    self._n_swaps = n_swaps
+
+  def is_singular(self):
+    return self.pivot_indices is None
+
+  def _assert_not_singular(self):
+    if (self.pivot_indices is None):
+      raise RuntimeError("lu_factorization: singular matrix")
+
+  def _solve_columns_numpy(self, b):
+    "b is a numpy array with shape (n,k); returns the solution x."
+    numpy = numpy_proxy()
+    a = self.a
+    x = numpy.array(b[self.pivot_indices], dtype=numpy.float64)
+    n = self.n
+    for i in xrange(1, n):
+      x[i] -= numpy.dot(a[i,:i], x[:i])
+    for i in xrange(n-1, -1, -1):
+      x[i] = (x[i] - numpy.dot(a[i,i+1:], x[i+1:])) / a[i,i]
+    return x
+
+  def _solve_in_place(self, b):
+    lu_back_substitution(
+      a=self.a, n=self.n, pivot_indices=self.pivot_indices, b=b)
+
+  def solve(self, b):
+    "Returns x (a col) such that m * x = b."
+    self._assert_not_singular()
+    b = list(getattr(b, "elems", b))
+    assert len(b) == self.n
+    if (self.use_numpy):
+      numpy = numpy_proxy()
+      x = self._solve_columns_numpy(numpy.array(b).reshape((self.n,1)))
+      return col(x.ravel().tolist())
+    self._solve_in_place(b)
+    return col(b)
+
+  def solve_many(self, b):
+    """\
+b may be a rec with n rows (each column is one right-hand side), in
+which case the result is a rec with the same shape, or a sequence of
+right-hand side vectors, in which case the result is a list of col.
+"""
+    self._assert_not_singular()
+    n = self.n
+    if (isinstance(b, rec)):
+      assert b.n[0] == n
+      nc = b.n[1]
+      if (self.use_numpy):
+        numpy = numpy_proxy()
+        x = self._solve_columns_numpy(numpy.array(b.elems).reshape((n,nc)))
+        return rec(x.ravel().tolist(), (n,nc))
+      e = b.elems
+      result = [0] * (n*nc)
+      for j in xrange(nc):
+        x = [e[i*nc+j] for i in xrange(n)]
+        self._solve_in_place(x)
+        for i in xrange(n):
+          result[i*nc+j] = x[i]
+      return rec(result, (n,nc))
+    columns = [list(getattr(v, "elems", v)) for v in b]
+    for x in columns: assert len(x) == n
+    if (self.use_numpy):
+      if (len(columns) == 0): return []
+      numpy = numpy_proxy()
+      x = self._solve_columns_numpy(numpy.array(columns).transpose())
+      return [col(v) for v in x.transpose().tolist()]
+    for x in columns:
+      self._solve_in_place(x)
+    return [col(x) for x in columns]
+
+  def determinant(self):
+    if (self.pivot_indices is None):
+      return 0
+    n = self.n
+    a = self.a
+    result = 1
+    if (self.use_numpy):
+      for i in xrange(n):
+        result *= float(a[i,i])
+      n_swaps = self._n_swaps
+    else:
+      for i in xrange(n):
+        result *= a[i*n+i]
+      n_swaps = self.pivot_indices[-1]
+    if (n_swaps % 2):
+      result = -result
+    return result
+
+  def inverse(self):
+    self._assert_not_singular()
+    n = self.n
+    if (n == 0): return sqr([])
+    if (self.use_numpy):
+      numpy = numpy_proxy()
+      return sqr(self._solve_columns_numpy(numpy.identity(n)).ravel().tolist())
+    r = [0] * (n*n)
+    for j in xrange(n):
+      b = [0.] * n
+      b[j] = 1.
+      self._solve_in_place(b)
+      for i in xrange(n):
+        r[i*n+j] = b[i]
+    return sqr(r)
+
 def inverse_via_lu(m):
   assert m.is_square()
-  n = m.n[0]
-  if (n == 0): return sqr([])
-  a = list(m.elems)
-  pivot_indices = lu_decomposition_in_place(a=a, n=n)
-  r = [0] * (n*n)
-  for j in xrange(n):
-    b = [0.] * n
-    b[j] = 1.
-    lu_back_substitution(a=a, n=n, pivot_indices=pivot_indices, b=b)
-    for i in xrange(n):
-      r[i*n+j] = b[i]
-  return sqr(r)
+  return lu_factorization(m=m, use_numpy=False).inverse()
 
 def determinant_via_lu(m):
+  assert m.is_square()
+  if (m.n[0] == 0): return 1 # to be consistent with other implemenations
+  return lu_factorization(
+    m=m, raise_if_singular=False, use_numpy=False).determinant()
+
+def _gcd(a, b):
+  while (b):
+    a, b = b, a % b
+  return a
+
+def _integer_scaled_rows(elems, n):
+  """\
+elems are the n*n int or fractions.Fraction elements of a square
+matrix. Each row is multiplied by the least common multiple of its
+denominators. Returns (int elems, list of row scale factors).
+"""
+  result = []
+  scales = []
+  for i in xrange(n):
+    row = elems[i*n:(i+1)*n]
+    s = 1
+    for v in row:
+      d = getattr(v, "denominator", 1)
+      s = s * d // _gcd(s, d)
+    result.extend([int(v * s) for v in row])
+    scales.append(s)
+  return result, scales
+
+def _bareiss_determinant_in_place(a, n, integral):
+  sign = 1
+  previous_pivot = 1
+  for k in xrange(n-1):
+    kk = k*n+k
+    if (a[kk] == 0):
+      for i in xrange(k+1, n):
+        if (a[i*n+k] != 0):
+          for j in xrange(k, n):
+            a[k*n+j], a[i*n+j] = a[i*n+j], a[k*n+j]
+          sign = -sign
+          break
+      else:
+        return 0
+    pivot = a[kk]
+    for i in xrange(k+1, n):
+      a_ik = a[i*n+k]
+      for j in xrange(k+1, n):
+        v = a[i*n+j] * pivot - a_ik * a[k*n+j]
+        if (integral): a[i*n+j] = v // previous_pivot
+        else:          a[i*n+j] = v / previous_pivot
+    previous_pivot = pivot
+  return sign * a[n*n-1]
+
+def determinant_bareiss(m):
+  """\
+Fraction-free Gaussian elimination (Bareiss). All intermediate values
+are determinants of submatrices, so the divisions are exact: the
+result is exact for int elements without the cost of rational
+arithmetic. Matrices with fractions.Fraction elements are scaled to
+int row by row first.
+"""
   assert m.is_square()
   n = m.n[0]
-  if (n == 0): return 1 # to be consistent with other implemenations
-  a = list(m.elems)
-  pivot_indices = lu_decomposition_in_place(a=a, n=n, raise_if_singular=False)
-  if (pivot_indices is None):
-    return 0
-  result = 1
+  if (n == 0): return 1
+  if (_exact_types(m.elems, require_fraction=True)):
+    import fractions
+    a, scales = _integer_scaled_rows(m.elems, n)
+    denominator = 1
+    for s in scales: denominator *= s
+    return fractions.Fraction(
+      _bareiss_determinant_in_place(a, n, integral=True), denominator)
+  return _bareiss_determinant_in_place(list(m.elems), n,
+    integral=_exact_types(m.elems, require_fraction=False))
+
+def inverse_via_fractions(m):
+  """\
+Exact inverse with fractions.Fraction elements. The rows are scaled to
+int (see determinant_bareiss()) and inverted by fraction-free
+Gauss-Jordan elimination, so that only the final n*n divisions by the
+determinant involve rational arithmetic. float elements are converted
+to Fraction exactly.
+"""
+  import fractions
+  Fraction = fractions.Fraction
+  assert m.is_square()
+  n = m.n[0]
+  elems = m.elems
+  if (not _exact_types(elems, require_fraction=False)):
+    elems = [Fraction(v) for v in elems]
+  a, scales = _integer_scaled_rows(elems, n)
+  rows = []
   for i in xrange(n):
-    result *= a[i*n+i]
-  if (pivot_indices[-1] % 2):
-    result = -result
-  return result
+    row = a[i*n:(i+1)*n] + [0] * n
+    row[n+i] = 1
+    rows.append(row)
+  previous_pivot = 1
+  for k in xrange(n):
+    for i in xrange(k, n):
+      if (rows[i][k] != 0): break
+    else:
+      raise RuntimeError("inverse_via_fractions: singular matrix")
+    rows[k], rows[i] = rows[i], rows[k]
+    row_k = rows[k]
+    pivot = row_k[k]
+    for i in xrange(n):
+      if (i == k): continue
+      row_i = rows[i]
+      f = row_i[k]
+      for j in xrange(2*n):
+        row_i[j] = (row_i[j] * pivot - f * row_k[j]) // previous_pivot
+    previous_pivot = pivot
+  # now rows[i][i] == previous_pivot (the determinant) for all i
+  result = []
+  for row in rows:
+    for j in xrange(n):
+      result.append(Fraction(row[n+j] * scales[j], previous_pivot))
+  return rec(result, m.n)
+
+def _packed_u_index(n, i, j):
+  "Index of element (i,j), i <= j, in packed upper-triangular storage."
+  return i*n - (i*(i-1))//2 + j - i
+
+def cholesky_decomposition_packed_u_in_place(
+      a, n, raise_if_not_positive_definite=True):
+  """\
+a is a symmetric matrix in packed upper-triangular storage (rows of
+the upper triangle, including the diagonal, n*(n+1)/2 elements).
+On return a holds U (same storage) with U^T U = the original matrix.
+"""
+  not_positive_definite_message = \
+    "cholesky_decomposition_packed_u_in_place: not positive definite"
+  assert len(a) == n*(n+1)//2
+  ii = 0
+  for i in xrange(n):
+    d = a[ii]
+    if (not d > 0):
+      if (raise_if_not_positive_definite):
+        raise RuntimeError(not_positive_definite_message)
+      return False
+    d = math.sqrt(d)
+    a[ii] = d
+    row_end = ii + n - i
+    for j in xrange(ii+1, row_end):
+      a[j] /= d
+    kk = row_end
+    for k in xrange(i+1, n):
+      u_ik = a[ii + k - i]
+      if (u_ik != 0):
+        shift = ii - i - kk + k
+        for jk in xrange(kk, kk + n - k):
+          a[jk] -= u_ik * a[jk + shift]
+      kk += n - k
+    ii = row_end
+  return True
+
+def cholesky_back_substitution_packed_u(u, n, b):
+  "Solves U^T U x = b in place (b is overwritten with x)."
+  assert len(u) == n*(n+1)//2
+  assert len(b) == n
+  ii = 0
+  for i in xrange(n):
+    bi = b[i] / u[ii]
+    b[i] = bi
+    for j in xrange(i+1, n):
+      b[j] -= u[ii + j - i] * bi
+    ii += n - i
+  for i in xrange(n-1, -1, -1):
+    ii -= n - i
+    s = b[i]
+    for j in xrange(i+1, n):
+      s -= u[ii + j - i] * b[j]
+    b[i] = s / u[ii]
+
+class cholesky_factorization(object):
+  """\
+Cholesky factorization U^T U of a symmetric positive definite matrix
+(only the upper triangle of m is used), computed once in packed
+storage and then reused by solve(), solve_many(), determinant() and
+inverse(). About half the work of lu_factorization.
+
+If raise_if_not_positive_definite is False, a matrix that is not
+positive definite is not an error: is_positive_definite() returns
+False and the other methods raise RuntimeError.
+"""
+
+  def __init__(self, m, raise_if_not_positive_definite=True):
+    assert m.is_square()
+    n = m.n[0]
+    e = m.elems
+    u = []
+    for i in xrange(n):
+      u.extend(e[i*n+i:(i+1)*n])
+    if (not cholesky_decomposition_packed_u_in_place(a=u, n=n,
+              raise_if_not_positive_definite=raise_if_not_positive_definite)):
+      u = None
+    self.n = n
+    self.u_packed = u
+
+  def is_positive_definite(self):
+    return self.u_packed is not None
+
+  def _assert_positive_definite(self):
+    if (self.u_packed is None):
+      raise RuntimeError("cholesky_factorization: not positive definite")
+
+  def u(self):
+    "The upper-triangular factor as a full sqr."
+    self._assert_positive_definite()
+    n = self.n
+    result = [0] * (n*n)
+    k = 0
+    for i in xrange(n):
+      for j in xrange(i, n):
+        result[i*n+j] = self.u_packed[k]
+        k += 1
+    return sqr(result)
+
+  def solve(self, b):
+    "Returns x (a col) such that m * x = b."
+    self._assert_positive_definite()
+    b = list(getattr(b, "elems", b))
+    cholesky_back_substitution_packed_u(u=self.u_packed, n=self.n, b=b)
+    return col(b)
+
+  def solve_many(self, b):
+    "Same conventions as lu_factorization.solve_many()."
+    self._assert_positive_definite()
+    n = self.n
+    if (isinstance(b, rec)):
+      assert b.n[0] == n
+      nc = b.n[1]
+      e = b.elems
+      result = [0] * (n*nc)
+      for j in xrange(nc):
+        x = [e[i*nc+j] for i in xrange(n)]
+        cholesky_back_substitution_packed_u(u=self.u_packed, n=n, b=x)
+        for i in xrange(n):
+          result[i*nc+j] = x[i]
+      return rec(result, (n,nc))
+    return [self.solve(v) for v in b]
+
+  def determinant(self):
+    self._assert_positive_definite()
+    result = 1
+    ii = 0
+    for i in xrange(self.n):
+      result *= self.u_packed[ii]
+      ii += self.n - i
+    return result * result
+
+  def inverse(self):
+    "Returns a sym."
+    self._assert_positive_definite()
+    n = self.n
+    if (n == 0): return sym(elems=[])
+    r = [0] * (n*n)
+    for j in xrange(n):
+      b = [0.] * n
+      b[j] = 1.
+      cholesky_back_substitution_packed_u(u=self.u_packed, n=n, b=b)
+      for i in xrange(j+1):
+        r[i*n+j] = b[i]
+    return sym(elems=r)
+
+def jacobi_eigensystem_in_place(a, n, max_sweeps=50):
+  """\
+Eigenvalues and eigenvectors of a real symmetric matrix (n*n elements
+of a full matrix), using cyclic Jacobi rotations. On return the
+diagonal of a holds the eigenvalues and the returned list (n*n
+elements) the eigenvectors as columns, in the same (unsorted) order.
+"""
+  assert len(a) == n*n
+  v = [0.] * (n*n)
+  for i in xrange(n): v[i*n+i] = 1.
+  norm_sq = 0
+  for e in a: norm_sq += e*e
+  for i_sweep in xrange(max_sweeps):
+    off_sq = 0
+    for p in xrange(n-1):
+      for q in xrange(p+1, n):
+        off_sq += a[p*n+q]**2
+    if (off_sq <= 1.e-30 * norm_sq):
+      return v
+    for p in xrange(n-1):
+      for q in xrange(p+1, n):
+        a_pq = a[p*n+q]
+        if (a_pq == 0): continue
+        theta = (a[q*n+q] - a[p*n+p]) / (2. * a_pq)
+        t = 1. / (abs(theta) + math.sqrt(theta*theta + 1))
+        if (theta < 0): t = -t
+        c = 1. / math.sqrt(t*t + 1)
+        s = t * c
+        for k in xrange(n):
+          kp, kq = k*n+p, k*n+q
+          a_kp, a_kq = a[kp], a[kq]
+          a[kp] = c*a_kp - s*a_kq
+          a[kq] = s*a_kp + c*a_kq
+        for k in xrange(n):
+          pk, qk = p*n+k, q*n+k
+          a_pk, a_qk = a[pk], a[qk]
+          a[pk] = c*a_pk - s*a_qk
+          a[qk] = s*a_pk + c*a_qk
+        for k in xrange(n):
+          kp, kq = k*n+p, k*n+q
+          v_kp, v_kq = v[kp], v[kq]
+          v[kp] = c*v_kp - s*v_kq
+          v[kq] = s*v_kp + c*v_kq
+  raise RuntimeError(
+    "jacobi_eigensystem_in_place: no convergence after %d sweeps"
+      % max_sweeps)
+
+class real_symmetric_eigensystem(object):
+  """\
+Eigenvalues (tuple, in descending order) and unit eigenvectors (list
+of col, same order) of a real symmetric matrix, e.g. a sym with n=3
+(only the upper triangle is used).
+"""
+
+  def __init__(self, m):
+    assert m.is_square()
+    n = m.n[0]
+    a = [float(e) for e in sym(elems=m.elems).elems]
+    v = jacobi_eigensystem_in_place(a=a, n=n)
+    order = sorted(xrange(n), key=lambda i: -a[i*n+i])
+    self.values = tuple([a[i*n+i] for i in order])
+    self.vectors = [col([v[k*n+i] for k in xrange(n)]) for i in order]
+
+class normal_equations_accumulator(object):
+  """\
+Least-squares normal equations (A^T A) x = A^T b, accumulated from
+rows or row blocks of the design matrix A (with n columns). Only
+O(n^2) memory is used, independent of the number of rows: A^T A is kept
+in packed upper-triangular storage.
+
+Accumulators of the same problem, e.g. computed in worker processes
+(instances are picklable), can be combined with merge() or +.
+"""
+
+  def __init__(self, n):
+    self.n = n
+    self.a_t_a_packed_u = [0] * (n*(n+1)//2)
+    self.a_t_b = [0] * n
+    self.b_t_b = 0
+    self.n_rows = 0
+
+  def add_row(self, a_row, b, weight=1):
+    a_row = getattr(a_row, "elems", a_row)
+    n = self.n
+    assert len(a_row) == n
+    ata = self.a_t_a_packed_u
+    atb = self.a_t_b
+    ii = 0
+    for i in xrange(n):
+      wa_i = weight * a_row[i]
+      if (wa_i != 0):
+        atb[i] += wa_i * b
+        for j in xrange(i, n):
+          ata[ii + j - i] += wa_i * a_row[j]
+      ii += n - i
+    self.b_t_b += weight * b * b
+    self.n_rows += 1
+    return self
+
+  def add_block(self, a, b):
+    """\
+a is a rec with n columns, b a sequence (or col) with a.n_rows()
+elements. Uses rec.transpose_multiply(), i.e. the numpy backend for
+large blocks if available.
+"""
+    n = self.n
+    assert a.n[1] == n
+    b = col(getattr(b, "elems", b))
+    assert len(b) == a.n[0]
+    ata = a.transpose_multiply().elems
+    atb = a.transpose_multiply(b).elems
+    packed = self.a_t_a_packed_u
+    k = 0
+    for i in xrange(n):
+      for j in xrange(i, n):
+        packed[k] += ata[i*n+j]
+        k += 1
+    for i in xrange(n):
+      self.a_t_b[i] += atb[i]
+    self.b_t_b += b.dot()
+    self.n_rows += a.n[0]
+    return self
+
+  def add_rows(self, rows):
+    """\
+rows is an iterable of (a, b) pairs: a single row (sequence or rec)
+with a scalar b, or a block (rec, possibly with only one row) with a
+sequence (or col) b.
+"""
+    for a,b in rows:
+      if (hasattr(b, "__len__")):
+        self.add_block(a, b)
+      else:
+        self.add_row(a, b)
+    return self
+
+  def merge(self, other):
+    assert other.n == self.n
+    packed = self.a_t_a_packed_u
+    for i,v in enumerate(other.a_t_a_packed_u):
+      packed[i] += v
+    for i,v in enumerate(other.a_t_b):
+      self.a_t_b[i] += v
+    self.b_t_b += other.b_t_b
+    self.n_rows += other.n_rows
+    return self
+
+  def __add__(self, other):
+    result = normal_equations_accumulator(self.n)
+    result.merge(self)
+    return result.merge(other)
+
+  def normal_matrix(self):
+    "A^T A as a full sqr."
+    n = self.n
+    packed = self.a_t_a_packed_u
+    result = [0] * (n*n)
+    k = 0
+    for i in xrange(n):
+      for j in xrange(i, n):
+        result[i*n+j] = result[j*n+i] = packed[k]
+        k += 1
+    return sqr(result)
+
+  def right_hand_side(self):
+    "A^T b"
+    return col(self.a_t_b)
+
+  def solve(self, method="cholesky"):
+    """\
+method "cholesky" requires A^T A to be positive definite (A with full
+column rank); "lu" works for any non-singular A^T A.
+"""
+    if (method == "cholesky"):
+      u = list(self.a_t_a_packed_u)
+      cholesky_decomposition_packed_u_in_place(a=u, n=self.n)
+      x = list(self.a_t_b)
+      cholesky_back_substitution_packed_u(u=u, n=self.n, b=x)
+      return col(x)
+    if (method == "lu"):
+      return lu_factorization(m=self.normal_matrix()).solve(self.a_t_b)
+    raise ValueError("Unknown method: %s" % method)
+
+  def sum_of_squared_residuals(self, x):
+    "|A x - b|^2 = x^T A^T A x - 2 x^T A^T b + b^T b"
+    x = getattr(x, "elems", x)
+    n = self.n
+    packed = self.a_t_a_packed_u
+    xtatax = 0
+    k = 0
+    for i in xrange(n):
+      xtatax += packed[k] * x[i] * x[i]
+      k += 1
+      for j in xrange(i+1, n):
+        xtatax += 2 * packed[k] * x[i] * x[j]
+        k += 1
+    xtatb = 0
+    for i in xrange(n):
+      xtatb += x[i] * self.a_t_b[i]
+    return xtatax - 2 * xtatb + self.b_t_b
+
+class block_sparse(object):
+  """\
+Block-sparse matrix: a grid of blocks with row_sizes[i] x
+column_sizes[j] elements, of which only the nonzero blocks are stored,
+as rec in the dict blocks[(i,j)]. Products, transposes and block
+diagonal solves work on the stored blocks only; as_dense() converts
+to a dense rec (the same as rec.resolve_partitions()).
+"""
+
+  def __init__(self, row_sizes, column_sizes, blocks=None):
+    self.row_sizes = tuple(row_sizes)
+    self.column_sizes = tuple(column_sizes)
+    self.blocks = {}
+    self._lu_factorizations = None
+    if (blocks is not None):
+      for ij,block in blocks.items():
+        self[ij] = block
+
+  def from_partitions(cls, m):
+    """\
+m is a rec of rec blocks as for rec.resolve_partitions(). Blocks with
+all elements equal to zero are not stored.
+"""
+    nr, nc = m.n
+    row_sizes = [m(i,0).n[0] for i in xrange(nr)]
+    column_sizes = [m(0,j).n[1] for j in xrange(nc)]
+    result = cls(row_sizes, column_sizes)
+    for i in xrange(nr):
+      for j in xrange(nc):
+        block = m(i,j)
+        for e in block.elems:
+          if (e != 0):
+            result[i,j] = block
+            break
+        else:
+          assert block.n == (row_sizes[i], column_sizes[j])
+    return result
+  from_partitions = classmethod(from_partitions)
+
+  def block_diagonal(cls, blocks):
+    "blocks are the square diagonal blocks (rec)."
+    sizes = [block.n[0] for block in blocks]
+    return cls(sizes, sizes, dict([((i,i), block)
+      for i,block in enumerate(blocks)]))
+  block_diagonal = classmethod(block_diagonal)
+
+  def n(self):
+    return (_builtin_sum(self.row_sizes), _builtin_sum(self.column_sizes))
+  n = property(n)
+
+  def __setitem__(self, ij, block):
+    i, j = ij
+    assert block.n == (self.row_sizes[i], self.column_sizes[j])
+    self.blocks[(i,j)] = block
+    self._lu_factorizations = None
+
+  def __getitem__(self, ij):
+    "The block (i,j); a zero rec if it is not stored."
+    block = self.blocks.get(ij)
+    if (block is None):
+      i, j = ij
+      block = zeros((self.row_sizes[i], self.column_sizes[j]))
+    return block
+
+  def __len__(self):
+    "Number of stored blocks."
+    return len(self.blocks)
+
+  def _offsets(self, sizes):
+    result = [0]
+    for s in sizes:
+      result.append(result[-1] + s)
+    return result
+
+  def _blocks_by_row(self):
+    result = {}
+    for (i,j),block in self.blocks.items():
+      result.setdefault(i, []).append((j, block))
+    return result
+
+  def as_dense(self):
+    nr, nc = self.n
+    result = [0] * (nr * nc)
+    row_offsets = self._offsets(self.row_sizes)
+    column_offsets = self._offsets(self.column_sizes)
+    for (i,j),block in self.blocks.items():
+      bnr, bnc = block.n
+      e = block.elems
+      r0 = row_offsets[i]
+      c0 = column_offsets[j]
+      for ir in xrange(bnr):
+        k = (r0 + ir) * nc + c0
+        result[k:k+bnc] = e[ir*bnc:(ir+1)*bnc]
+    return rec(result, (nr, nc))
+
+  def transpose(self):
+    return block_sparse(self.column_sizes, self.row_sizes, dict([
+      ((j,i), block.transpose()) for (i,j),block in self.blocks.items()]))
+
+  def _accumulate(self, result, ij, block):
+    previous = result.blocks.get(ij)
+    if (previous is None):
+      result.blocks[ij] = block
+    else:
+      result.blocks[ij] = previous + block
+
+  def __mul__(self, other):
+    """\
+block_sparse * block_sparse (a block_sparse), block_sparse * rec or
+sequence (a dense rec), or block_sparse * scalar.
+"""
+    if (isinstance(other, block_sparse)):
+      assert other.row_sizes == self.column_sizes, "Incompatible blocks."
+      other_by_row = other._blocks_by_row()
+      result = block_sparse(self.row_sizes, other.column_sizes)
+      for (i,k),a in self.blocks.items():
+        for j,b in other_by_row.get(k, ()):
+          self._accumulate(result, (i,j), a * b)
+      return result
+    if (isinstance(other, (list, tuple))):
+      other = col(other)
+    if (not isinstance(other, rec)):
+      return block_sparse(self.row_sizes, self.column_sizes, dict([
+        (ij, block * other) for ij,block in self.blocks.items()]))
+    nr, nc = self.n
+    assert other.n[0] == nc, "Incompatible matrices."
+    onc = other.n[1]
+    oe = other.elems
+    row_offsets = self._offsets(self.row_sizes)
+    column_offsets = self._offsets(self.column_sizes)
+    result = [0] * (nr * onc)
+    for (i,j),block in self.blocks.items():
+      c0 = column_offsets[j]
+      part = block * rec(oe[c0*onc:(c0+block.n[1])*onc], (block.n[1], onc))
+      k = row_offsets[i] * onc
+      for v in part.elems:
+        result[k] += v
+        k += 1
+    return rec(result, (nr, onc))
+
+  def transpose_multiply(self, other=None):
+    """\
+self.transpose() * other, without transposing any block. other may be
+None (meaning self, the result is a block_sparse), a block_sparse or a
+dense rec.
+"""
+    if (other is None): other = self
+    if (isinstance(other, block_sparse)):
+      assert other.row_sizes == self.row_sizes, "Incompatible blocks."
+      other_by_row = other._blocks_by_row()
+      result = block_sparse(self.column_sizes, other.column_sizes)
+      for (k,i),a in self.blocks.items():
+        for j,b in other_by_row.get(k, ()):
+          self._accumulate(result, (i,j), a.transpose_multiply(b))
+      return result
+    if (isinstance(other, (list, tuple))):
+      other = col(other)
+    nr, nc = self.n
+    assert other.n[0] == nr, "Incompatible matrices."
+    onc = other.n[1]
+    oe = other.elems
+    row_offsets = self._offsets(self.row_sizes)
+    column_offsets = self._offsets(self.column_sizes)
+    result = [0] * (nc * onc)
+    for (i,j),block in self.blocks.items():
+      r0 = row_offsets[i]
+      part = block.transpose_multiply(
+        rec(oe[r0*onc:(r0+block.n[0])*onc], (block.n[0], onc)))
+      k = column_offsets[j] * onc
+      for v in part.elems:
+        result[k] += v
+        k += 1
+    return rec(result, (nc, onc))
+
+  def is_block_diagonal(self):
+    if (self.row_sizes != self.column_sizes): return False
+    for i,j in self.blocks:
+      if (i != j): return False
+    return True
+
+  def solve_block_diagonal(self, b):
+    """\
+Solves self * x = b for a block diagonal self, block by block (the LU
+factorizations of the diagonal blocks are cached). b may be a sequence
+or a rec; the result is a col if b has one column, otherwise a rec with
+the shape of b.
+"""
+    if (not self.is_block_diagonal()):
+      raise RuntimeError("block_sparse: not block diagonal")
+    if (self._lu_factorizations is None):
+      self._lu_factorizations = {}
+    if (not isinstance(b, rec)): b = col(b)
+    nr, nc = b.n
+    assert nr == self.n[0], "Incompatible matrices."
+    e = b.elems
+    result = []
+    r0 = 0
+    for i,size in enumerate(self.row_sizes):
+      lu = self._lu_factorizations.get(i)
+      if (lu is None):
+        block = self.blocks.get((i,i))
+        if (block is None):
+          raise RuntimeError("block_sparse: singular matrix")
+        lu = lu_factorization(m=block)
+        self._lu_factorizations[i] = lu
+      result.extend(lu.solve_many(
+        rec(e[r0*nc:(r0+size)*nc], (size, nc))).elems)
+      r0 += size
+    if (nc == 1): return col(result)
+    return rec(result, (nr, nc))
 
 def exercise():
   try:
@@ -1587,6 +4732,40 @@ def exercise():
     1/3,4/15,-8/15,8/15,
     -1,-1,1,-1]), -1/75)
   #
+  m = sqr([4, 4, -1, 0, -3, -3, -3, -2, -3, 2, -1, 1, -4, 1, 3, 2])
+  bs = col_list([(1, 2, 3, 4), (-1, 0, 5, 2), (0, 0, 0, 1)])
+  for use_numpy in [False, True]:
+    if (use_numpy and numpy_proxy() is None): continue
+    lu = lu_factorization(m=m, use_numpy=use_numpy)
+    assert not lu.is_singular()
+    assert approx_equal(lu.determinant(), -75)
+    assert approx_equal(lu.inverse(), inverse_via_lu(m=m))
+    for b in bs:
+      x = lu.solve(b)
+      assert isinstance(x, col)
+      assert approx_equal(m * x, b)
+      assert approx_equal(lu.solve(b.elems), x)
+    xs = lu.solve_many(bs)
+    assert len(xs) == 3
+    for x,b in zip(xs, bs): assert approx_equal(m * x, b)
+    bm = rec([b[i] for i in xrange(4) for b in bs], (4,3))
+    xm = lu.solve_many(bm)
+    assert xm.n == (4,3)
+    assert approx_equal(m * xm, bm)
+    assert lu.solve_many([]) == []
+    lu = lu_factorization(m=sqr([1,2,2,4]), raise_if_singular=False,
+      use_numpy=use_numpy)
+    assert lu.is_singular()
+    assert lu.determinant() == 0
+    try: lu.solve((1,2))
+    except RuntimeError, e:
+      assert str(e) == "lu_factorization: singular matrix"
+    else: raise Exception_expected
+    try: lu_factorization(m=sqr([0]*9), use_numpy=use_numpy)
+    except RuntimeError, e:
+      assert str(e).endswith(": singular matrix")
+    else: raise Exception_expected
+  #
   r = identity(n=3)
   assert r.is_r3_rotation_matrix()
   uqr = r.r3_rotation_matrix_as_unit_quaternion()
@@ -1659,6 +4838,153 @@ def exercise():
       assert approx_equal(
         rotate_point_around_axis(**args),
         __rotate_point_around_axis(**args))
+  #
+  r = rt((sqr((0.36, 0.48, -0.8, -0.8, 0.6, 0, 0.48, 0.64, 0.6)),
+          (1.5, -2, 0.25)))
+  points = [site.elems for site in sites]
+  flat = array.array("d", [x for p in points for x in p])
+  expected = [rotate_point_around_axis(
+    axis_point_1=sites[0], axis_point_2=sites[1], point=p, angle=13, deg=True)
+      for p in points]
+  expected_rt = [(r * p).elems for p in points]
+  for points_type in ["array", "vec3_array", "numpy"]:
+    if (points_type == "numpy"):
+      if (numpy_proxy() is None): continue
+      make = lambda: numpy_proxy().array(points)
+    elif (points_type == "vec3_array"):
+      make = lambda: vec3_array(array.array("d", flat), use_numpy=False)
+    else:
+      make = lambda: array.array("d", flat)
+    def as_tuples(result):
+      if (points_type == "numpy"): return [tuple(p) for p in result.tolist()]
+      if (points_type == "vec3_array"): return [v.elems for v in result]
+      return [tuple(result[i:i+3]) for i in xrange(0, len(result), 3)]
+    pts = make()
+    result = rotate_points_around_axis(
+      axis_point_1=sites[0], axis_point_2=sites[1], points=pts,
+      angle=13, deg=True)
+    assert result is not pts
+    assert as_tuples(pts) == points
+    assert approx_equal(as_tuples(result), expected)
+    result = rotate_points_around_axis(
+      axis_point_1=sites[0], axis_point_2=sites[1], points=pts,
+      angle=13*math.pi/180, in_place=True)
+    assert result is pts
+    assert approx_equal(as_tuples(pts), expected)
+    pts = make()
+    assert approx_equal(as_tuples(r.apply_to_points(pts)), expected_rt)
+    assert as_tuples(pts) == points
+    assert r.apply_to_points(pts, in_place=True) is pts
+    assert approx_equal(as_tuples(pts), expected_rt)
+  assert approx_equal(
+    (r * vec3_array(flat, use_numpy=False)).as_recs(), expected_rt)
+  try: r.apply_to_points(points)
+  except TypeError, e: assert str(e).startswith("points must be ")
+  else: raise Exception_expected
+  #
+  assert backends.select("mul", 8, (col((1,2)), row((3,4)))) is backends.pure
+  assert backends.select("determinant", 3, (identity(3),)).name == "pure"
+  class counting_backend(_pure_backend):
+    name = "counting"
+    default_thresholds = {"mul": 100, "inverse": 5}
+    calls = 0
+    def mul(self, a, b):
+      counting_backend.calls += 1
+      return _pure_backend.mul(self, a, b)
+  saved_thresholds = backends.thresholds
+  backends.register(counting_backend(), priority=100)
+  try:
+    assert backends.threshold("mul", "counting") == 100
+    a = rec(range(20), (4,5))
+    b = rec(range(15), (5,3))
+    assert (a*b).elems == rec(_pure_backend().mul(a, b), (4,3)).elems
+    assert counting_backend.calls == 0 # 4*5*3 < 100
+    a = rec(range(40), (8,5))
+    c = a*b
+    assert counting_backend.calls == 1
+    assert c.elems == tuple(_pure_backend().mul(a, b))
+    backends.set_threshold("mul", "counting", None)
+    a*b
+    assert counting_backend.calls == 1
+    assert backends.select("inverse", 6, (identity(6),)).name == "counting"
+    assert backends.select("inverse", 4, (identity(4),)).name != "counting"
+  finally:
+    backends.unregister("counting")
+    backends.thresholds = saved_thresholds
+    backends._update_lowest_thresholds()
+  assert "counting" not in backends.backends
+  def pinned_registry(*backends_and_priorities):
+    "A backend_registry that does not read the user's config file."
+    result = backend_registry()
+    for backend,priority in backends_and_priorities:
+      result.register(backend, priority=priority)
+    result._config_loaded = True
+    return result
+  registry = pinned_registry((_pure_backend(), 0), (_numpy_backend(), 10))
+  assert registry.threshold("mul", "numpy") is not None
+  a = rec([i*0.5 for i in xrange(6)], (2,3))
+  b = rec([i-3.25 for i in xrange(12)], (3,4))
+  assert registry.select("mul", 10**9, (a, b)).name \
+      == ["pure", "numpy"][int(numpy_proxy() is not None)]
+  assert _builtin_real_types((1, 2.5), require_float=True)
+  assert not _builtin_real_types((1, 2), require_float=True)
+  assert _builtin_real_types((1, 2), require_float=False)
+  from fractions import Fraction
+  assert not _builtin_real_types((1, Fraction(1,2)), require_float=False)
+  if (numpy_proxy() is not None):
+    nb = backends.backends["numpy"]
+    a = rec([i*0.5 for i in xrange(6)], (2,3))
+    b = rec([i-3.25 for i in xrange(12)], (3,4))
+    assert approx_equal(nb.mul(a, b), _pure_backend().mul(a, b))
+    assert approx_equal(nb.transpose_multiply(a, None),
+      _pure_backend().transpose_multiply(a, None))
+    assert approx_equal(nb.transpose_multiply(b, b),
+      _pure_backend().transpose_multiply(b, b))
+    m = sqr([4, 4, -1, 0, -3, -3, -3, -2, -3, 2, -1, 1, -4, 1, 3, 2])
+    assert approx_equal(nb.determinant(m), -75)
+    assert approx_equal(nb.inverse(m), inverse_via_lu(m))
+    assert nb.accepts("mul", (a, b))
+    assert not nb.accepts("mul", (rec(range(6), (2,3)), None))
+    assert nb.accepts("inverse", (m,))
+    assert not nb.accepts("inverse", (sqr([Fraction(1,2)]),))
+  import os, tempfile
+  config_file_name = tempfile.mktemp(suffix=".json")
+  try:
+    registry = backend_registry()
+    registry.register(_pure_backend(), priority=0)
+    registry.register(_numpy_backend(), priority=10)
+    registry.set_threshold("mul", "numpy", 123)
+    registry.set_threshold("inverse", "numpy", None)
+    assert registry.save_config(config_file_name) == config_file_name
+    registry = backend_registry()
+    registry.register(_pure_backend(), priority=0)
+    registry.register(_numpy_backend(), priority=10)
+    assert registry.threshold("mul", "numpy") == 4096
+    assert registry.load_config(config_file_name)
+    assert registry.config_file_name == config_file_name
+    assert registry.threshold("mul", "numpy") == 123
+    assert registry.threshold("inverse", "numpy") is None
+    assert registry.select("inverse", 1000, (identity(3),)) is registry.pure
+    open(config_file_name, "w").write('{"thresholds": {"foo": {}}}')
+    try: registry.load_config(config_file_name)
+    except RuntimeError, e:
+      assert str(e).startswith("Invalid scitbx_matrix backend config file ")
+      assert str(e).endswith(": unknown operation: foo")
+    else: raise Exception_expected
+    registry = backend_registry()
+    registry.register(_pure_backend(), priority=0)
+    registry.default_config_file_name = lambda: config_file_name
+    for i_pass in xrange(2): # a bad config file fails consistently
+      try: registry.select("mul", 1000, (identity(3), identity(3)))
+      except RuntimeError, e:
+        assert str(e).endswith(": unknown operation: foo")
+      else: raise Exception_expected
+    open(config_file_name, "w").write('{"thresholds": {}}')
+    assert registry.select("mul", 1000, (identity(3), identity(3))) \
+      is registry.pure
+    assert registry.config_file_name == config_file_name
+  finally:
+    if (os.path.exists(config_file_name)): os.remove(config_file_name)
   # exercise plane_equation
   point_1=col((1,2,3))
   point_2=col((10,20,30))
@@ -1676,6 +5002,720 @@ def exercise():
     n = m.as_numpy_array()
     assert n.tolist() == [[0, 1, 2], [3, 4, 5]]
   #
+  ms = [sqr((7, 7, -4, 3, 1, -1, 15, 16, -9)),
+        sqr((2, 1, 1, 0, 1, 0, 0, 0, 1)),
+        sqr((1, 2, 3, 0, 1, 4, 5, 6, 0))]
+  vs = col_list([(1, -2, 3), (0, 4, 5), (-6, 7, 1)])
+  for use_numpy in [False, True]:
+    if (use_numpy and numpy is None): continue
+    ma = mat3_array.from_recs(ms, use_numpy=use_numpy)
+    va = vec3_array.from_recs(vs, use_numpy=use_numpy)
+    assert ma.uses_numpy() == use_numpy
+    assert len(ma) == 3 and len(va) == 3
+    assert ma[1] == ms[1] and ma[-1] == ms[2] and va[0] == vs[0]
+    assert isinstance(ma[0], sqr) and isinstance(va[0], col)
+    assert ma.as_recs() == ms
+    assert va.as_recs() == vs
+    assert (ma * ma).as_recs() == [m*m for m in ms]
+    assert (ma * va).as_recs() == [m*v for m,v in zip(ms, vs)]
+    assert (ma * ms[0]).as_recs() == [m*ms[0] for m in ms]
+    assert (ms[0] * ma).as_recs() == [ms[0]*m for m in ms]
+    assert (ma * vs[1]).as_recs() == [m*vs[1] for m in ms]
+    assert (ms[2] * va).as_recs() == [ms[2]*v for v in vs]
+    assert (ma * 2).as_recs() == [m*2 for m in ms]
+    assert (-va).as_recs() == [-v for v in vs]
+    assert (va + va).as_recs() == [v+v for v in vs]
+    assert (va - vs[0]).as_recs() == [v-vs[0] for v in vs]
+    assert list(va.dot(va)) == [v.dot(v) for v in vs]
+    vr = vec3_array.from_recs(vs[::-1], use_numpy=use_numpy)
+    assert va.cross(vr).as_recs() == [a.cross(b) for a,b in zip(vs, vs[::-1])]
+    assert ma.transpose().as_recs() == [m.transpose() for m in ms]
+    assert list(ma.determinant()) == [m.determinant() for m in ms]
+    for mi,m in zip(ma.inverse().as_recs(), ms):
+      assert approx_equal(mi, m.inverse())
+      assert approx_equal(mi*m, identity(n=3))
+    try: mat3_array.from_recs([sqr([0]*9)], use_numpy=use_numpy).inverse()
+    except RuntimeError, e:
+      assert str(e) == "mat3_array.inverse(): singular matrix."
+    else: raise Exception_expected
+    assert len(mat3_array(use_numpy=use_numpy)) == 0
+    assert mat3_array(use_numpy=use_numpy).as_recs() == []
+    assert vec3_array(range(6), use_numpy=use_numpy).as_recs() \
+        == col_list([(0,1,2), (3,4,5)])
+    if (numpy is not None):
+      assert ma.as_numpy_array().shape == (3,3,3)
+      assert va.as_numpy_array().tolist() == [list(v) for v in vs]
+  if (numpy is not None):
+    va = vec3_array.from_recs(vs, use_numpy=True)
+    vp = vec3_array.from_recs(vs, use_numpy=False)
+    assert (va + vp).uses_numpy() and not (vp + va).uses_numpy()
+    assert (vp + va).as_recs() == (va + vp).as_recs()
+  #
+  a = col((1.5, -2, 3))
+  b = col((0.25, 4, -5))
+  m = sqr((7, 7, -4, 3, 1, -1, 15, 16, -9.5))
+  assert type(a) is vec3 and type(m) is mat3
+  assert isinstance(a, col) and isinstance(m, sqr)
+  assert type(col((1,2))) is col and type(sqr((1,2,3,4))) is sqr
+  assert type(mutable_col((1,2,3))) is mutable_col
+  assert vec3.__slots__ == () and mat3.__slots__ == ()
+  ga = rec(a.elems, (3,1))
+  gb = rec(b.elems, (3,1))
+  gm = rec(m.elems, (3,3))
+  assert type(-a) is vec3 and (-a).elems == (-ga).elems
+  assert type(a+b) is vec3 and (a+b).elems == (ga+gb).elems
+  assert type(a-b) is vec3 and (a-b).elems == (ga-gb).elems
+  assert type(a*3) is vec3 and (a*3).elems == (ga*3).elems
+  assert type(3*a) is vec3 and (3*a).elems == (3*ga).elems
+  assert (a/2).elems == (ga/2).elems
+  assert a.dot(b) == ga.dot(gb) and a.dot() == ga.dot()
+  assert a.norm_sq() == ga.norm_sq() and abs(a) == abs(ga)
+  assert type(a.cross(b)) is vec3 and a.cross(b).elems == ga.cross(gb).elems
+  assert a.normalize().elems == ga.normalize().elems
+  assert type(m*a) is vec3 and (m*a).elems == (gm*ga).elems
+  assert type(m*m) is mat3 and (m*m).elems == (gm*gm).elems
+  assert (m*gm).elems == (gm*m).elems == (gm*gm).elems
+  assert (m*2).elems == (gm*2).elems and (-m).elems == (-gm).elems
+  assert (m+m).elems == (gm+gm).elems and (m-gm).elems == (gm-gm).elems
+  assert m.transpose().elems == gm.transpose().elems
+  assert m.determinant() == gm.determinant()
+  assert m.trace() == gm.trace()
+  assert type(m.inverse()) is mat3 and m.inverse().elems == gm.inverse().elems
+  assert (m * a.transpose().transpose()).elems == (gm*ga).elems
+  assert (a * row((1,2))).n == (3,2)
+  assert (m * rec(range(6), (3,2))).n == (3,2)
+  assert (m * [1,2,3]).elems == (gm * [1,2,3]).elems
+  r = rt((m, a))
+  assert type(r.r) is mat3 and type(r.t) is vec3
+  assert (r * b).elems == (gm * gb + ga).elems
+  assert approx_equal((r.inverse() * r).r, identity(n=3))
+  import pickle
+  for protocol in [0, 2]:
+    for x in [a, m, ga, rec(range(6), (2,3))]:
+      y = pickle.loads(pickle.dumps(x, protocol))
+      assert type(y) is type(x) and y.n == x.n and y.elems == x.elems
+  #
+  rng = random.Random(0)
+  n = 4
+  design = [[rng.uniform(-1, 1) for j in xrange(n)] for i in xrange(23)]
+  x_true = (0.5, -2, 3.25, 1)
+  bs = [col(r).dot(col(x_true)) + rng.uniform(-1e-3, 1e-3) for r in design]
+  a = rec([e for r in design for e in r], (len(design), n))
+  ata = a.transpose_multiply()
+  atb = a.transpose_multiply(col(bs))
+  x_ref = lu_factorization(m=ata).solve(atb)
+  acc = normal_equations_accumulator(n=n)
+  acc.add_rows(zip(design[:4], bs[:4]))
+  acc.add_rows([(rec(design[4], (1,n)), bs[4])]) # row
+  acc.add_rows([(rec([e for r in design[5:14] for e in r], (9,n)), bs[5:14]),
+                (rec(design[14], (1,n)), bs[14:15])]) # blocks
+  acc.add_block(rec([e for r in design[15:] for e in r], (8,n)), bs[15:])
+  assert acc.n_rows == 23
+  assert approx_equal(acc.normal_matrix(), ata)
+  assert approx_equal(acc.right_hand_side(), atb)
+  for method in ["cholesky", "lu"]:
+    x = acc.solve(method=method)
+    assert isinstance(x, col)
+    assert approx_equal(x, x_ref)
+    assert abs(x - col(x_true)) < 1e-2
+  assert approx_equal(acc.sum_of_squared_residuals(x),
+    (a*x - col(bs)).norm_sq())
+  part1 = normal_equations_accumulator(n=n).add_rows(zip(design, bs)[:11])
+  part2 = normal_equations_accumulator(n=n).add_rows(zip(design, bs)[11:])
+  part2 = pickle.loads(pickle.dumps(part2, 2))
+  merged = part1 + part2
+  assert merged.n_rows == 23 and part1.n_rows == 11
+  assert approx_equal(merged.solve(), x_ref)
+  assert approx_equal(part1.merge(part2).a_t_a_packed_u, acc.a_t_a_packed_u)
+  acc = normal_equations_accumulator(n=2).add_row((1, 2), 1).add_row((2, 4), 2)
+  try: acc.solve()
+  except RuntimeError, e: assert str(e).endswith(": not positive definite")
+  else: raise Exception_expected
+  try: acc.solve(method="qr")
+  except ValueError, e: assert str(e) == "Unknown method: qr"
+  else: raise Exception_expected
+  u = [4, 2, -2, 10, 5, 11] # packed upper triangle of an SPD matrix
+  assert cholesky_decomposition_packed_u_in_place(a=u, n=3)
+  assert approx_equal(u, [2, 1, -1, 3, 2, 6**0.5])
+  b = [2, 23, 19]
+  cholesky_back_substitution_packed_u(u=u, n=3, b=b)
+  assert approx_equal(sqr((4, 2, -2, 2, 10, 5, -2, 5, 11)) * col(b), (2,23,19))
+  assert not cholesky_decomposition_packed_u_in_place(
+    a=[1, 2, 1], n=2, raise_if_not_positive_definite=False)
+  #
+  s = sym(elems=(4, 2, -2, 99, 10, 5, 99, 99, 11))
+  assert s.as_mat3() == (4, 2, -2, 2, 10, 5, -2, 5, 11)
+  assert s.packed_u() == [4, 2, -2, 10, 5, 11]
+  assert sym(elems=s.elems).as_sym_mat3() == s.as_sym_mat3()
+  c = s.cholesky_factorization()
+  assert c.is_positive_definite()
+  assert approx_equal(c.u().transpose() * c.u(), s)
+  assert approx_equal(c.determinant(), s.determinant())
+  x = c.solve(col((2, 23, 19)))
+  assert isinstance(x, col)
+  assert approx_equal(s * x, (2, 23, 19))
+  assert approx_equal(c.solve_many(rec((2, 1, 23, 0, 19, 0), (3,2))),
+    lu_factorization(m=s).solve_many(rec((2, 1, 23, 0, 19, 0), (3,2))))
+  assert approx_equal(c.solve_many([(1,0,0)])[0], s.inverse().elems[::3])
+  assert type(c.inverse()) is sym
+  assert approx_equal(c.inverse(), s.inverse())
+  c = sym(sym_mat3=(1, 1, 1, 2, 0, 0)).cholesky_factorization(
+    raise_if_not_positive_definite=False)
+  assert not c.is_positive_definite()
+  try: c.solve((1,2,3))
+  except RuntimeError, e:
+    assert str(e) == "cholesky_factorization: not positive definite"
+  else: raise Exception_expected
+  for sym_mat3 in [(4, 10, 11, 2, -2, 5), (2, 3, 5, 0, 0, 0),
+                   (1, 1, 1, 0, 0, 0), (3, 3, 1, 1, 0, 0)]:
+    s = sym(sym_mat3=sym_mat3)
+    es = s.eigensystem()
+    assert list(es.values) == sorted(es.values, reverse=True)
+    assert approx_equal(sum(es.values), s.trace())
+    assert approx_equal(es.values[0]*es.values[1]*es.values[2],
+      s.determinant())
+    for value, vector in zip(es.values, es.vectors):
+      assert abs(vector.length() - 1) < 1e-12
+      assert (s * vector - value * vector).length() < 1e-12
+    assert abs(abs(es.vectors[0].cross(es.vectors[1]).dot(es.vectors[2]))
+               - 1) < 1e-12
+  es = sym(sym_mat3=(3, 3, 1, 1, 0, 0)).eigensystem()
+  assert approx_equal(es.values, (4, 2, 1))
+  es = sym(elems=[2, 1, 0, 0,
+                  1, 2, 1, 0,
+                  0, 1, 2, 1,
+                  0, 0, 1, 2]).eigensystem()
+  assert approx_equal(es.values, [2 + 2 * math.cos(k * math.pi / 5)
+    for k in [1, 2, 3, 4]])
+  #
+  tensors = [(4, 10, 11, 2, -2, 5), (2, 3, 5, 0, 0, 0.5), (1, 2, 3, 0.1, 0, 0)]
+  rot = sqr((0, -1, 0, 1, 0, 0, 0, 0, 1)) * sqr((1, 0, 0, 0, 0.6, -0.8,
+                                                 0, 0.8, 0.6))
+  for use_numpy in ([False, True][:1+int(numpy_proxy() is not None)]):
+    u = sym_mat3_array([e for t in tensors for e in t], use_numpy=use_numpy)
+    assert len(u) == 3 and u.uses_numpy() == use_numpy
+    assert type(u[1]) is sym and u[1].as_sym_mat3() == tensors[1]
+    v = sym_mat3_array.from_recs(u.as_recs(), use_numpy=use_numpy)
+    assert [m.elems for m in v.as_recs()] == [m.elems for m in u.as_recs()]
+    assert [m.elems for m in u.as_mat3_array().as_recs()] \
+        == [sym(sym_mat3=t).elems for t in tensors]
+    assert approx_equal(list(u.trace()), [25, 10, 6])
+    assert approx_equal(list(u.determinant()),
+      [sym(sym_mat3=t).determinant() for t in tensors])
+    for m,t in zip(u.inverse().as_recs(), tensors):
+      assert approx_equal(m, sym(sym_mat3=t).inverse())
+    for m,t in zip(u.transform(rot).as_recs(), tensors):
+      assert approx_equal(m, rot * sym(sym_mat3=t) * rot.transpose())
+    rots = mat3_array.from_recs([rot, rot.transpose(), identity(3)],
+      use_numpy=use_numpy)
+    for m,r,t in zip(u.transform(rots).as_recs(), rots.as_recs(), tensors):
+      assert approx_equal(m, r * sym(sym_mat3=t) * r.transpose())
+    assert approx_equal((u + u - 2 * u)[2], [0] * 9)
+    assert approx_equal((-u * 3)[0], -3 * u[0])
+    try: sym_mat3_array([1, 1, 1, 1, 0, 0], use_numpy=use_numpy).inverse()
+    except RuntimeError, e:
+      assert str(e) == "sym_mat3_array.inverse(): singular matrix."
+    else: raise Exception_expected
+  #
+  m = sqr([4, 4, -1, 0, -3, -3, -3, -2, -3, 2, -1, 1, -4, 1, 3, 2])
+  assert backends.select("determinant", 4, (m,)).name == "exact"
+  assert backends.select("inverse", 4, (m,)).name != "exact"
+  assert backends.select("determinant", 4, (m.as_float(),)).name != "exact"
+  assert m.determinant() == -75 and isinstance(m.determinant(), (int, long))
+  assert approx_equal(m.inverse(), inverse_via_lu(m))
+  assert type(m.inverse().elems[0]) is float
+  n = 6
+  big = sqr([10**17 + (10**17+1) * (i == j)
+    for i in xrange(n) for j in xrange(n)])
+  assert big.determinant() == (10**17+1)**(n-1) * ((n+1) * 10**17 + 1)
+  assert big.as_float().determinant() != big.determinant()
+  p = sqr([0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0])
+  assert p.determinant() == -1 and determinant_bareiss(p.transpose()) == -1
+  assert determinant_bareiss(
+    sqr([1, 2, 3, 4, 2, 4, 6, 8, 0, 0, 1, 1, 1, 0, 0, 1])) == 0
+  assert determinant_bareiss(sqr([])) == 1
+  from fractions import Fraction
+  h = sqr([Fraction(1, i+j+1) for i in xrange(n) for j in xrange(n)])
+  assert backends.select("inverse", n, (h,)).name == "exact"
+  assert h.determinant() == determinant_bareiss(h) == 1 / Fraction(
+    186313420339200000)
+  hi = h.inverse()
+  assert (hi * h).elems == identity(n).elems
+  assert hi.elems[0] == 36 and hi.elems[n-1] == -2772
+  assert inverse_via_fractions(sqr([2, 1, 0, 3])).elems \
+      == (Fraction(1,2), Fraction(-1,6), 0, Fraction(1,3))
+  try: inverse_via_fractions(sqr([1, 2, 2, 4]))
+  except RuntimeError, e:
+    assert str(e) == "inverse_via_fractions: singular matrix"
+  else: raise Exception_expected
+  assert _exact_types((1, Fraction(1,2)), require_fraction=True)
+  assert not _exact_types((1, 2), require_fraction=True)
+  assert not _exact_types((1, 0.5), require_fraction=False)
+  #
+  cache = rotation_matrix_cache(max_size=3)
+  axis = (1, 2, -0.5)
+  for i_pass in xrange(2):
+    for angle in [10, 20, 30]:
+      r = cache.axis_and_angle_as_r3_rotation_matrix(axis, angle, deg=True)
+      assert r.elems == col(axis).axis_and_angle_as_r3_rotation_matrix(
+        angle, deg=True).elems
+  assert (cache.hits, cache.misses, cache.size()) == (3, 3, 3)
+  assert cache.axis_and_angle_as_r3_rotation_matrix(
+    col(axis)*2, 30+1e-12, deg=True) is r
+  assert cache.hits == 4
+  cache.axis_and_angle_as_r3_rotation_matrix(axis, 390, deg=True)
+  assert cache.hits == 5
+  cache.axis_and_angle_as_r3_rotation_matrix(axis, 40, deg=True)
+  assert (cache.misses, cache.size()) == (4, 3)
+  cache.axis_and_angle_as_r3_rotation_matrix(axis, 10, deg=True) # dropped
+  assert cache.misses == 5
+  q = cache.axis_and_angle_as_unit_quaternion(axis, 0.5)
+  assert q.elems == col(axis).axis_and_angle_as_unit_quaternion(0.5).elems
+  assert cache.unit_quaternion_as_r3_rotation_matrix(q).elems \
+      == q.unit_quaternion_as_r3_rotation_matrix().elems
+  assert cache.unit_quaternion_as_r3_rotation_matrix(q.elems) \
+      is cache.unit_quaternion_as_r3_rotation_matrix(q)
+  assert cache.misses == 7 and cache.size() == 3
+  from cStringIO import StringIO
+  sio = StringIO()
+  cache.show_statistics(out=sio)
+  assert sio.getvalue() == "rotation_matrix_cache: hits: 7, misses: 7" \
+    " (hit ratio 0.500), size: 3 of 3\n"
+  cache.clear()
+  assert (cache.hits, cache.misses, cache.size()) == (0, 0, 0)
+  for angle in [30, 390, 750]:
+    q = cache.axis_and_angle_as_unit_quaternion(axis, angle, deg=True)
+    assert approx_equal(q.elems,
+      col(axis).axis_and_angle_as_unit_quaternion(angle, deg=True).elems)
+  assert (cache.hits, cache.misses) == (1, 2)
+  assert approx_equal(
+    (q + cache.axis_and_angle_as_unit_quaternion(axis, 390, deg=True)).elems,
+    (0,0,0,0))
+  cache.clear()
+  angles = [-45, 0, 10, 123.5]
+  for use_numpy in ([False, True][:1+int(numpy_proxy() is not None)]):
+    rs = cache.axis_and_angles_as_r3_rotation_matrices(
+      axis, angles, deg=True, use_numpy=use_numpy)
+    assert isinstance(rs, mat3_array) and rs.uses_numpy() == use_numpy
+    for r,angle in zip(rs.as_recs(), angles):
+      assert approx_equal(r, col(axis).axis_and_angle_as_r3_rotation_matrix(
+        angle, deg=True))
+    rs = axis_and_angles_as_r3_rotation_matrices(
+      axis, [a * math.pi / 180 for a in angles], use_numpy=use_numpy)
+    assert approx_equal(rs[3],
+      col(axis).axis_and_angle_as_r3_rotation_matrix(123.5, deg=True))
+  #
+  rng = random.Random(1)
+  reference = [(rng.uniform(-10, 10), rng.uniform(-10, 10),
+    rng.uniform(-10, 10)) for i in xrange(20)]
+  r_true = col((1, -2, 0.5)).axis_and_angle_as_r3_rotation_matrix(
+    angle=130, deg=True)
+  t_true = col((3, -1, 4))
+  models = []
+  for noise in [0, 0.1, 0.5]:
+    models.append([(r_true * col(site) + t_true + col([
+      rng.uniform(-noise, noise) for i in xrange(3)])).elems
+        for site in reference])
+  def rmsd_after(fit, other):
+    return (sum([(fit * col(o) - col(r)).norm_sq()
+      for r,o in zip(reference, other)]) / len(reference))**0.5
+  for use_numpy in ([False, True][:1+int(numpy_proxy() is not None)]):
+    fit, rmsd = superpose(reference, models[0], use_numpy=use_numpy)
+    assert isinstance(fit, rt)
+    assert approx_equal(fit.r, r_true.transpose())
+    assert approx_equal(fit.r.determinant(), 1)
+    assert abs(rmsd) < 1e-6
+    assert approx_equal((fit * col(models[0][3])), reference[3])
+    engine = superposition_engine(
+      reference_sites=array.array("d", [e for s in reference for e in s]),
+      use_numpy=use_numpy)
+    assert engine.n_sites == 20
+    rts, rmsds = engine.fit_many(models)
+    assert len(rts) == 3 and rmsds[0] < 1e-6 and rmsds[1] < rmsds[2]
+    for fit, rmsd, other in zip(rts, rmsds, models):
+      assert approx_equal(rmsd, rmsd_after(fit, other))
+      f2, r2 = engine.fit(vec3_array(
+        [e for s in other for e in s], use_numpy=use_numpy))
+      assert approx_equal(f2.r, fit.r) and approx_equal(f2.t, fit.t)
+      assert approx_equal(r2, rmsd)
+      perturbed = rt((fit.r * col((0, 0, 1))
+        .axis_and_angle_as_r3_rotation_matrix(angle=1, deg=True), fit.t))
+      assert rmsd_after(perturbed, other) > rmsd
+    assert engine.fit_many([]) == ([], [])
+    try: engine.fit(models[0][:5])
+    except AssertionError, e: assert str(e) == "numbers of sites differ"
+    else: raise Exception_expected
+  if (numpy_proxy() is not None):
+    numpy = numpy_proxy()
+    stack = numpy.array(models)
+    rts, rmsds = superposition_engine(stack[0], use_numpy=True).fit_many(stack)
+    assert rmsds[0] < 1e-6
+    assert approx_equal(rts[0].r, identity(3))
+  #
+  a = mutable_rec([1, 2, 3, 4, 5, 6], (2,3))
+  elems = a.elems
+  b = rec([6, 5, 4, 3, 2, 1], (2,3))
+  c = a
+  a += b
+  assert a is c and a.elems is elems and a.elems == [7] * 6
+  a -= rec(range(6), (2,3))
+  a *= 2
+  assert a is c and a.elems == [14, 12, 10, 8, 6, 4]
+  a *= sqr([1, 0, 0, 0, 0, 1, 0, 1, 0])
+  assert a is c and a.elems is elems and a.elems == [14, 10, 12, 8, 4, 6]
+  v = mutable_col((1, 2, 3))
+  v += col((1, 1, 1))
+  assert type(v) is mutable_col and v.elems == [2, 3, 4]
+  x = rec((1, 2), (1,2))
+  y = x
+  x += rec((1, 1), (1,2))
+  assert x is not y and x.elems == (2, 3)
+  out = mutable_zeros((2,2))
+  m = sqr([1, 2, 3, 4])
+  assert add_into(out, m, m) is out and out.elems == [2, 4, 6, 8]
+  assert sub_into(out, out, m).elems == [1, 2, 3, 4]
+  assert mul_into(out, m, m).elems == list((m * m).elems)
+  assert mul_into(out, m, out).elems == list((m * m * m).elems)
+  assert mul_into(out, out, 0.5).elems == [e * 0.5 for e in (m*m*m).elems]
+  out = mutable_zeros((2,1))
+  assert mul_into(out, m, col((1, -1))).elems == [-1, -1]
+  assert type(sum([col((1, 2, 3))] * 3)) is vec3
+  assert sum([col((1, 2, 3))] * 3).elems == (3, 6, 9)
+  assert type(sum([sqr(range(9)), identity(3)])) is mat3
+  ms = [mutable_rec([1, 2], (2,1)), col((3, 4)), rec((5, 6), (2,1))]
+  s = sum(ms)
+  assert type(s) is rec and s.elems == (9, 12) and ms[0].elems == [1, 2]
+  assert sum(ms[:1]) is ms[0]
+  assert sum([1, 2.5]) == 3.5
+  #
+  a = typed_rec(range(6), (2,3))
+  assert isinstance(a.elems, array.array) and a.elems.typecode == "d"
+  assert a.elems.itemsize == 8
+  assert a == rec(range(6), (2,3)) and rec(range(6), (2,3)) == a
+  assert a == typed_rec(array.array("l", range(6)), (2,3))
+  assert a != rec(range(1,7), (2,3))
+  assert mutable_rec([1, 2], (2,1)) == col((1, 2))
+  assert (a + a).elems == (0., 2., 4., 6., 8., 10.)
+  assert (a * rec(range(3), (3,1))).elems == (5, 14)
+  assert a.transpose().n == (3,2) and a(1,2) == 5
+  b = rec(range(4), (2,2)).as_typed("l")
+  assert type(b) is typed_rec and b.elems.typecode == "l"
+  assert b.determinant() == -2
+  y = pickle.loads(pickle.dumps(a, 2))
+  assert type(y) is typed_rec and y == a
+  if (numpy_proxy() is not None):
+    numpy = numpy_proxy()
+    na = a.as_numpy_array()
+    assert na.shape == (2,3) and na.dtype == numpy.float64
+    a.elems[4] = 40
+    assert na[1,1] == 40
+    na[0,0] = -1
+    assert a[0] == -1
+    c = typed_rec(numpy.arange(6.).reshape((2,3)), (3,2))
+    assert c.as_numpy_array().shape == (3,2)
+    assert numpy.may_share_memory(c.as_numpy_array(), c.elems)
+    assert c(2,1) == 5
+    buf = bytearray(array.array("d", [1.5, 2.5]).tostring())
+    d = typed_rec(buf, (2,1))
+    assert tuple(d.elems) == (1.5, 2.5)
+    d.as_numpy_array()[1,0] = 3
+    assert array.array("d", bytes(buf))[1] == 3
+  #
+  a = rec([(i*7) % 11 - 5 for i in xrange(7*9)], (7,9))
+  b = rec([(i*5) % 13 - 6 for i in xrange(9*4)], (9,4))
+  registry = pinned_registry((_pure_backend(), 0), (_blocked_backend(), 5))
+  assert registry.select("mul", 7*9*4, (a, b)).name == "blocked"
+  expected = _pure_backend().mul(a, b)
+  blocked = _blocked_backend()
+  blocked.block_rows = 3
+  assert blocked.mul(a, b) == expected
+  assert (a * b).elems == tuple(expected)
+  assert _blocked_backend().mul(a.as_float(), b) == expected
+  parallel = _parallel_backend(max_workers=2)
+  assert parallel.is_available() == (_process_pool_executor_type() is not None)
+  if (parallel.is_available()):
+    try:
+      assert parallel.mul(a, b) == expected
+      assert parallel.mul(b.transpose(), a.transpose()) \
+          == list(rec(expected, (7,4)).transpose().elems)
+    finally:
+      parallel.shutdown()
+  assert not _parallel_backend(max_workers=1).is_available()
+  parallel = _parallel_backend(max_workers=2)
+  registry = pinned_registry(
+    (_pure_backend(), 0), (_blocked_backend(), 5), (parallel, 7))
+  assert registry.threshold("mul", "parallel") is None
+  assert registry.select("mul", 10**9, (a, b)).name == "blocked"
+  assert parallel._executor is None
+  registry.set_threshold("mul", "parallel", 8000000)
+  if (parallel.is_available()):
+    assert registry.select("mul", 10**9, (a, b)).name == "parallel"
+  strassen = _strassen_backend()
+  for n in [1, 2, 5, 8, 13]:
+    a = sqr([(i*7) % 11 - 5 for i in xrange(n*n)])
+    b = sqr([(i*5) % 13 - 6 for i in xrange(n*n)])
+    expected = _pure_backend().mul(a, b)
+    for leaf_size in [1, 2, 3, 64]:
+      strassen.leaf_size = leaf_size
+      assert strassen.mul(a, b) == expected
+    assert _strassen_winograd_mul(
+      list(a.as_float().elems), list(b.elems), n, 1) == expected
+  a = sqr([Fraction(i % 5, i % 3 + 1) for i in xrange(36)])
+  assert strassen.mul(a, a) == list((a * a).elems)
+  rng = random.Random(0)
+  a = sqr([rng.uniform(-1, 1) for i in xrange(40*40)])
+  b = sqr([rng.uniform(-1, 1) for i in xrange(40*40)])
+  strassen.leaf_size = 4
+  c = strassen.mul(a, b)
+  for x,y in zip(c, _blocked_backend().mul(a, b)):
+    assert abs(x - y) < 1e-12
+  assert strassen.accepts("mul", (a, b))
+  assert not strassen.accepts("mul", (a, rec(b.elems, (20,80))))
+  assert not strassen.accepts("mul", (rec(b.elems, (20,80)), a))
+  parallel = _parallel_backend(max_workers=2)
+  registry = pinned_registry((_pure_backend(), 0), (_blocked_backend(), 5),
+    (_strassen_backend(), 6), (parallel, 7))
+  assert registry.select("mul", 256**3, (a, b)).name == "strassen"
+  registry.set_threshold("mul", "parallel", 8000000)
+  if (parallel.is_available()):
+    assert registry.select("mul", 256**3, (a, b)).name == "parallel"
+  registry.set_threshold("mul", "parallel", None)
+  assert registry.select("mul", 128**3, (a, b)).name == "blocked"
+  assert registry.select(
+    "mul", 256**3, (rec(a.elems, (20,80)), rec(b.elems, (80,20)))).name \
+      == "blocked"
+  #
+  assert matrix_chain_order([10, 100, 5, 50])[0] == 7500
+  cost, split = matrix_chain_order([40, 20, 30, 10, 30])
+  assert cost == 26000 and split[0][3] == 2
+  assert matrix_chain_order([3, 4])[0] == 0
+  r = col((1, 2, 3)).axis_and_angle_as_r3_rotation_matrix(30, deg=True)
+  point = col((0.5, -1, 2))
+  pivot = col((1, 1, 1))
+  e = lazy(r) * (lazy(point) - pivot) + pivot
+  assert e.n == (3,1) and e._value is None
+  assert approx_equal(e.eval(), r * (point - pivot) + pivot)
+  assert e.eval() is e.eval()
+  assert approx_equal(e[1], (r * (point - pivot) + pivot)[1])
+  assert approx_equal(e.elems, __rotate_point_around_axis(
+    axis_point_1=(1, 1, 1), axis_point_2=(2, 3, 4), point=(0.5, -1, 2),
+    angle=30, deg=True))
+  a = rec(range(6), (2,3))
+  b = rec(range(6, 12), (2,3))
+  c = rec(range(12), (3,4))
+  v = col((1, -1, 2, 0))
+  e = 2 * lazy(a) - b * 3 + (-lazy(a))
+  assert e.eval().elems == (2*a - b*3 - a).elems
+  e = (lazy(a) + b) * c * v
+  assert e.eval().elems == ((a + b) * c * v).elems
+  assert (a * lazy(c)).elems == (a * c).elems # rec on the left: eager
+  assert (lazy(a) - b)(1, 2) == -6
+  x = lazy(c) * v
+  e = lazy(a) * x + lazy(a) * x
+  assert e.eval().elems == (2 * (a * c * v)).elems
+  try: lazy(a) + c
+  except RuntimeError, err: assert str(err).startswith("Incompatible")
+  else: raise Exception_expected
+  try: lazy(a) * b
+  except RuntimeError, err: assert str(err).startswith("Incompatible")
+  else: raise Exception_expected
+  # chain order: m*w*(u*w) needs 2600 instead of 7500 multiply-adds
+  class counting_mul_backend(_pure_backend):
+    name = "counting_mul"
+    default_thresholds = {"mul": 0}
+    sizes = []
+    def mul(self, a, b):
+      counting_mul_backend.sizes.append(a.n[0]*a.n[1]*b.n[1])
+      return _pure_backend.mul(self, a, b)
+  u = row([1] * 50)
+  m = sqr([(i % 7) - 3 for i in xrange(2500)])
+  w = col([1] * 50)
+  expected = (m * w * u * w).elems
+  backends.register(counting_mul_backend(), priority=100)
+  try:
+    assert (lazy(m) * w * u * w).eval().elems == expected
+    assert sorted(counting_mul_backend.sizes) == [50, 50, 2500]
+  finally:
+    backends.unregister("counting_mul")
+  #
+  d0 = sqr((4, 1, 2, 3))
+  d1 = sqr((2,))
+  d2 = sqr((1, 2, 0, 0, 1, 3, 1, 0, 2))
+  m = rec((d0, zeros((2,1)), rec((1, 0, 0, 0, 0, 0), (2,3)),
+           zeros((1,2)), d1, zeros((1,3)),
+           zeros((3,2)), zeros((3,1)), d2), (3,3))
+  bs = block_sparse.from_partitions(m)
+  dense = m.resolve_partitions()
+  assert bs.n == (6,6) and len(bs) == 4
+  assert bs.row_sizes == (2, 1, 3) and bs.column_sizes == (2, 1, 3)
+  assert bs.as_dense() == dense
+  assert bs[1,0].elems == (0, 0) and bs[0,0] is d0
+  assert bs.transpose().as_dense() == dense.transpose()
+  v = col(range(1, 7))
+  assert (bs * v) == dense * v
+  assert (bs * list(v.elems)) == dense * v
+  assert (bs * rec(range(12), (6,2))) == dense * rec(range(12), (6,2))
+  assert (bs * bs).as_dense() == dense * dense
+  assert (bs * 2).as_dense() == dense * 2
+  assert (bs.transpose() * bs).as_dense() == dense.transpose() * dense
+  assert bs.transpose_multiply().as_dense() == dense.transpose_multiply()
+  assert bs.transpose_multiply(v) == dense.transpose_multiply(v)
+  assert not bs.is_block_diagonal()
+  try: bs.solve_block_diagonal(v)
+  except RuntimeError, e: assert str(e) == "block_sparse: not block diagonal"
+  else: raise Exception_expected
+  bd = block_sparse.block_diagonal([d0, d1, d2])
+  assert bd.is_block_diagonal()
+  x = bd.solve_block_diagonal(v)
+  assert isinstance(x, col)
+  assert approx_equal(bd.as_dense() * x, v)
+  assert approx_equal(x, lu_factorization(bd.as_dense()).solve(v))
+  b = rec(range(12), (6,2))
+  assert approx_equal(bd.as_dense() * bd.solve_block_diagonal(b), b)
+  assert len(bd._lu_factorizations) == 3
+  bd[1,1] = sqr((4,))
+  assert bd._lu_factorizations is None
+  assert approx_equal(bd.solve_block_diagonal(v)[2], 0.75)
+  try: block_sparse([2], [2], {(0,0): sqr((1,2,3,4,5,6,7,8,9))})
+  except AssertionError: pass
+  else: raise Exception_expected
+  #
+  rng = random.Random(2)
+  xyz = [(rng.uniform(-5, 5), rng.uniform(-5, 5), rng.uniform(-5, 5))
+    for i in xrange(12)]
+  xyz[9:] = [(0, 0, 0), (1, 1, 1), (2, 2, 2)]
+  table = [(0, 1, 2, 3), (4, 5, 6, 7), (3, 1, 0, 2), (8, 9, 10, 11),
+           (11, 2, 7, 5)]
+  expected = [_dihedral_angle(sites=col_list([xyz[i] for i in q]), deg=True)
+    for q in table]
+  assert expected[3] is None
+  frames = [xyz, [(x+1, 2*y, 2*z) for x,y,z in xyz]]
+  for use_numpy in ([False, True][:1+int(numpy_proxy() is not None)]):
+    for sites in [xyz, vec3_array([e for s in xyz for e in s],
+                                  use_numpy=use_numpy)]:
+      angles = dihedral_angles(sites, table, deg=True, use_numpy=use_numpy)
+      assert len(angles) == 5
+      for a,e in zip(angles, expected):
+        if (e is None): assert a != a # nan
+        else: assert approx_equal(a, e)
+    angles = dihedral_angles(xyz, deg=False, use_numpy=use_numpy)
+    assert len(angles) == 3
+    assert approx_equal(angles[1] * 180 / math.pi, expected[1])
+    per_frame = dihedral_angles_over_frames(frames, table, deg=True,
+      use_numpy=use_numpy)
+    assert len(per_frame) == 2 and len(per_frame[1]) == 5
+    for angles,frame in zip(per_frame, frames):
+      for a,q in zip(angles, table):
+        e = _dihedral_angle(sites=col_list([frame[i] for i in q]), deg=True)
+        if (e is None): assert a != a
+        else: assert approx_equal(a, e)
+  if (numpy_proxy() is not None):
+    numpy = numpy_proxy()
+    stack = numpy.array(frames)
+    result = dihedral_angles(stack, numpy.array(table), deg=True)
+    assert result.shape == (2, 5)
+    assert approx_equal(list(result[0][:3]), expected[:3])
+    assert numpy.isnan(result[:,3]).all()
+  #
+  import StringIO
+  m = rec((1, -2.5e-12, 3, 4.25, 5e20, -6), (2,3))
+  for kw in [{}, dict(label="ae", one_row_per_line=True, prefix="  "),
+             dict(format="%.3e", matrix_form=True)]:
+    s = StringIO.StringIO()
+    m.write_mathematica_form(s, **kw)
+    assert s.getvalue() == m.mathematica_form(**kw)
+    kw.pop("matrix_form", None)
+    s = StringIO.StringIO()
+    m.write_matlab_form(s, **kw)
+    assert s.getvalue() == m.matlab_form(**kw)
+  assert m.matlab_form(one_row_per_line=True) \
+    == "[1, -2.5e-12, 3;\n 4.25, 5e+20, -6]"
+  npy_file_name = tempfile.mktemp(suffix=".npy")
+  try:
+    for m,is_float in [(m, True), (rec(range(-3,3), (3,2)), False),
+                       (sqr([2**62, -1, 0, 1]), False),
+                       (rec([], (0,4)), False), (sqr([1.5, 2, 3, 4]), True)]:
+      save_npy(m, npy_file_name)
+      assert os.path.getsize(npy_file_name) % 64 == len(m.elems) * 8 % 64
+      for memory_map in [False, True, None]:
+        l = load_npy(npy_file_name, memory_map=memory_map)
+        assert isinstance(l, typed_rec)
+        assert l.n == m.n
+        assert list(l.elems) == list(m.elems)
+        assert l == m
+      assert isinstance(l.elems, array.array)
+      assert (l.elems.typecode == "d") == is_float
+      s = StringIO.StringIO()
+      save_npy(l, s)
+      assert load_npy(StringIO.StringIO(s.getvalue())) == m
+      if (numpy_proxy() is not None):
+        numpy = numpy_proxy()
+        a = numpy.load(npy_file_name)
+        assert a.shape == m.n
+        assert a.tolist() == [list(m.elems[i*m.n[1]:(i+1)*m.n[1]])
+                              for i in xrange(m.n[0])]
+        l = load_npy(npy_file_name, memory_map=True)
+        if (len(m.elems) != 0):
+          assert isinstance(l.elems, numpy.memmap)
+          assert l.as_numpy_array().tolist() == a.tolist()
+        numpy.save(npy_file_name, numpy.asfortranarray(a))
+        assert load_npy(npy_file_name) == m
+        numpy.save(npy_file_name, a.astype(">f8"))
+        assert load_npy(npy_file_name) == m
+    try: save_npy(sqr([2**64]), npy_file_name)
+    except RuntimeError, e:
+      assert str(e) == "save_npy: integer out of int64 range."
+    else: raise Exception_expected
+    open(npy_file_name, "wb").write("not numpy")
+    try: load_npy(npy_file_name)
+    except RuntimeError, e: assert str(e) == "load_npy: not a .npy file."
+    else: raise Exception_expected
+  finally:
+    if (os.path.exists(npy_file_name)):
+      os.remove(npy_file_name)
+  derived_value_cache.clear()
+  r = sqr((0,-1,0, 1,0,0, 0,0,1))
+  assert r.cache_derived_values() is r
+  assert r.caches_derived_values()
+  assert isinstance(r, mat3)
+  ri = r.inverse()
+  assert r.inverse() is ri and r.transpose() is r.transpose()
+  assert ri.elems == r.transpose().elems
+  assert r.determinant() == 1 and r.determinant() == 1
+  for i in xrange(3): assert r.is_r3_rotation_matrix()
+  assert derived_value_cache.hits == {
+    "inverse": 1, "transpose": 2, "determinant": 1,
+    "is_r3_rotation_matrix_rms": 2}
+  assert derived_value_cache.misses == {
+    "inverse": 1, "transpose": 1, "determinant": 1,
+    "is_r3_rotation_matrix_rms": 1}
+  assert approx_equal(derived_value_cache.hit_ratio(), 6/10)
+  u = col((3,4,0)).cache_derived_values()
+  v = col((0,4,3)).cache_derived_values()
+  for i in xrange(4): assert approx_equal(u.cos_angle(v), 16/25)
+  assert u.length_sq() == 25 and abs(rec((3,4), (1,2))) == 5
+  assert derived_value_cache.misses["norm_sq"] == 2
+  assert derived_value_cache.hits["norm_sq"] == 7
+  sio = StringIO.StringIO()
+  derived_value_cache.show(out=sio, prefix="  ")
+  assert sio.getvalue().splitlines()[3] \
+    == "  norm_sq: hits: 7, misses: 2 (hit ratio 0.778)"
+  import pickle
+  p = pickle.loads(pickle.dumps(r))
+  assert p == r and not p.caches_derived_values()
+  assert r.cache_derived_values(enable=False) is r
+  assert not r.caches_derived_values()
+  assert r.inverse() is not r.inverse()
+  derived_value_cache.clear()
+  assert derived_value_cache.hit_ratio() == 0
+  for m in [mutable_rec([1,2,3,4], (2,2)), typed_rec([1,2,3,4], (2,2))]:
+    try: m.cache_derived_values()
+    except RuntimeError, e:
+      assert str(e) \
+        == "cache_derived_values(): not available for mutable elems."
+    else: raise Exception_expected
+    assert not m.caches_derived_values()
+  #
   print "OK"
 
 if (__name__ == "__main__"):
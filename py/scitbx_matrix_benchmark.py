@@ -0,0 +1,507 @@
+"""
+Timings for scitbx_matrix.
+
+Usage:
+  python scitbx_matrix_benchmark.py [options]
+  python scitbx_matrix_benchmark.py --vec3-mat3 [n_repeats]
+  python scitbx_matrix_benchmark.py --calibrate [--config=FILE]
+  python scitbx_matrix_benchmark.py --exact [--sizes=4,8,16,32,50]
+  python scitbx_matrix_benchmark.py --mul [--sizes=8,16,32,64,128,256]
+
+Without a mode option (--vec3-mat3, --calibrate, --exact, --mul) the
+benchmark suite is run: each operation in suite_operations is timed for
+a grid of sizes and element types. Options:
+  --sizes=2,4,8,16,32
+  --types=int,float,fraction
+  --operations=mul,inverse,...
+  --min-time=0.05     (seconds per measurement)
+  --json=FILE         write the results as JSON (- for stdout)
+  --compare=FILE      compare with a previous --json output and flag
+                      regressions (exit status 1 if there are any)
+  --tolerance=1.25    new/old time ratio above which a result is
+                      flagged as a regression
+
+--vec3-mat3 compares the vec3/mat3 fast paths with the generic rec code.
+
+--calibrate measures the crossover sizes between the "pure" backend and
+the other available backends (numpy, flex) and writes them to the
+backend config file (see scitbx_matrix.backend_registry).
+
+--exact compares the exact determinant (Bareiss) and inverse (Fraction
+Gauss-Jordan) for int and fraction matrices with the float LU path.
+
+--mul compares the naive multiplication loop (pure backend) with the
+blocked and Strassen-Winograd backends and, if available, the parallel
+(process pool) and numpy backends.
+"""
+
+import fractions
+import json
+import platform
+import random
+import sys
+import time
+
+import scitbx_matrix as matrix
+
+
+def time_call(function, n_repeats):
+  t0 = time.time()
+  for i in xrange(n_repeats):
+    function()
+  return time.time() - t0
+
+
+def vec3_mat3_cases():
+  "(label, generic function, fast path function) tuples."
+  a = (1.5, -2.25, 3.125)
+  b = (0.25, 4.5, -5.75)
+  m = (0.9, -0.1, 0.4, 0.2, 0.8, -0.3, -0.4, 0.35, 0.85)
+  ga, gb, gm = matrix.rec(a, (3,1)), matrix.rec(b, (3,1)), matrix.rec(m, (3,3))
+  fa, fb, fm = matrix.col(a), matrix.col(b), matrix.sqr(m)
+  assert type(fa) is matrix.vec3 and type(fm) is matrix.mat3
+  return [
+    ("col(x,y,z)", lambda: matrix.rec(a, (3,1)), lambda: matrix.col(a)),
+    ("sqr(9 elems)", lambda: matrix.rec(m, (3,3)), lambda: matrix.sqr(m)),
+    ("vec3 + vec3", lambda: ga + gb, lambda: fa + fb),
+    ("vec3 * scalar", lambda: ga * 2.5, lambda: fa * 2.5),
+    ("vec3.dot", lambda: ga.dot(gb), lambda: fa.dot(fb)),
+    ("vec3.cross", lambda: ga.cross(gb), lambda: fa.cross(fb)),
+    ("abs(vec3)", lambda: abs(ga), lambda: abs(fa)),
+    ("mat3 * vec3", lambda: gm * ga, lambda: fm * fa),
+    ("mat3 * mat3", lambda: gm * gm, lambda: fm * fm),
+    ("mat3.transpose", lambda: gm.transpose(), lambda: fm.transpose()),
+    ("mat3.determinant", lambda: gm.determinant(), lambda: fm.determinant()),
+    ("mat3.inverse", lambda: gm.inverse(), lambda: fm.inverse()),
+  ]
+
+
+def show_vec3_mat3_timings(n_repeats, out=None):
+  if (out is None): out = sys.stdout
+  print >> out, "vec3/mat3 fast path vs. generic rec (%d repeats):" % n_repeats
+  print >> out, "  %-18s %12s %12s %8s" % (
+    "operation", "generic us", "fast us", "speedup")
+  for label, generic, fast in vec3_mat3_cases():
+    tg = time_call(generic, n_repeats)
+    tf = time_call(fast, n_repeats)
+    print >> out, "  %-18s %12.3f %12.3f %8.2f" % (
+      label, tg / n_repeats * 1e6, tf / n_repeats * 1e6, tg / max(tf, 1e-12))
+
+
+def time_per_call(function, min_time=0.02):
+  "Seconds per call, repeating until at least min_time has elapsed."
+  n_repeats = 1
+  while True:
+    t = time_call(function, n_repeats)
+    if (t >= min_time):
+      return t / n_repeats
+    n_repeats *= 2
+
+
+def random_sqr(n, offset=0):
+  "Random float matrix; offset is added to the diagonal."
+  elems = [matrix.random.uniform(-1, 1) for i in xrange(n*n)]
+  for i in xrange(n):
+    elems[i*(n+1)] += offset
+  return matrix.rec(elems, (n,n))
+
+
+calibration_sizes = [2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64]
+
+
+def calibration_cases(n):
+  "(operation, size, operands, call) tuples for n x n matrices."
+  a = random_sqr(n)
+  b = random_sqr(n)
+  m = random_sqr(n, offset=n)
+  return [
+    ("mul", n**3, (a, b), lambda backend: backend.mul(a, b)),
+    ("transpose_multiply", n**3, (a, b),
+      lambda backend: backend.transpose_multiply(a, b)),
+    ("determinant", n, (m,), lambda backend: backend.determinant(m)),
+    ("inverse", n, (m,), lambda backend: backend.inverse(m)),
+  ]
+
+
+def calibrate_backend_thresholds(
+      sizes=None, min_time=0.02, registry=None, out=None):
+  """\
+Sets the thresholds of all available non-pure backends in registry to
+the smallest size at which the backend is faster than the pure backend
+for that size and all larger sizes (None if it is never faster).
+"""
+  if (sizes is None): sizes = calibration_sizes
+  if (registry is None): registry = matrix.backends
+  if (out is None): out = sys.stdout
+  pure = registry.pure
+  others = [registry.backends[name]
+    for priority, name in registry.priorities
+      if name != "pure" and registry.backends[name].is_available()]
+  timings = {} # (operation, backend name) -> [(size, t_pure, t_other)]
+  for n in sizes:
+    for operation, size, operands, call in calibration_cases(n):
+      t_pure = None
+      for backend in others:
+        if (not hasattr(backend, operation)): continue
+        if (not backend.accepts(operation, operands)): continue
+        if (t_pure is None):
+          t_pure = time_per_call(lambda: call(pure), min_time)
+        t_other = time_per_call(lambda: call(backend), min_time)
+        print >> out, "  %-18s n=%-3d pure: %10.3f us  %s: %10.3f us" % (
+          operation, n, t_pure*1e6, backend.name, t_other*1e6)
+        timings.setdefault((operation, backend.name), []).append(
+          (size, t_pure, t_other))
+  for (operation, name), results in sorted(timings.items()):
+    threshold = None
+    for size, t_pure, t_other in reversed(results):
+      if (t_other >= t_pure): break
+      threshold = size
+    registry.set_threshold(operation, name, threshold)
+    print >> out, "threshold %s %s: %s" % (operation, name, threshold)
+  return registry
+
+
+exact_sizes = [4, 8, 16, 32, 50]
+
+
+def exact_cases(n, rng):
+  "(label, exact function, float LU function) tuples for n x n matrices."
+  mi = make_sqr(n, 'int', rng, diagonal_offset=10*n)
+  mf = make_sqr(n, 'fraction', rng, diagonal_offset=10*n)
+  mi_float = mi.as_float()
+  mf_float = mf.as_float()
+  return [
+    ('determinant int', lambda: matrix.determinant_bareiss(mi),
+      lambda: matrix.determinant_via_lu(mi_float)),
+    ('determinant fraction', lambda: matrix.determinant_bareiss(mf),
+      lambda: matrix.determinant_via_lu(mf_float)),
+    ('inverse fraction', lambda: matrix.inverse_via_fractions(mf),
+      lambda: matrix.inverse_via_lu(mf_float)),
+  ]
+
+
+def show_exact_timings(sizes=None, min_time=0.05, out=None):
+  if (sizes is None): sizes = exact_sizes
+  if (out is None): out = sys.stdout
+  print >> out, 'exact vs. float LU:'
+  print >> out, '  %-22s %4s %14s %14s %8s' % (
+    'operation', 'n', 'exact us', 'float us', 'ratio')
+  for n in sizes:
+    for label, exact, float_lu in exact_cases(n, random.Random(0)):
+      te = time_per_call(exact, min_time)
+      tf = time_per_call(float_lu, min_time)
+      print >> out, '  %-22s %4d %14.3f %14.3f %8.2f' % (
+        label, n, te*1e6, tf*1e6, te / max(tf, 1e-12))
+
+
+mul_sizes = [8, 16, 32, 64, 128, 256]
+
+
+def show_mul_timings(sizes=None, min_time=0.05, registry=None, out=None):
+  if (sizes is None): sizes = mul_sizes
+  if (registry is None): registry = matrix.backends
+  if (out is None): out = sys.stdout
+  names = [name for name in (
+    'pure', 'blocked', 'strassen', 'parallel', 'numpy')
+    if name in registry.backends and registry.backends[name].is_available()]
+  print >> out, 'n x n times n x n float matrices, us per product:'
+  print >> out, '  %4s' % 'n' + ''.join(['%14s' % name for name in names])
+  for n in sizes:
+    a = random_sqr(n)
+    b = random_sqr(n)
+    line = '  %4d' % n
+    for name in names:
+      backend = registry.backends[name]
+      t = time_per_call(lambda: backend.mul(a, b), min_time)
+      line += '%14.1f' % (t*1e6)
+    print >> out, line
+    print >> out, '        selected for n=%d: %s' % (n, registry.select(
+      operation='mul', size=n**3, operands=(a, b)).name)
+
+
+def make_elems(count, element_type, rng):
+  if (element_type == 'int'):
+    return [rng.randint(-9, 9) for i in xrange(count)]
+  if (element_type == 'float'):
+    return [rng.uniform(-1, 1) for i in xrange(count)]
+  if (element_type == 'fraction'):
+    return [fractions.Fraction(rng.randint(-9, 9), rng.randint(1, 9))
+      for i in xrange(count)]
+  raise ValueError('Unknown element type: %s' % element_type)
+
+
+def make_sqr(n, element_type, rng, diagonal_offset=0):
+  elems = make_elems(n*n, element_type, rng)
+  for i in xrange(n):
+    elems[i*(n+1)] += diagonal_offset
+  return matrix.rec(elems, (n,n))
+
+
+def make_unit_quaternions(count, element_type, rng):
+  """\
+For int and fraction the quaternions are not normalized, which does not
+matter for timing the (polynomial) conversion to a matrix.
+"""
+  result = []
+  for i in xrange(count):
+    q = matrix.col(make_elems(4, element_type, rng))
+    if (element_type == 'float'): q = q.normalize()
+    result.append(q)
+  return result
+
+
+def setup_mul(size, element_type, rng):
+  a = make_sqr(size, element_type, rng)
+  b = make_sqr(size, element_type, rng)
+  return lambda: a * b
+
+
+def setup_transpose_multiply(size, element_type, rng):
+  a = make_sqr(size, element_type, rng)
+  b = make_sqr(size, element_type, rng)
+  return lambda: a.transpose_multiply(b)
+
+
+def setup_inverse(size, element_type, rng):
+  m = make_sqr(size, element_type, rng, diagonal_offset=10*size)
+  return lambda: m.inverse()
+
+
+def setup_determinant(size, element_type, rng):
+  m = make_sqr(size, element_type, rng, diagonal_offset=10*size)
+  return lambda: m.determinant()
+
+
+def setup_resolve_partitions(size, element_type, rng):
+  "size x size grid of 2x2 blocks."
+  blocks = [make_sqr(2, element_type, rng) for i in xrange(size*size)]
+  m = matrix.rec(blocks, (size,size))
+  return lambda: m.resolve_partitions()
+
+
+def setup_unit_quaternion_as_r3_rotation_matrix(size, element_type, rng):
+  "size conversions per call."
+  qs = make_unit_quaternions(size, element_type, rng)
+  def call():
+    for q in qs:
+      q.unit_quaternion_as_r3_rotation_matrix()
+  return call
+
+
+def setup_r3_rotation_matrix_as_unit_quaternion(size, element_type, rng):
+  "size conversions per call."
+  rs = [q.unit_quaternion_as_r3_rotation_matrix()
+    for q in make_unit_quaternions(size, element_type, rng)]
+  def call():
+    for r in rs:
+      r.r3_rotation_matrix_as_unit_quaternion()
+  return call
+
+
+def setup_axis_and_angle_as_r3_rotation_matrix(size, element_type, rng):
+  "size conversions per call."
+  axes = [matrix.col(make_elems(3, element_type, rng)) + matrix.col((2,0,0))
+    for i in xrange(size)]
+  def call():
+    for axis in axes:
+      axis.axis_and_angle_as_r3_rotation_matrix(angle=30, deg=True)
+  return call
+
+
+def setup_rotate_point_around_axis(size, element_type, rng):
+  "size points per call."
+  axis_point_1 = (0, 0, 0)
+  axis_point_2 = (1, 2, 3)
+  points = [tuple(make_elems(3, element_type, rng)) for i in xrange(size)]
+  rotate_point_around_axis = matrix.rotate_point_around_axis
+  def call():
+    for point in points:
+      rotate_point_around_axis(
+        axis_point_1=axis_point_1,
+        axis_point_2=axis_point_2,
+        point=point,
+        angle=30,
+        deg=True)
+  return call
+
+
+all_element_types = ('int', 'float', 'fraction')
+
+# (operation, element types, setup function)
+# setup(size, element_type, rng) returns the function to be timed.
+suite_operations = [
+  ('mul', all_element_types, setup_mul),
+  ('transpose_multiply', all_element_types, setup_transpose_multiply),
+  ('inverse', all_element_types, setup_inverse),
+  ('determinant', all_element_types, setup_determinant),
+  ('resolve_partitions', all_element_types, setup_resolve_partitions),
+  ('unit_quaternion_as_r3_rotation_matrix', all_element_types,
+    setup_unit_quaternion_as_r3_rotation_matrix),
+  ('r3_rotation_matrix_as_unit_quaternion', ('float',),
+    setup_r3_rotation_matrix_as_unit_quaternion),
+  ('axis_and_angle_as_r3_rotation_matrix', ('int', 'float'),
+    setup_axis_and_angle_as_r3_rotation_matrix),
+  ('rotate_point_around_axis', ('int', 'float'),
+    setup_rotate_point_around_axis),
+]
+
+default_suite_sizes = [2, 4, 8, 16, 32]
+
+
+def run_suite(
+      sizes=None,
+      element_types=None,
+      operations=None,
+      min_time=0.05,
+      out=None):
+  """\
+Returns a JSON-serializable dict with "metadata" and "results" (a list
+of dicts with operation, element_type, size, seconds_per_call).
+"""
+  if (sizes is None): sizes = default_suite_sizes
+  if (element_types is None): element_types = all_element_types
+  known = [operation for operation, types, setup in suite_operations]
+  if (operations is None):
+    operations = known
+  for operation in operations:
+    if (operation not in known):
+      raise ValueError('Unknown operation: %s' % operation)
+  results = []
+  for operation, types, setup in suite_operations:
+    if (operation not in operations): continue
+    for element_type in element_types:
+      if (element_type not in types): continue
+      for size in sizes:
+        rng = random.Random(0)
+        t = time_per_call(setup(size, element_type, rng), min_time)
+        results.append(dict(
+          operation=operation,
+          element_type=element_type,
+          size=size,
+          seconds_per_call=t))
+        if (out is not None):
+          print >> out, '%-38s %-8s %4d %14.3f us' % (
+            operation, element_type, size, t*1e6)
+  metadata = dict(
+    time=time.strftime('%Y-%m-%d %H:%M:%S'),
+    python=sys.version.split()[0],
+    platform=platform.platform(),
+    numpy=matrix.numpy_proxy() is not None,
+    flex=matrix.flex_proxy() is not None,
+    min_time=min_time)
+  return dict(metadata=metadata, results=results)
+
+
+def compare_results(previous, current, tolerance=1.25, out=None):
+  """\
+Returns a list of (operation, element_type, size, ratio) for all results
+in current that are slower than in previous by more than tolerance
+(ratio = current time / previous time).
+"""
+  def index(run):
+    return dict([
+      ((r['operation'], r['element_type'], r['size']), r['seconds_per_call'])
+        for r in run['results']])
+  old = index(previous)
+  regressions = []
+  for r in current['results']:
+    key = (r['operation'], r['element_type'], r['size'])
+    if (key not in old or old[key] <= 0): continue
+    ratio = r['seconds_per_call'] / old[key]
+    flag = ''
+    if (ratio > tolerance):
+      regressions.append(key + (ratio,))
+      flag = '  REGRESSION'
+    elif (ratio < 1 / tolerance):
+      flag = '  improved'
+    if (out is not None):
+      print >> out, '%-38s %-8s %4d %8.2fx%s' % (key + (ratio, flag))
+  return regressions
+
+
+def run(args):
+  mode = 'suite'
+  options = {}
+  positional = []
+  for arg in args:
+    if (arg == '--calibrate'):
+      mode = 'calibrate'
+    elif (arg == '--vec3-mat3'):
+      mode = 'vec3_mat3'
+    elif (arg == '--exact'):
+      mode = 'exact'
+    elif (arg == '--mul'):
+      mode = 'mul'
+    elif (arg.startswith('--') and '=' in arg):
+      key, value = arg[2:].split('=', 1)
+      options[key] = value
+    else:
+      positional.append(arg)
+  def pop_option(key, default=None):
+    return options.pop(key, default)
+  if (mode == 'calibrate'):
+    config_file_name = pop_option('config')
+    assert len(positional) == 0 and len(options) == 0, options
+    registry = calibrate_backend_thresholds()
+    print 'Wrote:', registry.save_config(config_file_name)
+    return 0
+  if (mode == 'vec3_mat3'):
+    assert len(positional) <= 1 and len(options) == 0, '[n_repeats]'
+    n_repeats = 100000
+    if positional:
+      n_repeats = int(positional[0])
+    show_vec3_mat3_timings(n_repeats)
+    return 0
+  assert len(positional) == 0, positional
+  sizes = pop_option('sizes')
+  if (sizes is not None): sizes = [int(n) for n in sizes.split(',')]
+  if (mode == 'exact'):
+    min_time = float(pop_option('min-time', 0.05))
+    assert len(options) == 0, 'Unknown options: %s' % ', '.join(options)
+    show_exact_timings(sizes, min_time)
+    return 0
+  if (mode == 'mul'):
+    min_time = float(pop_option('min-time', 0.05))
+    assert len(options) == 0, 'Unknown options: %s' % ', '.join(options)
+    show_mul_timings(sizes, min_time)
+    return 0
+  element_types = pop_option('types')
+  if (element_types is not None): element_types = element_types.split(',')
+  operations = pop_option('operations')
+  if (operations is not None): operations = operations.split(',')
+  min_time = float(pop_option('min-time', 0.05))
+  json_file_name = pop_option('json')
+  compare_file_name = pop_option('compare')
+  tolerance = float(pop_option('tolerance', 1.25))
+  assert len(options) == 0, 'Unknown options: %s' % ', '.join(options)
+  if (json_file_name == '-'):
+    out = sys.stderr
+  else:
+    out = sys.stdout
+  current = run_suite(
+    sizes=sizes,
+    element_types=element_types,
+    operations=operations,
+    min_time=min_time,
+    out=out)
+  if (json_file_name is not None):
+    if (json_file_name == '-'):
+      f = sys.stdout
+    else:
+      f = open(json_file_name, 'w')
+    json.dump(current, f, indent=1, sort_keys=True)
+    f.write('\n')
+    if (f is not sys.stdout):
+      f.close()
+  if (compare_file_name is not None):
+    previous = json.load(open(compare_file_name))
+    print >> out, 'Comparison with %s (current/previous):' % compare_file_name
+    regressions = compare_results(previous, current, tolerance, out=out)
+    if regressions:
+      print >> out, 'Regressions: %d' % len(regressions)
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(run(sys.argv[1:]))